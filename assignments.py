@@ -0,0 +1,89 @@
+import constants
+import transactions
+
+# query for the loads carried by a boat
+def carried_loads(client, boat_key):
+  query = client.query(kind=constants.loads)
+  query.add_filter("carrier.id", "=", str(boat_key.id))
+  return query
+
+# per-load outcomes of assigning loads to, or removing them from, a boat
+ASSIGNED = "assigned"
+REMOVED = "removed"
+BOAT_NOT_FOUND = "boat_not_found"
+LOAD_NOT_FOUND = "load_not_found"
+ALREADY_ASSIGNED = "already_assigned"
+NOT_ON_BOAT = "not_on_boat"
+
+# a boat's loads are the loads whose carrier is the boat, found with a query on the indexed carrier.id
+# the boat is still written with every chunk, bumping its version so its ETag changes when its loads do,
+# and so a concurrent delete of the boat makes the chunk's transaction fail;
+# each chunk leaves room for it in the transaction
+CHUNK_SIZE = constants.max_mutations - 1
+
+# assign loads to a boat, and return a status for each load id
+def assign(client, boat_key, load_ids):
+  return apply_in_chunks(client, assign_chunk, boat_key, load_ids)
+
+# remove loads from a boat, and return a status for each load id
+def unassign(client, boat_key, load_ids):
+  return apply_in_chunks(client, unassign_chunk, boat_key, load_ids)
+
+def apply_in_chunks(client, apply_chunk, boat_key, load_ids):
+  load_ids = list(dict.fromkeys(load_ids))
+  statuses = {}
+  for start in range(0, len(load_ids), CHUNK_SIZE):
+    chunk = load_ids[start:start + CHUNK_SIZE]
+    statuses.update(transactions.run_in_transaction(client, apply_chunk, client, boat_key, chunk))
+  return statuses
+
+# read the boat and the loads in one lookup, keyed by their keys
+def get_boat_and_loads(client, boat_key, load_ids):
+  load_keys = [client.key(constants.loads, load_id) for load_id in load_ids]
+  entities = {entity.key: entity for entity in client.get_multi([boat_key] + load_keys)}
+  boat = entities.get(boat_key)
+  if boat is not None and boat.get("deleting"):
+    boat = None
+  return boat, [entities.get(load_key) for load_key in load_keys]
+
+def assign_chunk(client, boat_key, load_ids):
+  boat, loads = get_boat_and_loads(client, boat_key, load_ids)
+  if boat is None:
+    return {load_id: BOAT_NOT_FOUND for load_id in load_ids}
+
+  statuses = {}
+  updated = []
+  for load_id, load in zip(load_ids, loads):
+    if load is None:
+      statuses[load_id] = LOAD_NOT_FOUND
+    elif load["carrier"] is not None:
+      statuses[load_id] = ALREADY_ASSIGNED
+    else:
+      load["carrier"] = {"id": str(boat_key.id), "name": boat["name"]}
+      updated.append(load)
+      statuses[load_id] = ASSIGNED
+
+  if updated:
+    client.put_multi([boat] + updated)
+  return statuses
+
+def unassign_chunk(client, boat_key, load_ids):
+  boat, loads = get_boat_and_loads(client, boat_key, load_ids)
+  if boat is None:
+    return {load_id: BOAT_NOT_FOUND for load_id in load_ids}
+
+  statuses = {}
+  updated = []
+  for load_id, load in zip(load_ids, loads):
+    if load is None:
+      statuses[load_id] = LOAD_NOT_FOUND
+    elif not load["carrier"] or load["carrier"]["id"] != str(boat_key.id):
+      statuses[load_id] = NOT_ON_BOAT
+    else:
+      load["carrier"] = None
+      updated.append(load)
+      statuses[load_id] = REMOVED
+
+  if updated:
+    client.put_multi([boat] + updated)
+  return statuses
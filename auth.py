@@ -0,0 +1,169 @@
+from google.auth import jwt
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import outbound
+import re
+import threading
+import time
+
+# Google's signing certificates for ID tokens, and the issuers it signs them as
+# reference: https://developers.google.com/identity/sign-in/web/backend-auth
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+# fallback lifetime for certificates when the response has no usable Cache-Control header
+DEFAULT_CERTS_TTL = 300
+
+# never refetch certificates more often than this when a token names an unknown key id
+MIN_REFRESH_INTERVAL = 30
+
+# read the max-age directive out of a Cache-Control header
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+# return the unverified header of a JWT, or raise ValueError if it cannot be parsed
+def unverified_header(token):
+  try:
+    encoded = token.split(".")[0]
+    encoded += "=" * (-len(encoded) % 4)
+    return json.loads(base64.urlsafe_b64decode(encoded))
+  except (AttributeError, IndexError, TypeError, ValueError):
+    raise ValueError("Malformed JWT header")
+
+# signing certificates fetched from Google and cached for as long as Cache-Control allows
+class GoogleCertCache:
+  def __init__(self, certs_url=GOOGLE_CERTS_URL, transport=None, clock=time.time):
+    self.certs_url = certs_url
+    self.transport = transport
+    self.clock = clock
+    self.certs = {}
+    self.expires_at = 0
+    self.fetched_at = None
+    self.hits = 0
+    self.fetches = 0
+    self.lock = threading.Lock()
+
+  # return the certificates, refetching them if they expired or if kid is not among them
+  def get(self, kid):
+    with self.lock:
+      now = self.clock()
+      if now < self.expires_at and kid in self.certs:
+        self.hits += 1
+        return self.certs
+
+      # an unknown kid means Google may have rotated its keys, but don't let forged kids force a fetch per request
+      rotated_recently = self.fetched_at is not None and now - self.fetched_at < MIN_REFRESH_INTERVAL
+      if now < self.expires_at and rotated_recently:
+        self.hits += 1
+        return self.certs
+
+      self.refresh(now)
+      return self.certs
+
+  # fetch the certificates unless the cached ones are still fresh, e.g. while warming up an instance
+  def prefetch(self):
+    with self.lock:
+      now = self.clock()
+      if now >= self.expires_at:
+        self.refresh(now)
+
+  # fetch the certificates and compute their expiry from the Cache-Control and Age headers
+  # fetches share the app's pooled outbound session, which is only built once a fetch is needed
+  def refresh(self, now):
+    if self.transport is None:
+      self.transport = outbound.google_transport()
+    response = self.transport(url=self.certs_url, method="GET", timeout=(outbound.CONNECT_TIMEOUT, outbound.READ_TIMEOUT))
+    if response.status != 200:
+      raise ValueError("Could not fetch certificates at " + self.certs_url)
+
+    data = response.data
+    if isinstance(data, bytes):
+      data = data.decode("utf-8")
+    self.certs = json.loads(data)
+    self.fetches += 1
+    self.fetched_at = now
+    self.expires_at = now + self.max_age(response.headers)
+
+  @staticmethod
+  def max_age(headers):
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    cache_control = headers.get("cache-control", "")
+    if "no-store" in cache_control or "no-cache" in cache_control:
+      return 0
+    match = MAX_AGE_RE.search(cache_control)
+    if not match:
+      return DEFAULT_CERTS_TTL
+    age = int(headers.get("age", "0") or 0)
+    return max(int(match.group(1)) - age, 0)
+
+  def stats(self):
+    return {"key_hits": self.hits, "key_fetches": self.fetches}
+
+# a fixed set of certificates or public keys, used offline and in tests
+class StaticKeySet:
+  def __init__(self, certs):
+    self.certs = dict(certs)
+
+  def get(self, kid):
+    return self.certs
+
+  def prefetch(self):
+    pass
+
+  def stats(self):
+    return {"key_hits": 0, "key_fetches": 0}
+
+# verifies ID tokens against cached keys, and remembers verified tokens until they expire
+class TokenVerifier:
+  def __init__(self, audience, keys=None, issuers=GOOGLE_ISSUERS, max_tokens=4096, clock=time.time):
+    self.audience = audience
+    self.keys = keys if keys is not None else GoogleCertCache(clock=clock)
+    self.issuers = issuers
+    self.max_tokens = max_tokens
+    self.clock = clock
+    self.tokens = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  # return the claims of a valid token, or raise ValueError
+  def verify(self, token):
+    if not token:
+      raise ValueError("Missing JWT")
+
+    # tokens are kept by hash so the cache never holds bearer credentials
+    token_hash = hashlib.sha256(token.encode("utf-8")).digest()
+    now = self.clock()
+
+    with self.lock:
+      idinfo = self.tokens.get(token_hash)
+      if idinfo is not None:
+        if idinfo["exp"] > now:
+          self.tokens.move_to_end(token_hash)
+          self.hits += 1
+          return dict(idinfo)
+        del self.tokens[token_hash]
+      self.misses += 1
+
+    header = unverified_header(token)
+    certs = self.keys.get(header.get("kid"))
+    idinfo = jwt.decode(token, certs=certs, audience=self.audience)
+    if idinfo.get("iss") not in self.issuers:
+      raise ValueError("Wrong issuer. 'iss' should be one of the following: {}".format(self.issuers))
+
+    with self.lock:
+      self.tokens[token_hash] = idinfo
+      self.tokens.move_to_end(token_hash)
+      while len(self.tokens) > self.max_tokens:
+        self.tokens.popitem(last=False)
+    return dict(idinfo)
+
+  # fetch the signing keys ahead of the first request
+  def warm(self):
+    self.keys.prefetch()
+
+  def stats(self):
+    stats = {"token_hits": self.hits, "token_misses": self.misses, "tokens_cached": len(self.tokens)}
+    stats.update(self.keys.stats())
+    return stats
@@ -0,0 +1,64 @@
+from google.cloud import datastore
+import constants
+import transactions
+
+# per-item outcomes of a batch request
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+INVALID = "invalid"
+NOT_FOUND = "not_found"
+FORBIDDEN = "forbidden"
+
+# items accepted in one batch request
+MAX_ITEMS = 10000
+
+# a deleted load leaves a tombstone and its boat is written in the same transaction,
+# so each chunk leaves room for three mutations per load
+DELETE_CHUNK_SIZE = constants.max_mutations // 3
+
+def chunks(items, size):
+  for start in range(0, len(items), size):
+    yield items[start:start + size]
+
+# create entities of a kind from their properties, allocating all their ids in one call, and return them in order
+def create(client, kind, properties):
+  if not properties:
+    return []
+  keys = client.allocate_ids(client.key(kind), len(properties))
+  entities = []
+  for key, values in zip(keys, properties):
+    entity = datastore.Entity(key=key)
+    entity.update(values)
+    entities.append(entity)
+  put(client, entities)
+  return entities
+
+def put(client, entities):
+  for chunk in chunks(entities, constants.max_mutations):
+    client.put_multi(chunk)
+
+# read the entities of a kind with the given ids, keyed by id; ids that don't exist are left out
+def get_by_ids(client, kind, ids):
+  keys = [client.key(kind, entity_id) for entity_id in ids]
+  found = {}
+  for chunk in chunks(keys, constants.max_lookup):
+    for entity in client.get_multi(chunk):
+      found[entity.key.id] = entity
+  return found
+
+# delete loads, writing the boats they are on in the same transaction to bump the boats' versions
+# returns the keys of the loads that still existed when deleted
+def delete_loads(client, load_keys):
+  deleted = []
+  for chunk in chunks(load_keys, DELETE_CHUNK_SIZE):
+    deleted.extend(transactions.run_in_transaction(client, delete_loads_chunk, client, chunk))
+  return deleted
+
+def delete_loads_chunk(client, load_keys):
+  loads = client.get_multi(load_keys)
+  boat_keys = {client.key(constants.boats, int(load["carrier"]["id"])) for load in loads if load["carrier"]}
+  if boat_keys:
+    client.put_multi(client.get_multi(list(boat_keys)))
+  client.delete_multi([load.key for load in loads])
+  return [load.key for load in loads]
@@ -0,0 +1,101 @@
+# measures the cold start of an instance: the time to import the app, and to answer its first request,
+# with and without a warmup request first, each in a fresh interpreter, plus the modules slowest to import
+# usage: python benchmarks/bench_coldstart.py [--runs 10] [--output results.json]
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import harness
+
+# run in each fresh interpreter: prints the milliseconds to import main, to warm it up, and to answer a request
+# the verifier trusts a static key set, as in the load test, so warming up doesn't reach Google for its keys
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+import auth
+main.verifier = auth.TokenVerifier(main.config()["client_id"], keys=auth.StaticKeySet({}))
+client = main.app.test_client()
+if sys.argv[1] == "warm":
+  client.get("/_ah/warmup")
+warmed = time.perf_counter()
+client.get("/boats", headers={"Accept": "text/html"})
+answered = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "warmup_ms": (warmed - imported) * 1000,
+  "first_request_ms": (answered - warmed) * 1000}))
+"""
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+def environment(backend):
+  env = dict(os.environ, CREDENTIALS_FILE=harness.write_credentials(), STORAGE_BACKEND=backend)
+  if backend == "sqlite":
+    env["STORAGE_PATH"] = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+  return env
+
+def probe(env, mode):
+  output = subprocess.check_output([sys.executable, "-c", PROBE, mode], cwd=harness.ROOT, env=env)
+  return json.loads(output.decode().strip().splitlines()[-1])
+
+# top-level packages by cumulative import time of main, in milliseconds
+def import_times(env, top):
+  output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=harness.ROOT, env=env,
+    stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True).stderr.decode()
+  packages = {}
+  for line in output.splitlines():
+    match = IMPORTTIME_RE.match(line)
+    # main is indented by one space, and each level of imports under it by two more
+    if match and len(match.group(3)) == 3:
+      name = match.group(4).split(".")[0]
+      packages[name] = packages.get(name, 0) + int(match.group(2)) / 1000
+  return dict(sorted(packages.items(), key=lambda item: -item[1])[:top])
+
+def median(values):
+  return sorted(values)[len(values) // 2]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--runs", type=int, default=10)
+  parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"])
+  parser.add_argument("--top", type=int, default=10)
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  env = environment(args.backend)
+  cold = [probe(env, "cold") for _ in range(args.runs)]
+  warm = [probe(env, "warm") for _ in range(args.runs)]
+
+  commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=harness.ROOT, stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL).stdout.decode().strip() or None
+  results = {
+    "commit": commit,
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "backend": args.backend,
+    "runs": args.runs,
+    "import_ms": median([run["import_ms"] for run in cold]),
+    "first_request_ms": median([run["first_request_ms"] for run in cold]),
+    "warmup_ms": median([run["warmup_ms"] for run in warm]),
+    "first_request_after_warmup_ms": median([run["first_request_ms"] for run in warm]),
+    "slowest_imports_ms": import_times(env, args.top)
+  }
+
+  print("median of %d fresh interpreters on the %s backend" % (args.runs, args.backend))
+  print("import main:                  %8.1f ms" % results["import_ms"])
+  print("first request:                %8.1f ms" % results["first_request_ms"])
+  print("warmup request:               %8.1f ms" % results["warmup_ms"])
+  print("first request after warmup:   %8.1f ms" % results["first_request_after_warmup_ms"])
+  print("slowest imports of main:")
+  for name, milliseconds in results["slowest_imports_ms"].items():
+    print("  %-28s %8.1f ms" % (name, milliseconds))
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "coldstart-" + (commit or "unknown") + ".json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
@@ -0,0 +1,54 @@
+# compares the latency of a GET /loads page when its total comes from a full scan and from the sharded counters
+# usage: python benchmarks/bench_counters.py [--sizes 1000,10000,100000,1000000]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.cloud import datastore
+import constants
+import counters
+import storage
+
+def populate(client, existing, size):
+  loads = []
+  for load_id in range(existing + 1, size + 1):
+    load = datastore.Entity(key=client.key(constants.loads, load_id))
+    load.update({"volume": load_id, "content": "bench", "creation_date": "1/1/2021", "carrier": None})
+    loads.append(load)
+  for start in range(0, len(loads), constants.max_mutations):
+    client.put_multi(loads[start:start + constants.max_mutations])
+  counters.reconcile(client)
+
+# time one page of five loads plus its total, best of three runs
+def page_latency(client, count):
+  best = None
+  for _ in range(3):
+    start = time.perf_counter()
+    count(client)
+    page = list(client.query(kind=constants.loads).fetch(limit=5))
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  assert len(page) == 5
+  return best
+
+def scan_total(client):
+  return len(list(client.query(kind=constants.loads).fetch()))
+
+def counter_total(client):
+  return counters.total(client, constants.loads)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+  args = parser.parse_args()
+
+  client = storage.MemoryClient()
+  print("%10s %14s %14s" % ("loads", "scan (ms)", "counter (ms)"))
+  existing = 0
+  for size in [int(size) for size in args.sizes.split(",")]:
+    populate(client, existing, size)
+    existing = size
+    print("%10d %14.3f %14.3f" % (size, page_latency(client, scan_total) * 1000, page_latency(client, counter_total) * 1000))
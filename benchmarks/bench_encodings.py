@@ -0,0 +1,91 @@
+# compares the bytes on the wire and the CPU spent serializing and compressing a page of GET /loads,
+# for each representation, content coding and fieldset the app can answer with
+# serialization and compression times are the app's own phase timings, read from its Server-Timing header
+# usage: python benchmarks/bench_encodings.py [--page 100] [--runs 50] [--output results.json]
+import argparse
+import json
+import os
+import re
+import time
+
+import harness
+
+SERVER_TIMING_RE = re.compile(r"([\w-]+);dur=([\d.]+)")
+
+# the Accept and Accept-Encoding headers of each variant
+REPRESENTATIONS = [("json", "application/json"), ("msgpack", "application/msgpack")]
+ENCODINGS = [("identity", "identity"), ("gzip", "gzip"), ("br", "br")]
+
+# fieldsets compared, as the fields query parameter, or None for every field
+FIELDSETS = [None, "id,content", "id"]
+
+def populate(client, size):
+  for index in range(size):
+    response = client.post("/loads", headers={"Accept": "application/json"},
+      json={"volume": index, "content": "load of cargo number %d" % index, "creation_date": "%d/%d/2021" % (index % 12 + 1, index % 28 + 1)})
+    assert response.status_code == 201
+
+def measure(main, client, page, fields, accept, encoding, runs):
+  url = "/loads?limit=%d" % page + ("&fields=" + fields if fields else "")
+  headers = {"Accept": accept, "Accept-Encoding": encoding}
+  serialize = []
+  compress = []
+  rpcs = []
+  for _ in range(runs):
+    main.client.reset()
+    response = client.get(url, headers=headers)
+    rpcs.append(sum(main.client.reset()["rpcs"].values()))
+    timings = dict(SERVER_TIMING_RE.findall(response.headers.get("Server-Timing", "")))
+    serialize.append(float(timings.get("serialize", 0)))
+    compress.append(float(timings.get("compress", 0)))
+  return {
+    "status": response.status_code,
+    "content_encoding": response.headers.get("Content-Encoding", "identity"),
+    "bytes": len(response.data),
+    "serialize_ms": sum(serialize) / runs,
+    "compress_ms": sum(compress) / runs,
+    "rpcs": sum(rpcs) / runs
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--page", type=int, default=100)
+  parser.add_argument("--runs", type=int, default=50)
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  os.environ["SERVER_TIMING"] = "1"
+  main = harness.load_app(harness.LocalSigner())
+  import negotiation
+  client = main.app.test_client()
+  populate(client, args.page)
+
+  variants = {}
+  for fields in FIELDSETS:
+    for representation, accept in REPRESENTATIONS:
+      for encoding, accept_encoding in ENCODINGS:
+        name = "%s %s fields=%s" % (representation, encoding, fields or "all")
+        result = measure(main, client, args.page, fields, accept, accept_encoding, args.runs)
+        # leave out variants this installation can't serve, e.g. without msgpack or brotli, and bodies too small to compress
+        if result["status"] != 200 or result["content_encoding"] != encoding:
+          continue
+        variants[name] = result
+
+  results = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "page": args.page,
+    "runs": args.runs,
+    "msgpack": negotiation.msgpack is not None,
+    "brotli": negotiation.brotli is not None,
+    "variants": variants
+  }
+
+  print("%-36s %9s %13s %12s %6s" % ("variant", "bytes", "serialize ms", "compress ms", "rpcs"))
+  for name, result in variants.items():
+    print("%-36s %9d %13.3f %12.3f %6.1f" % (name, result["bytes"], result["serialize_ms"], result["compress_ms"], result["rpcs"]))
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "encodings.json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
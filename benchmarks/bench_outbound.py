@@ -0,0 +1,165 @@
+# compares outbound calls made with a fresh connection each, as the token exchange and certificate fetches used to,
+# with calls over the app's pooled keep-alive session, against a local HTTPS server standing in for Google
+# the server can wait on each new connection, standing in for the round trips a TCP and TLS handshake costs
+# usage: python benchmarks/bench_outbound.py [--calls 500] [--concurrency 8] [--connect-delay 20]
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+
+import harness
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+import requests
+
+import outbound
+
+CERTS = json.dumps({harness.KEY_ID: "-----BEGIN CERTIFICATE-----\n...\n-----END CERTIFICATE-----\n"}).encode("utf-8")
+TOKEN = json.dumps({"id_token": "header.payload.signature", "expires_in": 3599}).encode("utf-8")
+
+# self-signed certificate for 127.0.0.1, written to files the server and the clients load
+def certificate(directory):
+  key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+  now = datetime.datetime.utcnow()
+  cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+    .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+    .not_valid_after(now + datetime.timedelta(days=1))
+    .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+    .sign(key, hashes.SHA256()))
+  cert_path = os.path.join(directory, "cert.pem")
+  key_path = os.path.join(directory, "key.pem")
+  with open(cert_path, "wb") as cert_file:
+    cert_file.write(cert.public_bytes(serialization.Encoding.PEM))
+  with open(key_path, "wb") as key_file:
+    key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+      serialization.NoEncryption()))
+  return cert_path, key_path
+
+# serves the certificates on GET and a token on POST, over keep-alive connections, counting the connections opened
+class StandIn(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, cert_path, key_path, connect_delay):
+    super().__init__(("127.0.0.1", 0), Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+    self.connect_delay = connect_delay
+    self.connections = 0
+    self.lock = threading.Lock()
+
+  def process_request_thread(self, request, client_address):
+    with self.lock:
+      self.connections += 1
+    time.sleep(self.connect_delay)
+    request.do_handshake()
+    super().process_request_thread(request, client_address)
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  # headers and body go out in separate writes, which Nagle's algorithm would hold for the client's delayed ack
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    self.reply(CERTS, {"Cache-Control": "public, max-age=20000"})
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    self.reply(TOKEN, {})
+
+  def reply(self, body, headers):
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+transport = outbound.google_transport()
+
+# one certificate fetch or token exchange, alternately, through a fresh connection or the pooled session,
+# fetching certificates through the google-auth transport as the certificate cache does
+def call(url, cert_path, pooled, index):
+  data = {"code": "code-%d" % index, "grant_type": "authorization_code"}
+  if pooled:
+    if index % 2:
+      return outbound.session().post(url + "/token", data=data, verify=cert_path).status_code
+    return transport(url=url + "/certs", method="GET", verify=cert_path).status
+  if index % 2:
+    return requests.post(url + "/token", data=data, verify=cert_path).status_code
+  return requests.get(url + "/certs", verify=cert_path).status_code
+
+def run(server, url, cert_path, pooled, calls, concurrency):
+  server.connections = 0
+  latencies = []
+  def timed(index):
+    start = time.perf_counter()
+    status = call(url, cert_path, pooled, index)
+    latencies.append(time.perf_counter() - start)
+    return status
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    statuses = list(executor.map(timed, range(calls)))
+  wall = time.perf_counter() - start
+  latencies.sort()
+  return {
+    "calls": calls,
+    "failed": sum(1 for status in statuses if status != 200),
+    "connections": server.connections,
+    "throughput_cps": calls / wall,
+    "p50_ms": harness.percentile(latencies, 0.50) * 1000,
+    "p95_ms": harness.percentile(latencies, 0.95) * 1000,
+    "p99_ms": harness.percentile(latencies, 0.99) * 1000
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--calls", type=int, default=500)
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--connect-delay", type=float, default=20, help="milliseconds each new connection waits")
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  cert_path, key_path = certificate(tempfile.mkdtemp())
+  server = StandIn(cert_path, key_path, args.connect_delay / 1000)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = "https://127.0.0.1:%d" % server.server_address[1]
+
+  results = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "calls": args.calls,
+    "concurrency": args.concurrency,
+    "connect_delay_ms": args.connect_delay,
+    "fresh": run(server, url, cert_path, False, args.calls, args.concurrency),
+    "pooled": run(server, url, cert_path, True, args.calls, args.concurrency)
+  }
+  server.shutdown()
+
+  print("%-8s %8s %12s %10s %9s %9s %9s" % ("mode", "calls", "connections", "calls/s", "p50 ms", "p95 ms", "p99 ms"))
+  for mode in ("fresh", "pooled"):
+    summary = results[mode]
+    print("%-8s %8d %12d %10.1f %9.2f %9.2f %9.2f" % (mode, summary["calls"], summary["connections"],
+      summary["throughput_cps"], summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]))
+    if summary["failed"]:
+      print("warning: %d %s calls failed" % (summary["failed"], mode))
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "outbound.json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
@@ -0,0 +1,108 @@
+# compares packing loads into boats with POST /plans to the flow it replaces, where a dispatcher pages through
+# GET /boats and GET /loads and assigns each load with its own PUT /boats/<id>/loads/<id>, filling boats in turn
+# the naive flow is timed on a sample of the loads, as a request per load takes too long for the whole set,
+# and its time for every load is extrapolated from it
+# usage: python benchmarks/bench_plans.py [--loads 100000] [--boats 200] [--naive-loads 2000] [--output results.json]
+import argparse
+import json
+import os
+import random
+import time
+
+import harness
+
+PAGE = 1000
+
+def populate(client, headers, loads, boats, seed):
+  rng = random.Random(seed)
+  boat_items = [{"name": "boat %d" % index, "type": "barge", "length": rng.randint(10000, 40000)} for index in range(boats)]
+  boat_ids = [result["id"] for result in client.post("/boats:batchCreate", headers=headers, json={"boats": boat_items}).get_json()["boats"]]
+  load_ids = []
+  for start in range(0, loads, 10000):
+    items = [{"volume": rng.randint(1, 100), "content": "cargo", "creation_date": "1/1/2021"} for _ in range(min(10000, loads - start))]
+    load_ids += [result["id"] for result in client.post("/loads:batchCreate", headers=headers, json={"loads": items}).get_json()["loads"]]
+  return boat_ids, load_ids
+
+def pages(client, url, headers, name):
+  items = []
+  while url:
+    body = client.get(url, headers=headers).get_json()
+    items += body[name]
+    url = body.get("next", "").replace("http://localhost", "")
+  return items
+
+# the dispatcher's flow: read every boat and unassigned load, then put each load on the first boat with room
+def naive(client, headers, count):
+  boats = pages(client, "/boats?limit=%d&fields=id,length" % PAGE, headers, "boats")
+  loads = pages(client, "/loads?limit=%d&unassigned=true&fields=id,volume" % PAGE, headers, "loads")[:count]
+  room = {boat["id"]: boat["length"] for boat in boats}
+  requests = 2 + (len(boats) + len(loads)) // PAGE
+  placed = 0
+  for load in loads:
+    for boat_id, boat_room in room.items():
+      if boat_room >= load["volume"]:
+        requests += 1
+        if client.put("/boats/%d/loads/%d" % (boat_id, load["id"]), headers=headers).status_code == 204:
+          room[boat_id] -= load["volume"]
+          placed += 1
+        break
+  return {"loads": len(loads), "placed": placed, "requests": requests}
+
+def timed(main, run):
+  main.client.reset()
+  start = time.perf_counter()
+  result = run()
+  result["seconds"] = time.perf_counter() - start
+  result["rpcs"] = sum(main.client.reset()["rpcs"].values())
+  return result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--loads", type=int, default=100000)
+  parser.add_argument("--boats", type=int, default=200)
+  parser.add_argument("--naive-loads", type=int, default=2000)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  signer = harness.LocalSigner()
+  main = harness.load_app(signer)
+  client = main.app.test_client()
+
+  # the naive flow runs first, and places every load of its sample, so the plan then starts from
+  # unassigned loads only its own, and boats of another dispatcher, sized alike but empty
+  headers = {"Accept": "application/json", "Authorization": "Bearer " + signer.token("naive dispatcher")}
+  populate(client, headers, args.naive_loads, args.boats, args.seed)
+  sample = timed(main, lambda: naive(client, headers, args.naive_loads))
+
+  headers = {"Accept": "application/json", "Authorization": "Bearer " + signer.token("planning dispatcher")}
+  populate(client, headers, args.loads, args.boats, args.seed)
+  dry_run = timed(main, lambda: client.post("/plans", headers=headers, json={"apply": False}).get_json())
+  applied = timed(main, lambda: client.post("/plans", headers=headers, json={}).get_json())
+
+  per_load = sample["seconds"] / max(1, sample["loads"])
+  results = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "loads": args.loads,
+    "boats": args.boats,
+    "naive_sample": sample,
+    "naive_extrapolated_seconds": per_load * args.loads,
+    "plan_seconds": dry_run["seconds"],
+    "plan_rpcs": dry_run["rpcs"],
+    "plan_and_apply_seconds": applied["seconds"],
+    "plan_and_apply_rpcs": applied["rpcs"],
+    "planned": applied["planned"],
+    "unplaced": len(applied["unplaced"])
+  }
+
+  print("naive flow:       %d loads in %.2f s over %d requests, %d storage rpcs; %.1f s extrapolated to %d loads" % (
+    sample["loads"], sample["seconds"], sample["requests"], sample["rpcs"], results["naive_extrapolated_seconds"], args.loads))
+  print("POST /plans:      %d loads planned in %.2f s, %d storage rpcs, without applying" % (dry_run["planned"], dry_run["seconds"], dry_run["rpcs"]))
+  print("POST /plans:      %d loads planned and assigned in %.2f s, %d storage rpcs; %d left out" % (
+    applied["planned"], applied["seconds"], applied["rpcs"], len(applied["unplaced"])))
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "plans.json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
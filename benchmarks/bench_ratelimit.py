@@ -0,0 +1,80 @@
+# measures what admission control costs on the hot path: the time of one token bucket admission for each backend,
+# alone and under contention, and the latency of a cheap request with the limiter and concurrency cap on and off
+# usage: python benchmarks/bench_ratelimit.py [--admissions 200000] [--threads 8] [--requests 5000] [--output results.json]
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import time
+
+import harness
+
+import ratelimit
+
+# microseconds per admission, over count admissions spread over keys clients and made from threads threads
+def admissions(backend, count, keys, threads):
+  limiter = ratelimit.Limiter(backend, rate=1000000, burst=1000000)
+  names = ["user:%d" % key for key in range(keys)]
+  def run(offset):
+    for index in range(offset, count, threads):
+      limiter.admit(names[index % keys])
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    list(executor.map(run, range(threads)))
+  return (time.perf_counter() - start) / count * 1000000
+
+# latency percentiles of GET /loads/<id> through the app, in milliseconds
+def request_latencies(main, requests, load_id):
+  client = main.app.test_client()
+  headers = {"Accept": "application/json"}
+  latencies = []
+  for _ in range(requests):
+    start = time.perf_counter()
+    client.get("/loads/%d" % load_id, headers=headers)
+    latencies.append(time.perf_counter() - start)
+  latencies.sort()
+  return {name: harness.percentile(latencies, fraction) * 1000 for name, fraction in (("p50_ms", 0.50), ("p99_ms", 0.99))}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--admissions", type=int, default=200000)
+  parser.add_argument("--threads", type=int, default=8)
+  parser.add_argument("--requests", type=int, default=5000)
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  backends = {"local": ratelimit.LocalBackend, "shared (dict store)": lambda: ratelimit.SharedBackend(ratelimit.DictStore())}
+  micro = {}
+  for name, backend in backends.items():
+    for keys, threads in ((1, 1), (10000, 1), (1, args.threads), (10000, args.threads)):
+      micro["%s, %d keys, %d threads" % (name, keys, threads)] = admissions(backend(), args.admissions, keys, threads)
+
+  main = harness.load_app(harness.LocalSigner())
+  load_id = main.app.test_client().post("/loads", headers={"Accept": "application/json"},
+    json={"volume": 1, "content": "bench", "creation_date": "1/1/2021"}).get_json()["id"]
+  limiter, in_flight = main.limiter, main.in_flight
+  request_latencies(main, args.requests, load_id)
+  main.limiter, main.in_flight = None, None
+  off = request_latencies(main, args.requests, load_id)
+  main.limiter, main.in_flight = limiter, in_flight
+  on = request_latencies(main, args.requests, load_id)
+
+  results = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "admission_us": micro,
+    "requests": args.requests,
+    "request_off": off,
+    "request_on": on
+  }
+
+  print("%-44s %14s" % ("admission", "us/admission"))
+  for name, microseconds in micro.items():
+    print("%-44s %14.2f" % (name, microseconds))
+  print("GET /loads/<id> without admission control: p50 %.3f ms, p99 %.3f ms" % (off["p50_ms"], off["p99_ms"]))
+  print("GET /loads/<id> with admission control:    p50 %.3f ms, p99 %.3f ms" % (on["p50_ms"], on["p99_ms"]))
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "ratelimit.json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
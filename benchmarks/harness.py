@@ -0,0 +1,70 @@
+# shared setup for the benchmarks and tests: the app on a local storage engine, with JWTs signed by a local key
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+
+# audience of the local tokens, standing in for the OAuth client id
+CLIENT_ID = "benchmark-client-id"
+
+KEY_ID = "benchmark-key"
+
+# signs Google-style ID tokens with a key generated for this process
+class LocalSigner:
+  def __init__(self):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+      serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    self.public_pem = private_key.public_key().public_bytes(
+      serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode("utf-8")
+    self.signer = crypt.RSASigner.from_string(private_pem, key_id=KEY_ID)
+
+  # the key set a verifier needs to accept this signer's tokens
+  def certs(self):
+    return {KEY_ID: self.public_pem}
+
+  def token(self, sub, lifetime=3600, issuer="https://accounts.google.com"):
+    now = int(time.time())
+    payload = {"iss": issuer, "aud": CLIENT_ID, "sub": sub, "iat": now, "exp": now + lifetime}
+    return jwt.encode(self.signer, payload).decode("utf-8")
+
+# write OAuth settings for the local client id to a temporary file, and return its path for CREDENTIALS_FILE
+def write_credentials():
+  credentials = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+  credentials.write(
+    "auth_uri: https://accounts.google.com/o/oauth2/v2/auth\n"
+    "client_id: " + CLIENT_ID + "\n"
+    "client_secret: benchmark-secret\n"
+    "redirect_uri: http://localhost/oauth\n")
+  credentials.close()
+  return credentials.name
+
+# import the app with a local storage engine and a verifier trusting the signer
+# returns the main module, whose client counts storage round trips
+def load_app(signer, backend="memory"):
+  os.environ["CREDENTIALS_FILE"] = write_credentials()
+  os.environ["STORAGE_BACKEND"] = backend
+  # every flow's loads requests come from the same address, so the rate limit is lifted unless a benchmark sets one
+  os.environ.setdefault("RATE_LIMIT_RATE", "1000000")
+  os.environ.setdefault("RATE_LIMIT_BURST", "1000000")
+  if backend == "sqlite":
+    os.environ.setdefault("STORAGE_PATH", os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3"))
+
+  import auth
+  import main
+  main.verifier = auth.TokenVerifier(CLIENT_ID, keys=auth.StaticKeySet(signer.certs()))
+  return main
+
+# nearest-rank percentile of a sorted list
+def percentile(values, fraction):
+  if not values:
+    return None
+  index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+  return values[index]
@@ -0,0 +1,179 @@
+# replays the request flows of the Postman collection against the app, many flows at a time,
+# and reports throughput, latency percentiles and storage round trips per route
+# each flow runs the whole collection as two fresh users, on a local storage engine with locally signed JWTs
+# usage: python benchmarks/loadtest.py [--flows 200] [--concurrency 8] [--backend memory] [--output results.json]
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import time
+
+import harness
+
+COLLECTION = os.path.join(harness.ROOT, "shinal_project.postman_collection.json")
+
+# route templates the results are grouped by
+ROUTES = [
+  (re.compile(r"^/boats/[^/]+/loads/[^/]+$"), "/boats/<id>/loads/<id>"),
+  (re.compile(r"^/boats/[^/]+/loads$"), "/boats/<id>/loads"),
+  (re.compile(r"^/boats/[^/]+$"), "/boats/<id>"),
+  (re.compile(r"^/loads/[^/]+$"), "/loads/<id>"),
+]
+
+VARIABLE_RE = re.compile(r"{{(\w+)}}")
+SETS_RE = re.compile(r"pm\.environment\.set\(\"(\w+)\", pm\.response\.json\(\)\[\"id\"\]\)")
+EXPECTED_RE = re.compile(r"^(\d{3}) ")
+
+def route_of(path):
+  path = path.split("?")[0]
+  for pattern, route in ROUTES:
+    if pattern.match(path):
+      return route
+  return path
+
+# the requests of the collection, in order, with the status each expects and the variables each sets
+def load_steps(path=COLLECTION):
+  steps = []
+  def walk(items):
+    for item in items:
+      if "item" in item:
+        walk(item["item"])
+        continue
+      request = item["request"]
+      url = request["url"]["raw"] if isinstance(request["url"], dict) else request["url"]
+      scripts = "\n".join("\n".join(event["script"]["exec"]) for event in item.get("event", []) if event["listen"] == "test")
+      expected = EXPECTED_RE.match(item["name"])
+      token = None
+      if request.get("auth", {}).get("type") == "bearer":
+        token = next((entry["value"] for entry in request["auth"]["bearer"] if entry["key"] == "token"), "")
+      steps.append({
+        "name": item["name"],
+        "method": request["method"],
+        "url": url,
+        "headers": {header["key"]: header["value"] for header in request.get("header", []) if not header.get("disabled")},
+        "body": (request.get("body") or {}).get("raw"),
+        "token": token,
+        "expected": int(expected.group(1)) if expected else None,
+        "sets": SETS_RE.findall(scripts)
+      })
+  walk(json.load(open(path))["item"])
+  return steps
+
+def substitute(text, variables):
+  return VARIABLE_RE.sub(lambda match: str(variables.get(match.group(1), "")), text)
+
+# run every step of the collection once, returning one record per request
+def run_flow(main, steps, tokens):
+  client = main.app.test_client()
+  variables = {"app_url": "", "jwt1": tokens[0], "jwt2": tokens[1]}
+  records = []
+  for step in steps:
+    path = substitute(step["url"], variables)
+    headers = {key: substitute(value, variables) for key, value in step["headers"].items()}
+    token = substitute(step["token"], variables) if step["token"] is not None else ""
+    if token:
+      headers["Authorization"] = "Bearer " + token
+    body = substitute(step["body"], variables) if step["body"] else None
+
+    main.client.reset()
+    start = time.perf_counter()
+    response = client.open(path, method=step["method"], headers=headers, data=body,
+      content_type="application/json" if body else None)
+    elapsed = time.perf_counter() - start
+    counts = main.client.reset()
+
+    for variable in step["sets"]:
+      payload = response.get_json(silent=True) or {}
+      if "id" in payload:
+        variables[variable] = payload["id"]
+    records.append({
+      "route": route_of(path),
+      "method": step["method"],
+      "status": response.status_code,
+      "expected": step["expected"],
+      "seconds": elapsed,
+      "rpcs": sum(counts["rpcs"].values()),
+      "entities_read": counts["entities_read"],
+      "entities_written": counts["entities_written"]
+    })
+  return records
+
+def summarize(records):
+  latencies = sorted(record["seconds"] for record in records)
+  count = len(records)
+  return {
+    "requests": count,
+    "p50_ms": harness.percentile(latencies, 0.50) * 1000,
+    "p95_ms": harness.percentile(latencies, 0.95) * 1000,
+    "p99_ms": harness.percentile(latencies, 0.99) * 1000,
+    "rpcs_per_request": sum(record["rpcs"] for record in records) / count,
+    "entities_read_per_request": sum(record["entities_read"] for record in records) / count,
+    "entities_written_per_request": sum(record["entities_written"] for record in records) / count,
+    "unexpected_status": sum(1 for record in records if record["expected"] and record["status"] != record["expected"])
+  }
+
+def git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=harness.ROOT, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--flows", type=int, default=200)
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"])
+  parser.add_argument("--output")
+  args = parser.parse_args()
+
+  signer = harness.LocalSigner()
+  main = harness.load_app(signer, args.backend)
+  steps = load_steps()
+  tokens = [(signer.token("flow-%d-a" % flow), signer.token("flow-%d-b" % flow)) for flow in range(args.flows)]
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    flows = list(executor.map(lambda flow_tokens: run_flow(main, steps, flow_tokens), tokens))
+  wall = time.perf_counter() - start
+  records = [record for flow in flows for record in flow]
+
+  routes = {}
+  for record in records:
+    routes.setdefault(record["method"] + " " + record["route"], []).append(record)
+
+  # requests turned away by the JWT and Accept checks, which should never reach storage
+  rejected = [record for record in records if record["status"] in (401, 406)]
+
+  commit = git_commit()
+  results = {
+    "commit": commit,
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "python": platform.python_version(),
+    "backend": args.backend,
+    "flows": args.flows,
+    "concurrency": args.concurrency,
+    "wall_seconds": wall,
+    "throughput_rps": len(records) / wall,
+    "overall": summarize(records),
+    "rejected": summarize(rejected) if rejected else None,
+    "routes": {route: summarize(route_records) for route, route_records in sorted(routes.items())}
+  }
+
+  print("%-32s %8s %9s %9s %9s %7s %7s" % ("route", "requests", "p50 ms", "p95 ms", "p99 ms", "rpcs", "reads"))
+  for route, summary in sorted(results["routes"].items()) + [("overall", results["overall"])]:
+    print("%-32s %8d %9.2f %9.2f %9.2f %7.2f %7.2f" % (route, summary["requests"], summary["p50_ms"], summary["p95_ms"],
+      summary["p99_ms"], summary["rpcs_per_request"], summary["entities_read_per_request"]))
+  print("throughput: %.1f requests/s over %d requests" % (results["throughput_rps"], len(records)))
+  if rejected:
+    print("rejected with 401/406: %d requests, %.2f storage rpcs per request" % (len(rejected), results["rejected"]["rpcs_per_request"]))
+  if results["overall"]["unexpected_status"]:
+    print("warning: %d responses did not have the status the collection expects" % results["overall"]["unexpected_status"])
+
+  output = args.output or os.path.join(harness.ROOT, "benchmarks", "results", "loadtest-" + (commit or "unknown") + ".json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as results_file:
+    json.dump(results, results_file, indent=2)
+  print("results saved to " + output)
@@ -0,0 +1,294 @@
+from collections import OrderedDict
+from google.cloud import datastore
+import contextlib
+import copy
+import json
+import os
+import threading
+import time
+
+# read-through cache of entities by key, in front of any storage backend
+# lookups try an in-process LRU first, then an optional shared tier, then storage, and fill the tiers they missed
+# writes made outside a transaction update the cached copy; writes inside a transaction, and deletes,
+# drop it once they are committed, so the assign and cascade transactions never leave stale boats or loads behind
+# reads inside a transaction or a bypass() block go to storage, so a stale copy is never written back
+# a read racing a write can't cache what it read over what the write left: a copy never replaces one with a higher
+# version, and a read that started before a key was invalidated doesn't cache it
+
+# bounds of the in-process tier, overridable with the CACHE_MAX_ENTRIES and CACHE_TTL environment variables
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 30
+
+# seconds a key is remembered as invalidated, so that reads started before the invalidation don't cache their copy;
+# reads taking longer than this could still cache a stale copy, until it expires
+INVALIDATION_WINDOW = 5
+
+def cache_key(key):
+  return key.kind + ":" + str(key.id_or_name)
+
+# version of cached entity data, which every write of a boat or load bumps
+def version_of(data):
+  return data.get("version", 0)
+
+# in-process tier: least recently used entries are evicted beyond max_entries, and entries expire after ttl seconds
+class LocalTier:
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, clock=time.monotonic):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.clock = clock
+    self.entries = OrderedDict()
+    # times keys were invalidated, oldest first
+    self.invalidated = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get_many(self, names):
+    found = {}
+    now = self.clock()
+    with self.lock:
+      for name in names:
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > now:
+          self.entries.move_to_end(name)
+          found[name] = entry[1]
+          self.hits += 1
+        else:
+          if entry is not None:
+            del self.entries[name]
+          self.misses += 1
+    return found
+
+  # store items, except over entries with a higher version, and, for items read at read_at by this tier's clock,
+  # except for keys invalidated since
+  def set_many(self, items, read_at=None):
+    now = self.clock()
+    with self.lock:
+      for name, data in items.items():
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > now and version_of(entry[1]) > version_of(data):
+          continue
+        if read_at is not None and self.invalidated.get(name, read_at - 1) >= read_at:
+          continue
+        self.entries[name] = (now + self.ttl, data)
+        self.entries.move_to_end(name)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def delete_many(self, names):
+    now = self.clock()
+    with self.lock:
+      for name in names:
+        self.entries.pop(name, None)
+        self.invalidated[name] = now
+        self.invalidated.move_to_end(name)
+      while self.invalidated and next(iter(self.invalidated.values())) < now - INVALIDATION_WINDOW:
+        self.invalidated.popitem(last=False)
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries)}
+
+# interface of the optional shared tier, e.g. memcache or redis shared by every instance
+# values are json strings, so any byte store can hold them; invalidated keys hold "null" for INVALIDATION_WINDOW
+# seconds, as instances don't share a clock to tell which reads started before an invalidation, and no read caches over it
+class SharedTier:
+  def get_many(self, names):
+    raise NotImplementedError
+
+  def set_many(self, items, ttl):
+    raise NotImplementedError
+
+  def delete_many(self, names):
+    raise NotImplementedError
+
+# shared tier held in a dict, for local runs and tests
+class DictSharedTier(SharedTier):
+  def __init__(self, clock=time.monotonic):
+    self.clock = clock
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def get_many(self, names):
+    now = self.clock()
+    with self.lock:
+      return {name: self.values[name][1] for name in names if name in self.values and self.values[name][0] > now}
+
+  def set_many(self, items, ttl):
+    expires_at = self.clock() + ttl
+    with self.lock:
+      for name, value in items.items():
+        self.values[name] = (expires_at, value)
+
+  def delete_many(self, names):
+    with self.lock:
+      for name in names:
+        self.values.pop(name, None)
+
+# wraps a storage client, caching the entities of the given kinds by key
+class CachingClient:
+  def __init__(self, inner, kinds, local=None, shared=None):
+    self.inner = inner
+    self.kinds = set(kinds)
+    self.local = local if local is not None else LocalTier()
+    self.shared = shared
+    self.shared_hits = 0
+    self.shared_misses = 0
+    self.thread = threading.local()
+
+  def __getattr__(self, name):
+    return getattr(self.inner, name)
+
+  def cacheable(self, key):
+    return key.kind in self.kinds and not key.is_partial
+
+  # keys written by each open transaction of the current thread, innermost last
+  def pending(self):
+    if not hasattr(self.thread, "pending"):
+      self.thread.pending = []
+    return self.thread.pending
+
+  # read from storage within the block, e.g. to read entities that are about to be modified and written back
+  # entities read are still cached, and writes still update the cache
+  @contextlib.contextmanager
+  def bypass(self):
+    self.thread.bypass = getattr(self.thread, "bypass", 0) + 1
+    try:
+      yield
+    finally:
+      self.thread.bypass -= 1
+
+  def get(self, key, *args, **kwargs):
+    found = self.get_multi([key], *args, **kwargs)
+    return found[0] if found else None
+
+  def get_multi(self, keys, *args, **kwargs):
+    # reads inside a transaction go to storage, so the transaction sees and guards the stored entities
+    if self.pending():
+      return self.inner.get_multi(keys, *args, **kwargs)
+    if getattr(self.thread, "bypass", 0):
+      read_at = self.local.clock()
+      found = self.inner.get_multi(keys, *args, **kwargs)
+      self.fill(found, read_at)
+      return found
+
+    names = {key: cache_key(key) for key in keys if self.cacheable(key)}
+    cached = self.local.get_many(list(names.values()))
+
+    missed = [name for name in names.values() if name not in cached]
+    read_at = self.local.clock()
+    if self.shared is not None and missed:
+      shared = {name: json.loads(value) for name, value in self.shared.get_many(missed).items()}
+      shared = {name: data for name, data in shared.items() if data is not None}
+      self.shared_hits += len(shared)
+      self.shared_misses += len(missed) - len(shared)
+      if shared:
+        self.local.set_many(shared, read_at)
+      cached.update(shared)
+
+    found = []
+    uncached = []
+    for key in keys:
+      data = cached.get(names.get(key))
+      if data is None:
+        uncached.append(key)
+      else:
+        found.append(self.entity(key, data))
+
+    if uncached:
+      read = self.inner.get_multi(uncached, *args, **kwargs)
+      self.fill(read, read_at)
+      found.extend(read)
+    return found
+
+  def put(self, entity, *args, **kwargs):
+    self.put_multi([entity], *args, **kwargs)
+
+  def put_multi(self, entities, *args, **kwargs):
+    self.inner.put_multi(entities, *args, **kwargs)
+    if self.pending():
+      self.pending()[-1].extend(entity.key for entity in entities)
+    else:
+      self.fill(entities)
+
+  def delete(self, key, *args, **kwargs):
+    self.delete_multi([key], *args, **kwargs)
+
+  def delete_multi(self, keys, *args, **kwargs):
+    self.inner.delete_multi(keys, *args, **kwargs)
+    keys = [getattr(key, "key", key) for key in keys]
+    if self.pending():
+      self.pending()[-1].extend(keys)
+    else:
+      self.invalidate(keys)
+
+  def transaction(self, *args, **kwargs):
+    return CachingTransaction(self, self.inner.transaction(*args, **kwargs))
+
+  # store copies of entities just written, or read from storage at read_at by the local tier's clock
+  # the shared tier is checked before it is written, which narrows the race with other instances but can't close it
+  def fill(self, entities, read_at=None):
+    items = {cache_key(entity.key): copy.deepcopy(dict(entity)) for entity in entities if self.cacheable(entity.key)}
+    if items:
+      self.local.set_many(items, read_at)
+      if self.shared is not None:
+        for name, value in self.shared.get_many(list(items)).items():
+          data = json.loads(value)
+          if (data is None and read_at is not None) or (data is not None and version_of(data) > version_of(items[name])):
+            del items[name]
+        self.shared.set_many({name: json.dumps(data) for name, data in items.items()}, self.local.ttl)
+
+  # drop cached copies of keys, e.g. once a transaction writing them has committed,
+  # and keep reads that started before now from caching them again
+  def invalidate(self, keys):
+    names = [cache_key(key) for key in keys if self.cacheable(key)]
+    if names:
+      self.local.delete_many(names)
+      if self.shared is not None:
+        self.shared.set_many({name: json.dumps(None) for name in names}, INVALIDATION_WINDOW)
+
+  # cached copy of an entity, if any, without copying it or reading storage; callers must not modify it
+  def peek(self, key):
+    if not self.cacheable(key):
+      return None
+    return self.local.get_many([cache_key(key)]).get(cache_key(key))
+
+  def entity(self, key, data):
+    entity = datastore.Entity(key=key)
+    entity.update(copy.deepcopy(data))
+    return entity
+
+  def stats(self):
+    stats = {"local_" + name: value for name, value in self.local.stats().items()}
+    lookups = stats["local_hits"] + stats["local_misses"]
+    stats["local_hit_rate"] = stats["local_hits"] / lookups if lookups else 0.0
+    if self.shared is not None:
+      stats["shared_hits"] = self.shared_hits
+      stats["shared_misses"] = self.shared_misses
+    return stats
+
+# tracks the keys written in a transaction, and drops them from the cache once it commits
+class CachingTransaction:
+  def __init__(self, client, inner):
+    self.client = client
+    self.inner = inner
+
+  def __enter__(self):
+    entered = self.inner.__enter__()
+    self.client.pending().append([])
+    return entered
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    written = self.client.pending().pop()
+    try:
+      return self.inner.__exit__(exc_type, exc_value, traceback)
+    finally:
+      self.client.invalidate(written)
+
+# the cache configured from the environment: CACHE_MAX_ENTRIES and CACHE_TTL size the in-process tier,
+# and CACHE_SHARED_TIER=local adds a dict-backed shared tier for local runs
+def caching_client(inner, kinds):
+  local = LocalTier(int(os.environ.get("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)), float(os.environ.get("CACHE_TTL", DEFAULT_TTL)))
+  shared = DictSharedTier() if os.environ.get("CACHE_SHARED_TIER") == "local" else None
+  return CachingClient(inner, kinds, local, shared)
@@ -0,0 +1,100 @@
+import base64
+import binascii
+import constants
+import json
+import time
+
+# change feed of a user's boats and of all loads: the entities created, modified or deleted since a token
+# entities and tombstones are paged through by their update sequence, from four queries merged in sequence order:
+# the user's boats, all loads, the tombstones of the user's boats, and the tombstones of loads
+# a token holds the position reached in each query, as the sequence and key id of the last change returned from it
+
+# changes younger than this many seconds are left for the next page, so a write stamped just before a slower
+# concurrent write, on this or another instance, isn't skipped by a client that already read past it
+SETTLE_SECONDS = 5
+
+# tombstones older than this many days are purged, so tokens older than that are refused
+RETENTION_DAYS = 30
+
+# change types
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+
+# raised for a token older than the tombstones kept, whose client has to sync from scratch
+class Expired(Exception):
+  pass
+
+# the queries the feed merges, by name, for a user
+def sources(client, userid):
+  boats = client.query(kind=constants.boats)
+  boats.add_filter("owner", "=", userid)
+  loads = client.query(kind=constants.loads)
+  boat_tombstones = client.query(kind=constants.tombstones)
+  boat_tombstones.add_filter("owner", "=", userid)
+  load_tombstones = client.query(kind=constants.tombstones)
+  load_tombstones.add_filter("kind", "=", constants.loads)
+  return {"boats": boats, "loads": loads, "boat_tombstones": boat_tombstones, "load_tombstones": load_tombstones}
+
+def now():
+  return int(time.time() * 1000000)
+
+def encode_token(positions, issued):
+  return base64.urlsafe_b64encode(json.dumps({"positions": positions, "issued": issued}).encode("utf-8")).decode("utf-8")
+
+# positions and issue time of a token, or of the start of the feed for None
+# raises ValueError for a malformed token, and Expired for one older than the tombstones
+def decode_token(token):
+  if token is None:
+    return {}, None
+  try:
+    decoded = json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))
+    positions = {name: (int(sequence), key_id) for name, (sequence, key_id) in decoded["positions"].items()}
+    issued = int(decoded["issued"])
+  except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+    raise ValueError("invalid change token")
+  if issued < now() - RETENTION_DAYS * 86400 * 1000000:
+    raise Expired()
+  return positions, issued
+
+# up to limit changes after the positions of a token, in sequence order
+# returns the changes as (source name, entity) pairs, the positions after them, whether more changes are ready,
+# and the sequence up to which changes were considered
+def page(client, userid, positions, limit):
+  horizon = now() - SETTLE_SECONDS * 1000000
+  fetched = []
+  more = False
+  for name, query in sources(client, userid).items():
+    sequence, key_id = positions.get(name, (0, None))
+    query.add_filter("updated", ">=", sequence)
+    query.add_filter("updated", "<", horizon)
+    query.order = ["updated"]
+    taken = 0
+    for entity in query.fetch():
+      # changes sharing the position's sequence were returned up to and including its key
+      if entity["updated"] == sequence and key_id is not None and entity.key.id_or_name <= key_id:
+        continue
+      if taken == limit:
+        more = True
+        break
+      fetched.append((entity["updated"], name, entity))
+      taken += 1
+
+  fetched.sort(key=lambda change: (change[0], change[1], change[2].key.id_or_name))
+  more = more or len(fetched) > limit
+  positions = dict(positions)
+  changes = []
+  for sequence, name, entity in fetched[:limit]:
+    positions[name] = (sequence, entity.key.id_or_name)
+    changes.append((name, entity))
+  return changes, positions, more, horizon
+
+# purge the tombstones older than the retention period, and return how many were deleted
+def purge_tombstones(client):
+  query = client.query(kind=constants.tombstones)
+  query.add_filter("updated", "<", now() - RETENTION_DAYS * 86400 * 1000000)
+  query.keys_only()
+  keys = [tombstone.key for tombstone in query.fetch()]
+  for start in range(0, len(keys), constants.max_mutations):
+    client.delete_multi(keys[start:start + constants.max_mutations])
+  return len(keys)
@@ -1,3 +1,10 @@
 boats = "boats"
 loads = "loads"
-users = "users"
\ No newline at end of file
+users = "users"
+counters = "counters"
+tombstones = "tombstones"
+jobs = "jobs"
+
+# datastore limits on keys per lookup and entities written per commit or transaction
+max_lookup = 1000
+max_mutations = 500
@@ -0,0 +1,75 @@
+from google.cloud import datastore
+import constants
+import random
+import transactions
+
+# number of shards per counter, so concurrent creates and deletes rarely write the same entity
+NUM_SHARDS = 20
+
+# name of the counter holding the number of entities of a kind that belong to an owner
+def owner_name(kind, owner):
+  return kind + ":" + owner
+
+def shard_key(client, name, index):
+  return client.key(constants.counters, name + "-" + str(index))
+
+# add delta to one randomly chosen shard of each named counter, in a single transaction
+# two writes picking the same shard make one of the transactions abort, which is retried with new shards,
+# as the write being counted is already committed
+def increment(client, names, delta=1):
+  transactions.run_in_transaction(client, increment_shards, client, names, delta)
+
+def increment_shards(client, names, delta):
+  keys = [shard_key(client, name, random.randrange(NUM_SHARDS)) for name in names]
+  shards = {shard.key: shard for shard in client.get_multi(keys)}
+  updated = []
+  for name, key in zip(names, keys):
+    shard = shards.get(key)
+    if shard is None:
+      shard = datastore.entity.Entity(key=key)
+      shard.update({"name": name, "count": 0})
+    shard["count"] += delta
+    updated.append(shard)
+  client.put_multi(updated)
+
+# read the current value of a counter by summing its shards in one lookup
+def total(client, name):
+  shards = client.get_multi([shard_key(client, name, index) for index in range(NUM_SHARDS)])
+  return sum(shard["count"] for shard in shards)
+
+# rebuild every counter from a scan of the boats and loads, e.g. after a failed write left one off
+def reconcile(client):
+  counts = {constants.loads: 0, constants.boats: 0}
+
+  query = client.query(kind=constants.loads)
+  query.keys_only()
+  for _ in query.fetch():
+    counts[constants.loads] += 1
+
+  query = client.query(kind=constants.boats)
+  query.projection = ["owner"]
+  for boat in query.fetch():
+    counts[constants.boats] += 1
+    name = owner_name(constants.boats, boat["owner"])
+    counts[name] = counts.get(name, 0) + 1
+
+  # counters that no longer have any entities behind them are reset to zero
+  query = client.query(kind=constants.counters)
+  query.projection = ["name"]
+  for shard in query.fetch():
+    counts.setdefault(shard["name"], 0)
+
+  # store each count on the first shard and zero the others
+  shards = []
+  for name, count in counts.items():
+    for index in range(NUM_SHARDS):
+      shard = datastore.entity.Entity(key=shard_key(client, name, index))
+      shard.update({"name": name, "count": count if index == 0 else 0})
+      shards.append(shard)
+  for start in range(0, len(shards), constants.max_mutations):
+    client.put_multi(shards[start:start + constants.max_mutations])
+  return counts
+
+if __name__ == '__main__':
+  counts = reconcile(datastore.Client())
+  print("Reconciled " + str(len(counts)) + " counters")
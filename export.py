@@ -0,0 +1,39 @@
+from flask import Response, request, stream_with_context
+import json
+import zlib
+
+# streaming export of whole collections as NDJSON, one entity per line, for clients that ask for it with
+# Accept: application/x-ndjson; entities are written a page at a time as the query's cursor reaches them,
+# so memory use doesn't grow with the collection and the first page goes out as soon as it is read
+
+NDJSON = "application/x-ndjson"
+
+# gzip's window bits for zlib, which writes the gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# whether the request prefers an NDJSON export to a JSON response; */* gets JSON
+def wants_ndjson():
+  return request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+
+# stream every entity of a query, transformed by represent(entity), which returns None to leave an entity out
+# the body is gzip-compressed if the client accepts it, flushing each page so it isn't held back by the compressor
+def ndjson_response(query, represent):
+  compress = "gzip" in request.accept_encodings
+
+  def generate():
+    compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+    for page in query.fetch().pages:
+      lines = [json.dumps(represented) for represented in map(represent, page) if represented is not None]
+      if not lines:
+        continue
+      chunk = ("\n".join(lines) + "\n").encode("utf-8")
+      if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+      yield chunk
+    if compressor:
+      yield compressor.flush()
+
+  headers = {"Vary": "Accept, Accept-Encoding"}
+  if compress:
+    headers["Content-Encoding"] = "gzip"
+  return Response(stream_with_context(generate()), mimetype=NDJSON, headers=headers)
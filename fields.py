@@ -0,0 +1,46 @@
+# sparse fieldsets of the collection routes: ?fields=id,name lists only the id and name of each item
+# when the fields allow it, the query only reads them from storage:
+#   only id and self: a keys-only query, which reads no properties at all
+#   one stored property besides them: a projection query, served from that property's built-in index,
+#     for queries already ordered by that property, with no equality filter and no order or range on another;
+#     a projection comes in the order of the index, by the property's values, so a query in key order isn't
+#     projected, or its items would be listed in another order than with any other fieldset
+# other fieldsets read whole entities and leave the other fields out of the response
+
+# fields every item has without reading its entity
+KEY_FIELDS = ("id", "self")
+
+# the fields named by the request's fields parameter, in order, or None to list every field
+# raises ValueError if a field isn't one of those given
+def requested(args, available):
+  if "fields" not in args:
+    return None
+  names = [name.strip() for name in args["fields"].split(",") if name.strip()]
+  if not names or any(name not in available for name in names):
+    raise ValueError("The fields query parameter must list fields of " + ", ".join(available))
+  return list(dict.fromkeys(names))
+
+# narrow a query to the given fields if it can be, where projectable are the stored properties it can project
+def narrow(query, fields, projectable):
+  if fields is None:
+    return
+  stored = [name for name in fields if name not in KEY_FIELDS]
+  if not stored:
+    query.keys_only()
+    return
+  if len(stored) != 1 or stored[0] not in projectable:
+    return
+  # datastore refuses projections of properties with equality filters, and orders or ranges on other properties
+  # would need a composite index
+  for name, op, _ in query.filters:
+    if name != stored[0] or op == "=":
+      return
+  if not query.order or any(order.lstrip("-") != stored[0] for order in query.order):
+    return
+  query.projection = stored
+
+# a represented item restricted to the given fields, or the item as is if every field is listed
+def select(item, fields):
+  if fields is None or item is None:
+    return item
+  return {name: item[name] for name in fields if name in item}
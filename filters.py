@@ -0,0 +1,117 @@
+import constants
+import datetime
+
+# filtering and sorting of the loads collection, from the query parameters of GET /loads
+#   content=<text>: loads with this content
+#   unassigned=true: loads on no boat
+#   min_volume, max_volume: loads with a volume in this range, inclusive
+#   min_creation_date, max_creation_date: loads created in this range of dates, inclusive, as M/D/YYYY or YYYY-MM-DD
+#   order=volume, -volume, creation_date or -creation_date: sort by this property, descending with a leading '-',
+#     instead of by id
+# datastore allows range filters on one property only, which must also be the property sorted by,
+# so a query has at most one range and sorts by its property if it has one
+# every query is served by a built-in single-property index or by a composite index in index.yaml,
+# and a combination that neither serves is refused with a 400 instead of failing or scanning at query time
+
+# parameters this module reads, carried over to the next url of a page
+PARAMETERS = ["content", "unassigned", "min_volume", "max_volume", "min_creation_date", "max_creation_date", "order"]
+
+# creation dates are stored as clients give them, so loads also store the day as YYYY-MM-DD in "created_on",
+# which sorts by date, or None when the creation date isn't a date in one of these formats
+DATE_FORMATS = ["%m/%d/%Y", "%Y-%m-%d"]
+
+# sortable properties, by the name used in the order parameter
+ORDERS = {"volume": "volume", "creation_date": "created_on"}
+
+# equality filters, and the property they sort by, of the composite indexes on loads declared in index.yaml
+# they are ascending only: a descending sort combined with equality filters would need as many indexes again,
+# each costing index writes on every load write
+COMPOSITE_INDEXES = {
+  (("content",), "volume"),
+  (("content",), "created_on"),
+  (("carrier",), "volume"),
+  (("carrier",), "created_on"),
+  (("carrier", "content"), "volume"),
+  (("carrier", "content"), "created_on"),
+}
+
+def parse_date(text):
+  for date_format in DATE_FORMATS:
+    try:
+      return datetime.datetime.strptime(text, date_format).date().isoformat()
+    except (TypeError, ValueError):
+      pass
+  raise ValueError("not a date")
+
+def parse_volume(text):
+  value = float(text)
+  return int(value) if value.is_integer() else value
+
+def created_on(creation_date):
+  try:
+    return parse_date(creation_date)
+  except ValueError:
+    return None
+
+# set the created_on property of a load from its creation date, after the creation date is set or changed
+def stamp(load):
+  load["created_on"] = created_on(load.get("creation_date"))
+
+# ranges, by property, with the parameters of their bounds and how the parameters are parsed
+RANGES = {
+  "volume": ("min_volume", "max_volume", parse_volume),
+  "created_on": ("min_creation_date", "max_creation_date", parse_date),
+}
+
+# the parameters of args this module reads, e.g. to carry them over to a next url
+def parameters(args):
+  return {name: args[name] for name in PARAMETERS if name in args}
+
+# query of the loads matching the parameters in args, sorted as they ask
+# raises ValueError, with the message of the 400 response, for parameters that are invalid or can't be served
+def load_query(client, args):
+  query = client.query(kind=constants.loads)
+  equalities = []
+  if "content" in args:
+    query.add_filter("content", "=", args["content"])
+    equalities.append("content")
+  if "unassigned" in args:
+    if args["unassigned"] != "true":
+      raise ValueError("The unassigned query parameter can only be true")
+    query.add_filter("carrier", "=", None)
+    equalities.append("carrier")
+
+  ranged = None
+  for name, (low, high, parse) in RANGES.items():
+    if low not in args and high not in args:
+      continue
+    if ranged is not None:
+      raise ValueError("Loads can be filtered by a range of volumes or of creation dates, but not both")
+    ranged = name
+    try:
+      if low in args:
+        query.add_filter(name, ">=", parse(args[low]))
+      if high in args:
+        query.add_filter(name, "<=", parse(args[high]))
+    except ValueError:
+      raise ValueError("The " + low + " or " + high + " query parameter is invalid")
+    # loads whose creation date isn't a date have a created_on of None, which sorts before any date
+    if name == "created_on" and low not in args:
+      query.add_filter(name, ">=", "")
+
+  sort = ranged
+  descending = False
+  if "order" in args:
+    order = args["order"]
+    if order.lstrip("-") not in ORDERS:
+      raise ValueError("The order query parameter must be one of volume, -volume, creation_date or -creation_date")
+    if ranged is not None and ORDERS[order.lstrip("-")] != ranged:
+      raise ValueError("Loads filtered by a range can only be ordered by the property of the range")
+    sort = ORDERS[order.lstrip("-")]
+    descending = order.startswith("-")
+
+  if equalities and sort is not None and (descending or (tuple(sorted(equalities)), sort) not in COMPOSITE_INDEXES):
+    raise ValueError("No index serves this combination of filters and order")
+  if sort is not None:
+    query.order = [("-" if descending else "") + sort]
+  return query
@@ -1,29 +1,314 @@
 from google.cloud import datastore
-from google.oauth2 import id_token
-import google.auth.transport
+from google.api_core.exceptions import BadRequest, Conflict
 import flask
-from flask import Flask, request, jsonify, render_template
-import requests
+from flask import Flask, g, request, render_template
+from werkzeug.http import quote_etag
+import assignments
+import auth
+import batches
+import cache
+import changes
 import constants
+import counters
+import export
+import fields
+import filters
+import metrics
+import negotiation
+import outbound
+import plans
+import ratelimit
+import storage
+import tasks
+import transactions
+import versions
 import uuid
-import yaml
-
-# instantiate flask app and datastore client
-app = Flask(__name__)
-client = datastore.Client()
-
-# global variables for Google OAuth 2.0
-credentials = yaml.safe_load(open('credentials.yaml'))
-AUTH_URI = credentials['auth_uri']
-CLIENT_ID = credentials['client_id']
-CLIENT_SECRET = credentials['client_secret']
-REDIRECT_URI = credentials['redirect_uri']
+import os
+import binascii
+import functools
+import math
+from urllib.parse import urlencode
+
+# the routes are registered on a blueprint, and create_app() builds the flask app serving them
+# nothing slow runs at import: the storage client, the OAuth settings and the JWT verifier are built on first use,
+# or by the warmup request App Engine sends a new instance before routing traffic to it
+api = flask.Blueprint("api", __name__)
+
+# storage client, cloud datastore unless STORAGE_BACKEND selects a local engine, built the first time it is used
+# the client counts its round trips so each request's storage use can be reported,
+# bumps the version of every boat and load it writes, for their ETags,
+# and serves boats and loads read by key from a read-through cache in front of it
+client = storage.CountingClient(storage.LazyClient(storage.get_client))
+client = versions.VersioningClient(client, [constants.boats, constants.loads])
+client = cache.caching_client(client, [constants.boats, constants.loads])
+
+# flask's jsonify, timed as the serialization phase
+jsonify = metrics.jsonify
+
+# settings for Google OAuth 2.0, read from credentials.yaml unless CREDENTIALS_FILE names another file,
+# the first time they are needed
+@functools.lru_cache(maxsize=None)
+def config():
+  import yaml
+  with open(os.environ.get('CREDENTIALS_FILE', 'credentials.yaml')) as credentials_file:
+    return yaml.safe_load(credentials_file)
+
 RESPONSE_TYPE = "code"
 SCOPE = "profile"
 STATE = 0
 
+# endpoint exchanging an authorization code for tokens
+TOKEN_URL = "https://www.googleapis.com/oauth2/v4/token"
+
+# verifier for incoming JWTs, caching Google's signing keys and already verified tokens, built on first use
+verifier = None
+
+def get_verifier():
+  global verifier
+  if verifier is None:
+    verifier = auth.TokenVerifier(config()['client_id'])
+  return verifier
+
+# verify a JWT and return its claims, or raise ValueError, timed as the auth phase
+def verify_jwt(token):
+  with metrics.phase("auth"):
+    return get_verifier().verify(token)
+
+# check whether the request accepts one of the given media types, JSON by default, timed as the accept phase
+def accepts_json(mimetypes=('application/json',)):
+  with metrics.phase("accept"):
+    return any(mimetype in request.accept_mimetypes for mimetype in mimetypes)
+
+# error bodies of the 404 responses, which pre_dispatch also returns for malformed ids
+BOAT_NOT_FOUND = {"Error": "No boat with this boat_id exists"}
+LOAD_NOT_FOUND = {"Error": "No load with this load_id exists"}
+BOAT_OR_LOAD_NOT_FOUND = {"Error": "The specified boat and/or load does not exist"}
+
+# attributes that clients set on boats and loads
+BOAT_ATTRIBUTES = ["name", "type", "length"]
+LOAD_ATTRIBUTES = ["volume", "content", "creation_date"]
+
+# fields of listed boats and loads, which the fields query parameter can pick from
+BOAT_FIELDS = ["id", "name", "type", "length", "owner", "version", "updated", "self"]
+LOAD_FIELDS = ["id", "volume", "content", "creation_date", "created_on", "carrier", "version", "updated", "self"]
+
+# properties of loads that a list can read alone, with a projection query; boats are always read whole,
+# as listing them needs their deleting flag, which only boats being deleted have
+PROJECTED_LOAD_FIELDS = ["volume", "content", "creation_date", "created_on"]
+
+# error bodies of the 400 responses for request objects without the attributes a route needs
+MISSING_ATTRIBUTES = {"Error": "The request object is missing at least one of the required attributes"}
+NOT_A_SUBSET = {"Error": "The request object did not provide a subset of the required attributes"}
+
+# validation of request objects, shared by the single and batch routes
+# each returns the error body for an invalid object, or None
+def creation_error(content, attributes):
+  if not isinstance(content, dict) or any(name not in content for name in attributes):
+    return MISSING_ATTRIBUTES
+  return None
+
+def patch_error(content):
+  if not isinstance(content, dict) or (len(content) != 1 and len(content) != 2):
+    return NOT_A_SUBSET
+  return None
+
+def put_error(content, attributes):
+  if not isinstance(content, dict) or len(content) != 3 or any(name not in content for name in attributes):
+    return MISSING_ATTRIBUTES
+  return None
+
+# whether a value of a request object is an entity id; JSON's true and false are ints to python, but not ids
+def is_id(value):
+  return isinstance(value, int) and not isinstance(value, bool)
+
+# properties of a new boat or load, from a request object that passed creation_error
+def boat_properties(content, userid):
+  return {"name": content["name"], "type": content["type"], "length": content["length"], "owner": userid}
+
+def load_properties(content):
+  return {"volume": content["volume"], "content": content["content"], "creation_date": content["creation_date"],
+    "created_on": filters.created_on(content["creation_date"]), "carrier": None}
+
+# update an entity with the attributes of a request object that passed patch_error, ignoring any others
+def apply_patch(entity, content, attributes):
+  for name in attributes:
+    if name in content:
+      entity[name] = content[name]
+
+# update a load with the attributes of a request object, and the day of creation derived from them
+def update_load(load, content):
+  apply_patch(load, content, LOAD_ATTRIBUTES)
+  filters.stamp(load)
+
+# error body of the 412 responses, when an If-Match header no longer matches the entity
+PRECONDITION_FAILED = {"Error": "The resource has been modified since the version in the If-Match header"}
+
+# strong ETag of a boat or load, from the version every write bumps
+def etag_of(entity):
+  return quote_etag(str(versions.version_of(entity)))
+
+# whether the request's If-None-Match header matches the entity, so it can be answered with 304
+def not_modified(entity):
+  return request.if_none_match.contains_weak(str(versions.version_of(entity)))
+
+# whether the request's If-Match header, if any, no longer matches the entity
+def precondition_failed(entity):
+  return bool(request.if_match) and not request.if_match.contains(str(versions.version_of(entity)))
+
+# write the request's changes to a boat or load read earlier in the request, and return the entity as written,
+# or None if it was deleted, or started being deleted, since
+# the entity is read again, changed by change(entity) and put in one transaction, so the write bumps the version
+# that is stored, and each version has one body only, and concurrent writes of other properties, e.g. a load's
+# assignment, aren't overwritten with what the request read
+# if the request has an If-Match header, raises versions.Modified if another write changed the entity since
+# the version it had when read, so no update is silently lost
+def save(entity, version, change):
+  return transactions.run_in_transaction(client, put_changed, entity.key, version if request.if_match else None, change)
+
+def put_changed(key, version, change):
+  entity = client.get(key)
+  if version is not None:
+    versions.check(entity, version)
+  if entity is None or entity.get("deleting"):
+    return None
+  change(entity)
+  client.put(entity)
+  return entity
+
+# return the 'sub' of the request's bearer JWT, or None if it is missing or invalid
+# reference: https://stackoverflow.com/questions/63518441/how-to-read-a-bearer-token-from-postman-into-python-code
+def authenticate():
+  parts = request.headers.get('Authorization', '').split()
+  if len(parts) != 2:
+    return None
+
+  # reference: https://developers.google.com/identity/sign-in/web/backend-auth
+  try:
+    return verify_jwt(parts[1])['sub']
+  except ValueError:
+    return None
+
+# admission control of the routes: each client's token bucket, keyed by the 'sub' of its JWT or else its IP address,
+# and the cap on requests served at once by this instance; either can be set to None to turn it off
+limiter = ratelimit.limiter()
+in_flight = ratelimit.concurrency_limit()
+
+# costs charged to a client's bucket by routes heavier than a lookup: collection scans, and batches of many entities
+SCAN_COST = 5
+BATCH_COST = 20
+
+# error bodies of the 429 and 503 responses
+RATE_LIMITED = {"Error": "Too many requests; retry after the number of seconds in the Retry-After header"}
+OVERLOADED = {"Error": "The server is too busy to handle the request; retry after the number of seconds in the Retry-After header"}
+
+# the address of the client making the request, as App Engine's front end saw it
+# reference: https://cloud.google.com/appengine/docs/standard/python3/reference/request-response-headers
+def client_address():
+  return request.headers.get('X-Appengine-User-IP') or request.remote_addr
+
+# checks shared by the routes, run before a route touches storage so rejected requests cost no storage reads
+# in the order the API reports them: a full instance is 503, then a client out of requests is 429,
+# then a missing or invalid JWT is 401, then a missing Accept header is 406, then an id in the path that is not an integer is 404
+#   jwt and accept: the methods that require a JWT and a JSON Accept header
+#   mimetypes: the media types the accept methods may ask for instead, JSON unless given
+#   ids: path parameters that must be integers, passed on to the route as ints, with the error body of their 404
+#   cost: what each method costs the client's token bucket, 1 unless given
+# the 'sub' of the JWT is left in g.userid
+def pre_dispatch(jwt=(), accept=(), ids=None, mimetypes=('application/json',), cost=None):
+  def decorator(route):
+    @functools.wraps(route)
+    def dispatch(**kwargs):
+      # if the instance is serving as many requests as it can, return 503 at once rather than queue the request
+      limit = in_flight
+      if limit is not None and not limit.acquire():
+        return (jsonify(OVERLOADED), 503, {'Retry-After': '1'})
+      try:
+        return check(**kwargs)
+      finally:
+        if limit is not None:
+          limit.release()
+
+    def check(**kwargs):
+      g.userid = None
+      if request.method in jwt:
+        g.userid = authenticate()
+
+      # if the client has used up its requests, return 429 with the seconds until it has enough again
+      # clients without a valid JWT are charged by address, so invalid tokens can't be used to dodge the limit
+      if limiter is not None:
+        key = "user:" + g.userid if g.userid is not None else "ip:" + str(client_address())
+        wait = limiter.admit(key, (cost or {}).get(request.method, 1))
+        if wait:
+          return (jsonify(RATE_LIMITED), 429, {'Retry-After': str(math.ceil(wait))})
+
+      # if the request is missing a JWT or the JWT is invalid, return 401
+      if request.method in jwt and g.userid is None:
+        return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
+
+      # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
+      if request.method in accept and not accepts_json(mimetypes):
+        return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+
+      # if an id in the path is not an integer, no entity can have it, so return 404
+      for name, error in (ids or {}).items():
+        try:
+          kwargs[name] = int(kwargs[name])
+        except ValueError:
+          return (jsonify(error), 404)
+
+      # only GET is served from the entity cache; other methods write back what they read, so they read storage
+      if request.method == 'GET':
+        return route(**kwargs)
+      with client.bypass():
+        return route(**kwargs)
+    return dispatch
+  return decorator
+
+# check of the cron routes: requests that don't come from App Engine's cron service are 403
+# App Engine strips the X-Appengine-Cron header from requests that don't come from its cron service
+# reference: https://cloud.google.com/appengine/docs/standard/python3/scheduling-jobs-with-cron-yaml
+def cron_only(route):
+  @functools.wraps(route)
+  def dispatch(**kwargs):
+    if request.headers.get('X-Appengine-Cron') != 'true':
+      return (jsonify({"Error": "The request did not come from the cron service"}), 403)
+    return route(**kwargs)
+  return dispatch
+
+# loads listed in a boat's representation, the rest are paged through on /boats/boat_id/loads
+BOAT_LOADS_LIMIT = 100
+
+# fetch one page of a query, starting from the request's next_page_token, and build the url of the following page
+# the token is an opaque datastore cursor, so deep pages cost the same as the first one
+# parameters, e.g. the filters of the query, are carried over to the following page's url, as its cursor needs them
+# raises ValueError for an invalid limit or page token
+def fetch_page(query, parameters=None):
+  q_limit = int(request.args.get('limit', '5'))
+  page_token = request.args.get('next_page_token')
+  if q_limit < 1:
+    raise ValueError("limit must be positive")
+
+  # offset is still honored for clients holding next urls from before page tokens
+  if page_token:
+    l_iterator = query.fetch(limit=q_limit, start_cursor=page_token)
+  else:
+    l_iterator = query.fetch(limit=q_limit, offset=int(request.args.get('offset', '0')))
+  try:
+    results = list(next(l_iterator.pages))
+  except (binascii.Error, BadRequest):
+    raise ValueError("invalid page token")
+
+  if l_iterator.next_page_token:
+    next_token = l_iterator.next_page_token
+    if isinstance(next_token, bytes):
+      next_token = next_token.decode()
+    next_url = request.base_url + "?" + urlencode({"limit": q_limit, **(parameters or {}), "next_page_token": next_token})
+  else:
+    next_url = None
+  return results, next_url
+
 # index route
-@app.route('/')
+@api.route('/')
 def index():
   # generate a random state value
   # reference: https://stackoverflow.com/questions/2511222/efficiently-generate-a-16-character-alphanumeric-string
@@ -31,155 +316,120 @@ def index():
   STATE = uuid.uuid4().hex
 
   # request url for client to access end-user resources on the server
-  request_url = AUTH_URI + "?response_type=" + RESPONSE_TYPE + "&client_id=" + CLIENT_ID + "&redirect_uri=" + REDIRECT_URI + "&scope=" + SCOPE + "&state=" + STATE
+  request_url = config()['auth_uri'] + "?response_type=" + RESPONSE_TYPE + "&client_id=" + config()['client_id'] + "&redirect_uri=" + config()['redirect_uri'] + "&scope=" + SCOPE + "&state=" + STATE
   return render_template("index.html", request=request_url)
 
 # oauth route
 # reference: https://developers.google.com/identity/protocols/oauth2/web-server#httprest
-@app.route('/oauth')
+@api.route('/oauth')
 def oauth():
   # client sends access code and client secret to the server
   auth_code = flask.request.args.get('code') 
   data = {
     'code': auth_code,
-    'client_id': CLIENT_ID,
-    'client_secret': CLIENT_SECRET,
-    'redirect_uri': REDIRECT_URI,
+    'client_id': config()['client_id'],
+    'client_secret': config()['client_secret'],
+    'redirect_uri': config()['redirect_uri'],
     'grant_type': 'authorization_code'
   }
-  r = requests.post('https://www.googleapis.com/oauth2/v4/token', data=data)
+  # the exchange reuses a pooled keep-alive connection to Google
+  r = outbound.session().post(TOKEN_URL, data=data)
 
 	# get JWT from the server
   JWT = r.json()["id_token"]
   
   # get the 'sub' value from the JWT
   # reference: https://developers.google.com/identity/sign-in/web/backend-auth
-  idinfo = id_token.verify_oauth2_token(JWT, google.auth.transport.requests.Request(), CLIENT_ID)
+  idinfo = verify_jwt(JWT)
   userid = idinfo['sub']
 
-  # query datastore for all existing users
-  query = client.query(kind=constants.users)
-  results = list(query.fetch())
-
-  # check if a user with the 'sub' value id already exists
-  user_exists = False
-  for user in results:
-    if user['id'] == userid:
-      user_exists = True
-      break
-  
-  # if user does not exist, add the new user to datastore
-  if not user_exists:
-    new_user = datastore.entity.Entity(key=client.key(constants.users))
-    new_user.update({"id": userid})
-    client.put(new_user)
+  # users are keyed by their 'sub' value, so looking one up is a single get
+  # the lookup and insert run in one transaction so concurrent logins can't create duplicates
+  user_key = client.key(constants.users, userid)
+  try:
+    with client.transaction():
+      # if user does not exist, add the new user to datastore
+      if client.get(user_key) is None:
+        new_user = datastore.entity.Entity(key=user_key)
+        new_user.update({"id": userid})
+        client.put(new_user)
+  except Conflict:
+    # a concurrent login for the same user committed first, so the user exists
+    pass
   
 	# render oauth page with the received JWT value and user's unique id
   return render_template("oauth.html", JWT_value=JWT, id_value=userid)
 
 # get route for /users
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
+@pre_dispatch(accept=['GET'], mimetypes=('application/json', export.NDJSON), cost={'GET': SCAN_COST})
 def get_users():
   if request.method == 'GET':
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # query all users in datastore and return results
+    # query all users in datastore
     query = client.query(kind=constants.users)
+
+    # stream the users one per line if the client asked for an NDJSON export
+    if export.wants_ndjson():
+      return export.ndjson_response(query, dict)
+
+    # return results
     results = list(query.fetch())
     return (jsonify(results), 200)
 
 # post and get routes for /boats
-@app.route('/boats', methods=['POST', 'GET'])
+@api.route('/boats', methods=['POST', 'GET'])
+@pre_dispatch(jwt=['POST', 'GET'], accept=['POST', 'GET'], mimetypes=negotiation.MIMETYPES + (export.NDJSON,), cost={'GET': SCAN_COST})
 def post_boats():
+  userid = g.userid
+
   # add a new boat
   if request.method == 'POST':
-    content = request.get_json()
-
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-		# reference: https://stackoverflow.com/questions/63518441/how-to-read-a-bearer-token-from-postman-into-python-code
-    request_JWT = request.headers.get('Authorization').split()[1]
-
-    # if the JWT is invalid, return 401
-    # reference: https://developers.google.com/identity/sign-in/web/backend-auth
-    try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+    content = request.get_json(silent=True) or {}
 
     # if the request is missing any of the required attributes, return 400
-    if "name" not in content or "type" not in content or "length" not in content:
-      return (jsonify({"Error": "The request object is missing at least one of the required attributes"}), 400)
+    error = creation_error(content, BOAT_ATTRIBUTES)
+    if error:
+      return (jsonify(error), 400)
 
     # add the boat to datastore
     new_boat = datastore.entity.Entity(key=client.key(constants.boats))
-    new_boat.update({
-      "name": content["name"],
-      "type": content["type"],
-      "length": content["length"],
-      "owner": userid,
-      "loads": []
-    })
+    new_boat.update(boat_properties(content, userid))
     client.put(new_boat)
 
+    # count the new boat in the total and in the user's total
+    counters.increment(client, [constants.boats, counters.owner_name(constants.boats, userid)])
+
     # return representation of new boat
     self_url = request.base_url + "/" + str(new_boat.key.id)
     new_boat["id"] = new_boat.key.id
     new_boat["self"] = self_url
-    return (jsonify(new_boat), 201)
+    return (negotiation.respond(new_boat), 201)
 
   # get all boats
   elif request.method == 'GET':
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-    request_JWT = request.headers.get('Authorization').split()[1]
+    query = client.query(kind=constants.boats)
+    query.add_filter("owner", "=", userid)
 
-    # if the JWT is invalid, return 401
+    # only the fields the client asked for are listed
     try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+      listed = fields.requested(request.args, BOAT_FIELDS)
+    except ValueError as error:
+      return (jsonify({"Error": str(error)}), 400)
+    represent = lambda boat: fields.select(represent_listed_boat(boat), listed)
 
-    # get all boats with pagination
-    query = client.query(kind=constants.boats)
-    total = len(list(query.fetch()))
-    q_limit = int(request.args.get('limit', '5'))
-    q_offset = int(request.args.get('offset', '0'))
-    l_iterator = query.fetch(limit=q_limit, offset=q_offset)
-    pages = l_iterator.pages
-    results = list(next(pages))
+    # stream all of the user's boats one per line if the client asked for an NDJSON export
+    if export.wants_ndjson():
+      return export.ndjson_response(query, represent)
 
-    if l_iterator.next_page_token:
-      next_offset = q_offset + q_limit
-      next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-    else:
-      next_url = None
-
-    # filter boats that belong to the user with the request
-    user_boats = []
-    for boat in results:
-      if boat["owner"] == userid:
-        boat["id"] = boat.key.id
-        boat["self"] = request.base_url + "/" + str(boat.key.id)
-        user_boats.append(boat)
+    # get the user's boats with cursor-based pagination
+    total = counters.total(client, counters.owner_name(constants.boats, userid))
+    try:
+      results, next_url = fetch_page(query, {"fields": request.args["fields"]} if listed else None)
+    except ValueError:
+      return (jsonify({"Error": "The limit or next_page_token query parameter is invalid"}), 400)
+
+    # add id and self representation for each boat, skipping boats that are being deleted
+    user_boats = [boat for boat in map(represent, results) if boat is not None]
     
     # create response with user's boats
     response = {"boats": user_boats}
@@ -192,266 +442,232 @@ def post_boats():
       response["next"] = next_url
 
     # return the response
-    return (jsonify(response), 200)
+    return (negotiation.respond(response), 200)
+
+# copy a renamed boat's name into the carrier of its loads
+# called whenever a request sets the boat's name, even to the name it already has, so a retried rename whose
+# first attempt stopped before its loads were renamed still renames them; loads that have the name are left alone
+# if that continues in the background, the boat's representation links the progress of the rename job
+def rename_loads(boat):
+  if not tasks.rename_carrier(client, boat):
+    boat["rename"] = request.url_root + "boats/" + str(boat.key.id) + "/rename"
+
+# a boat as listed on /boats, with its id and self representation, or None for a boat being deleted
+def represent_listed_boat(boat):
+  if boat.get("deleting"):
+    return None
+  boat["id"] = boat.key.id
+  boat["self"] = request.url_root + "boats/" + str(boat.key.id)
+  return boat
 
 # get, patch, put, and delete routes for /boats/boat_id
-@app.route('/boats/<boat_id>', methods=['GET', 'PATCH', 'PUT', 'DELETE'])
+@api.route('/boats/<boat_id>', methods=['GET', 'PATCH', 'PUT', 'DELETE'])
+@pre_dispatch(jwt=['GET', 'PATCH', 'PUT', 'DELETE'], accept=['GET', 'PATCH', 'PUT'], ids={'boat_id': BOAT_NOT_FOUND},
+  cost={'DELETE': SCAN_COST})
 def get_patch_put_delete_boat(boat_id):
-  boat_key = client.key(constants.boats, int(boat_id))
-  boat = client.get(key=boat_key)
+  userid = g.userid
+  boat_key = client.key(constants.boats, boat_id)
 
-  # get a boat
-  if request.method == 'GET':
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-    request_JWT = request.headers.get('Authorization').split()[1]
+  # if the cached boat matches the If-None-Match header, return 304 without reading or copying the boat
+  if request.method == 'GET' and request.if_none_match:
+    cached = client.peek(boat_key)
+    if cached and not cached.get("deleting") and cached["owner"] == userid and not_modified(cached):
+      return ('', 304, {'ETag': etag_of(cached)})
 
-    # if the JWT is invalid, return 401
-    try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
+  boat = client.get(key=boat_key)
 
-    # if the request contains accept header besides 'application/json' or is missing accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+  # if the boat does not exist or is being deleted, return 404
+  if not boat or boat.get("deleting"):
+    return (jsonify(BOAT_NOT_FOUND), 404)
 
-    # if the boat does not exist, return 404
-    if not boat:
-      return (jsonify({"Error": "No boat with this boat_id exists"}), 404)
+  # if the boat does not belong to the user making the request, return 403
+  if boat["owner"] != userid:
+    return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
 
-    # if the boat does not belong to the user making the request, return 403
-    if boat["owner"] != userid:
-      return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+  # if the boat changed since the version in the If-Match header, return 412
+  version = versions.version_of(boat)
+  if request.method != 'GET' and precondition_failed(boat):
+    return (jsonify(PRECONDITION_FAILED), 412)
 
-    # add id and self representation for loads on the boat, if any
-    for loaded in boat["loads"]:
-      loaded["self"] = request.url_root + "loads/" + loaded["id"]
-      loaded["id"] = int(loaded["id"])
+  # get a boat
+  if request.method == 'GET':
+    # if the boat matches the If-None-Match header, return 304
+    if not_modified(boat):
+      return ('', 304, {'ETag': etag_of(boat)})
+
+    # add id and self representation for the first loads on the boat, if any,
+    # and the url of the next ones if there are more, which are paged through on /boats/boat_id/loads
+    # from the cursor after the first page, as fetch_page does
+    query = assignments.carried_loads(client, boat_key)
+    query.keys_only()
+    l_iterator = query.fetch(limit=BOAT_LOADS_LIMIT)
+    carried = list(next(l_iterator.pages))
+    boat["loads"] = [{"id": load.key.id, "self": request.url_root + "loads/" + str(load.key.id)} for load in carried]
+    if l_iterator.next_page_token:
+      next_token = l_iterator.next_page_token
+      if isinstance(next_token, bytes):
+        next_token = next_token.decode()
+      boat["loads_next"] = request.base_url + "/loads?" + urlencode({"limit": BOAT_LOADS_LIMIT, "next_page_token": next_token})
 
     # add id and self representation of the boat and return response
     boat["self"] = request.base_url
-    boat["id"] = int(boat_id)
-    return (jsonify(boat), 200)
+    boat["id"] = boat_id
+    return (jsonify(boat), 200, {'ETag': etag_of(boat)})
   
   # patch a boat
   elif request.method == 'PATCH':
-    content = request.get_json()
-
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-    request_JWT = request.headers.get('Authorization').split()[1]
-
-    # if the JWT is invalid, return 401
-    try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-
-    # if the request contains accept header besides 'application/json' or is missing accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # if the boat does not exist, return 404
-    if not boat:
-      return (jsonify({"Error": "No boat with this boat_id exists"}), 404)
-
-    # if the boat does not belong to the user making the request, return 403
-    if boat["owner"] != userid:
-      return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+    content = request.get_json(silent=True) or {}
 
     # if the request does not provide exactly one or two attributes to edit, return 400
-    if len(content) != 1 and len(content) != 2:
-      return (jsonify({"Error": "The request object did not provide a subset of the required attributes"}), 400)
-
-    # update the boat
+    error = patch_error(content)
+    if error:
+      return (jsonify(error), 400)
+
+    # update the boat, and the carrier name of its loads if the name was set
+    # if the boat was deleted meanwhile, return 404
+    boat = save(boat, version, lambda boat: apply_patch(boat, content, BOAT_ATTRIBUTES))
+    if boat is None:
+      return (jsonify(BOAT_NOT_FOUND), 404)
     if "name" in content:
-      boat.update({"name": content["name"]})
-    if "type" in content:
-      boat.update({"type": content["type"]})
-    if "length" in content:
-      boat.update({"length": content["length"]})
-    client.put(boat)
+      rename_loads(boat)
 
     # add id and self representation of the boat and return response
     boat["self"] = request.base_url
-    boat["id"] = int(boat_id)
-    return (jsonify(boat), 200)
+    boat["id"] = boat_id
+    return (jsonify(boat), 200, {'ETag': etag_of(boat)})
   
   # put a boat
   elif request.method == 'PUT':
-    content = request.get_json()
-
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-    request_JWT = request.headers.get('Authorization').split()[1]
-
-    # if the JWT is invalid, return 401
-    try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
+    content = request.get_json(silent=True) or {}
 
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # if the boat does not exist, return 404
-    if not boat:
-      return (jsonify({"Error": "No boat with this boat_id exists"}), 404)
-
-    # if the boat does not belong to the user making the request, return 403
-    if boat["owner"] != userid:
-      return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+    # if the request does not provide exactly the three attributes to edit, return 400
+    error = put_error(content, BOAT_ATTRIBUTES)
+    if error:
+      return (jsonify(error), 400)
 
-    # if the request does not provide exactly three attributes to edit, return 400
-    if len(content) != 3:
-      return (jsonify({"Error": "The request object is missing at least one of the required attributes"}), 400)
-
-    # update the boat
-    boat.update({"name": content["name"]})
-    boat.update({"type": content["type"]})
-    boat.update({"length": content["length"]})
-    client.put(boat)
+    # update the boat, and the carrier name of its loads
+    # if the boat was deleted meanwhile, return 404
+    boat = save(boat, version, lambda boat: apply_patch(boat, content, BOAT_ATTRIBUTES))
+    if boat is None:
+      return (jsonify(BOAT_NOT_FOUND), 404)
+    rename_loads(boat)
 
     # add id and self representation of the boat and return response
     boat["self"] = request.base_url
-    boat["id"] = int(boat_id)
-    return (jsonify(boat), 200)
+    boat["id"] = boat_id
+    return (jsonify(boat), 200, {'ETag': etag_of(boat)})
 
   # delete a boat
   elif request.method == 'DELETE':
-    # if the request is missing a JWT, return 401
-    if not request.headers.get('Authorization'):
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-    
-    # get the JWT from the request
-    request_JWT = request.headers.get('Authorization').split()[1]
-
-    # if the JWT is invalid, return 401
-    try:
-      idinfo = id_token.verify_oauth2_token(request_JWT, google.auth.transport.requests.Request(), CLIENT_ID)
-      userid = idinfo['sub']
-    except ValueError:
-      return (jsonify({"Error": "The request object is missing a JWT or contains invalid JWT"}), 401)
-
-    # if the boat does not exist, return 404
-    if not boat:
-      return (jsonify({"Error": "No boat with this boat_id exists"}), 404)
-
-    # if the boat does not belong to the user making the request, return 403
-    if boat["owner"] != userid:
-      return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
-
-    # remove boat, if necessary, from load/s as carriers before deleting the boat, and return response
-    if not boat["loads"]:
-      client.delete(boat)
-    else:
-      for loaded in boat["loads"]:
-        load_key = client.key(constants.loads, int(loaded["id"]))
-        load = client.get(key=load_key)
-        load["carrier"] = None
-        client.put(load)
-      client.delete(boat)
+    # remove boat from its loads as carrier and delete the boat, atomically when the loads fit in one transaction,
+    # otherwise in a background job, and return response
+    # with an If-Match header, the version is re-checked in the same transaction as the delete
+    tasks.delete_boat(client, boat, version if request.if_match else None)
     return('', 204)
 
 # post and get routes for /loads
-@app.route('/loads', methods=['POST', 'GET'])
+@api.route('/loads', methods=['POST', 'GET'])
+@pre_dispatch(accept=['POST', 'GET'], mimetypes=negotiation.MIMETYPES + (export.NDJSON,), cost={'GET': SCAN_COST})
 def post_get_loads():
   # add a new load
   if request.method == 'POST':
-    content = request.get_json()
-    
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+    content = request.get_json(silent=True) or {}
 
     # if the request is missing any of the required attributes, return 400
-    if "volume" not in content or "content" not in content or "creation_date" not in content:
-      return (jsonify({"Error": "The request object is missing at least one of the required attributes"}), 400)
+    error = creation_error(content, LOAD_ATTRIBUTES)
+    if error:
+      return (jsonify(error), 400)
 
     # add the new load to datastore
     new_load = datastore.entity.Entity(key=client.key(constants.loads))
-    new_load.update({
-      "volume": content["volume"],
-      "content": content["content"],
-      "creation_date": content["creation_date"],
-      "carrier": None
-    })
+    new_load.update(load_properties(content))
     client.put(new_load)
+    counters.increment(client, [constants.loads])
 
     # add id and self representation of the load and return response
     self_url = request.base_url + "/" + str(new_load.key.id)
     new_load["id"] = new_load.key.id
     new_load["self"] = self_url
-    return (jsonify(new_load), 201)
+    return (negotiation.respond(new_load), 201)
   
-  # get all loads
+  # get all loads, or the loads matching the filters in the query parameters
   elif request.method == 'GET':
-    # if the request contains accept header besides 'application/json', or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # get all loads with pagination
-    query = client.query(kind=constants.loads)
-    total = len(list(query.fetch()))
-    q_limit = int(request.args.get('limit', '5'))
-    q_offset = int(request.args.get('offset', '0'))
-    l_iterator = query.fetch(limit=q_limit, offset=q_offset)
-    pages = l_iterator.pages
-    results = list(next(pages))
-
-    if l_iterator.next_page_token:
-      next_offset = q_offset + q_limit
-      next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-    else:
-      next_url = None
+    try:
+      query = filters.load_query(client, request.args)
+      listed = fields.requested(request.args, LOAD_FIELDS)
+    except ValueError as error:
+      return (jsonify({"Error": str(error)}), 400)
+    parameters = filters.parameters(request.args)
+
+    # only the fields the client asked for are listed, and read if the query can be narrowed to them
+    fields.narrow(query, listed, PROJECTED_LOAD_FIELDS)
+    represent = lambda load: fields.select(represent_listed_load(load), listed)
+
+    # stream the loads one per line if the client asked for an NDJSON export
+    if export.wants_ndjson():
+      return export.ndjson_response(query, represent)
+
+    # get the loads with cursor-based pagination
+    # the total counts every load, so it is left out of filtered lists, where counting the matches would cost a scan
+    total = None if parameters else counters.total(client, constants.loads)
+    if listed:
+      parameters["fields"] = request.args["fields"]
+    try:
+      results, next_url = fetch_page(query, parameters)
+    except ValueError:
+      return (jsonify({"Error": "The limit or next_page_token query parameter is invalid"}), 400)
 
     # add id and self representation for each load
-    for load in results:
-      load["id"] = load.key.id
-      load["self"] = request.base_url + "/" + str(load.key.id)
+    results = [represent(load) for load in results]
 
     # create response
     response = {"loads": results}
 
     # add total number of loads in response
-    response["total"] = total
+    if total is not None:
+      response["total"] = total
 
     # add next url if more than five loads
     if next_url:
       response["next"] = next_url
 
     # return response
-    return (jsonify(response), 200)
+    return (negotiation.respond(response), 200)
+
+# a load as listed on /loads, with its id and self representation
+def represent_listed_load(load):
+  load["id"] = load.key.id
+  load["self"] = request.url_root + "loads/" + str(load.key.id)
+  return load
 
 # get, patch, put, and delete routes for /loads/load_id
-@app.route('/loads/<load_id>', methods=['GET', 'PATCH', 'PUT', 'DELETE'])
+@api.route('/loads/<load_id>', methods=['GET', 'PATCH', 'PUT', 'DELETE'])
+@pre_dispatch(accept=['GET', 'PATCH', 'PUT'], ids={'load_id': LOAD_NOT_FOUND})
 def get_load(load_id):
-  load_key = client.key(constants.loads, int(load_id))
+  load_key = client.key(constants.loads, load_id)
+
+  # if the cached load matches the If-None-Match header, return 304 without reading or copying the load
+  if request.method == 'GET' and request.if_none_match:
+    cached = client.peek(load_key)
+    if cached and not_modified(cached):
+      return ('', 304, {'ETag': etag_of(cached)})
+
   load = client.get(key=load_key)
 
+  # if the load does not exist, return 404
+  if not load:
+    return (jsonify(LOAD_NOT_FOUND), 404)
+
+  # if the load changed since the version in the If-Match header, return 412
+  version = versions.version_of(load)
+  if request.method != 'GET' and precondition_failed(load):
+    return (jsonify(PRECONDITION_FAILED), 412)
+
   # get a load
   if request.method == 'GET':
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # if the load does not exist, return 404
-    if not load:
-      return (jsonify({"Error": "No load with this load_id exists"}), 404)
+    # if the load matches the If-None-Match header, return 304
+    if not_modified(load):
+      return ('', 304, {'ETag': etag_of(load)})
 
     # if the load is on a boat, add id and self representation for the boat
     if load["carrier"]:
@@ -460,137 +676,539 @@ def get_load(load_id):
 
     # add id and self representation  of the load and return response
     load["self"] = request.base_url
-    load["id"] = int(load_id)
-    return (jsonify(load), 200)
+    load["id"] = load_id
+    return (jsonify(load), 200, {'ETag': etag_of(load)})
 
   # patch a load
   elif request.method == 'PATCH':
-    content = request.get_json()
-
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
-
-    # if the load does not exist, return 404
-    if not load:
-      return (jsonify({"Error": "No load with this load_id exists"}), 404)
+    content = request.get_json(silent=True) or {}
 
     # if the request does not provide exactly one or two attributes to edit, return 400
-    if len(content) != 1 and len(content) != 2:
-      return (jsonify({"Error": "The request object did not provide a subset of the required attributes"}), 400)
-
-    # update the load
-    if "volume" in content:
-      load.update({"volume": content["volume"]})
-    if "content" in content:
-      load.update({"content": content["content"]})
-    if "creation_date" in content:
-      load.update({"creation_date": content["creation_date"]})
-    client.put(load)
+    error = patch_error(content)
+    if error:
+      return (jsonify(error), 400)
+
+    # update the load; if it was deleted meanwhile, return 404
+    load = save(load, version, lambda load: update_load(load, content))
+    if load is None:
+      return (jsonify(LOAD_NOT_FOUND), 404)
 
     # add id and self representation of the load and return response
     load["self"] = request.base_url
-    load["id"] = int(load_id)
-    return (jsonify(load), 200)
+    load["id"] = load_id
+    return (jsonify(load), 200, {'ETag': etag_of(load)})
 
   # put a load
   elif request.method == 'PUT':
-    content = request.get_json()
-
-    # if the request contains accept header besides 'application/json' or is missing the accept header, return 406
-    if 'application/json' not in request.accept_mimetypes:
-      return (jsonify({"Error": "MIME type not supported by the endpoint or the Accept header is missing"}), 406)
+    content = request.get_json(silent=True) or {}
 
-    # if the load does not exist, return 404
-    if not load:
-      return (jsonify({"Error": "No load with this load_id exists"}), 404)
+    # if the request does not provide exactly the three attributes to edit, return 400
+    error = put_error(content, LOAD_ATTRIBUTES)
+    if error:
+      return (jsonify(error), 400)
 
-    # if the request does not provide exactly three attributes to edit, return 400
-    if len(content) != 3:
-      return (jsonify({"Error": "The request object is missing at least one of the required attributes"}), 400)
-
-    # update the load
-    load.update({"volume": content["volume"]})
-    load.update({"content": content["content"]})
-    load.update({"creation_date": content["creation_date"]})
-    client.put(load)
+    # update the load; if it was deleted meanwhile, return 404
+    load = save(load, version, lambda load: update_load(load, content))
+    if load is None:
+      return (jsonify(LOAD_NOT_FOUND), 404)
 
     # add id and self representation of the load and return response
     load["self"] = request.base_url
-    load["id"] = int(load_id)
-    return (jsonify(load), 200)
+    load["id"] = load_id
+    return (jsonify(load), 200, {'ETag': etag_of(load)})
   
   # delete a load
   elif request.method == 'DELETE':
-    # if the load does not exist, return 404
-    if not load:
-      return (jsonify({"Error": "No load with this load_id exists"}), 404)
-
-    # update the boat that the load is on, if any, before deleting the load, and return response
-    if not load["carrier"]:
-      client.delete(load)
-    else:
-      boat_key = client.key(constants.boats, int(load["carrier"]["id"]))
-      boat = client.get(key=boat_key)
-      for loaded in boat["loads"]:
-        if loaded["id"] == str(load.key.id):
-          boat["loads"].remove(loaded)
-          client.put(boat)
-          break
-      client.delete(load)
+    # the load is read again and deleted in one transaction, with a write of its boat if it is on one,
+    # and its version re-checked against the If-Match header if there is one
+    # only the request that deleted it counts it out, so concurrent deletes don't count it twice; then return response
+    if transactions.run_in_transaction(client, delete_load, load_key, version if request.if_match else None):
+      counters.increment(client, [constants.loads], -1)
     return('', 204)
 
+# delete a load, writing the boat it is on, if any, to bump the boat's version
+# returns whether the load was deleted, or False if it was already gone
+# if a version is given, raises versions.Modified when the stored load no longer has it
+def delete_load(load_key, version=None):
+  load = client.get(load_key)
+  if version is not None:
+    versions.check(load, version)
+  if load is None:
+    return False
+  if load["carrier"]:
+    boat = client.get(client.key(constants.boats, int(load["carrier"]["id"])))
+    if boat is not None:
+      client.put(boat)
+  client.delete(load_key)
+  return True
+
 # put and delete routes for /boats/boat_id/loads/load_id
-@app.route('/boats/<boat_id>/loads/<load_id>', methods=['PUT', 'DELETE'])
+@api.route('/boats/<boat_id>/loads/<load_id>', methods=['PUT', 'DELETE'])
+@pre_dispatch(ids={'boat_id': BOAT_OR_LOAD_NOT_FOUND, 'load_id': BOAT_OR_LOAD_NOT_FOUND})
 def boats_and_loads(boat_id, load_id):
-  boat_key = client.key(constants.boats, int(boat_id))
-  boat = client.get(key=boat_key)
-  load_key = client.key(constants.loads, int(load_id))
-  load = client.get(key=load_key)
+  boat_key = client.key(constants.boats, boat_id)
 
   # assign a load to a boat
+  # the boat and load are read in one lookup, and checked and updated in one transaction
   if request.method == 'PUT':
-    # if the boat or load does not exist, return 404
-    if not boat or not load:
-      return (jsonify({"Error": "The specified boat and/or load does not exist"}), 404)
+    status = assignments.assign(client, boat_key, [load_id])[load_id]
+
+    # if the boat or load does not exist, or the boat is being deleted, return 404
+    if status in (assignments.BOAT_NOT_FOUND, assignments.LOAD_NOT_FOUND):
+      return (jsonify(BOAT_OR_LOAD_NOT_FOUND), 404)
 
     # if the load is already assigned to a boat, return 403
-    elif load["carrier"] is not None:
+    elif status == assignments.ALREADY_ASSIGNED:
       return (jsonify({"Error": "The load is already assigned to another boat"}), 403)
 
-    # add the load to the boat, add boat to load's carrier, and return response
-    else:
-      boat["loads"].append({"id": str(load.key.id)})
-      client.put(boat)
-
-      load["carrier"] = {"id": str(boat_id), "name": boat["name"]}
-      client.put(load)
-
-      return ('', 204)
+    # the load was added to the boat and the boat to load's carrier, return response
+    return ('', 204)
   
   # remove a load from a boat 
   elif request.method == 'DELETE':
-    # if the boat or load does not exist, return 404
-    if not boat or not load:
-      return (jsonify({"Error": "The specified boat and/or load does not exist"}), 404)
-
-    # iterate over boat's loads, and if the load is on the boat, remove the load from boat and update load's carrier and return response
-    for loaded in boat["loads"]:
-      if loaded["id"] == str(load.key.id):
-        boat["loads"].remove(loaded)
-        client.put(boat)
-        load["carrier"] = None
-        client.put(load)
-        return ('', 204)
+    status = assignments.unassign(client, boat_key, [load_id])[load_id]
+
+    # if the boat or load does not exist, or the boat is being deleted, return 404
+    if status in (assignments.BOAT_NOT_FOUND, assignments.LOAD_NOT_FOUND):
+      return (jsonify(BOAT_OR_LOAD_NOT_FOUND), 404)
 
     # return 403 if the load is not on the boat
-    return (jsonify({"Error": "No load with this load_id is at the boat with this boat_id"}), 403)
+    elif status == assignments.NOT_ON_BOAT:
+      return (jsonify({"Error": "No load with this load_id is at the boat with this boat_id"}), 403)
+
+    # the load was removed from the boat and its carrier cleared, return response
+    return ('', 204)
+
+# get route for /boats/boat_id/loads, paging through the loads on a boat
+@api.route('/boats/<boat_id>/loads', methods=['GET'])
+@pre_dispatch(jwt=['GET'], accept=['GET'], ids={'boat_id': BOAT_NOT_FOUND}, mimetypes=negotiation.MIMETYPES, cost={'GET': SCAN_COST})
+def get_boat_loads(boat_id):
+  boat = client.get(key=client.key(constants.boats, boat_id))
+
+  # if the boat does not exist or is being deleted, return 404
+  if not boat or boat.get("deleting"):
+    return (jsonify(BOAT_NOT_FOUND), 404)
+
+  # if the boat does not belong to the user making the request, return 403
+  if boat["owner"] != g.userid:
+    return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+
+  # only the fields the client asked for are listed, and only keys are read if they are just ids and self urls
+  try:
+    listed = fields.requested(request.args, LOAD_FIELDS)
+  except ValueError as error:
+    return (jsonify({"Error": str(error)}), 400)
+  query = assignments.carried_loads(client, boat.key)
+  fields.narrow(query, listed, [])
+
+  # get the boat's loads with cursor-based pagination
+  try:
+    results, next_url = fetch_page(query, {"fields": request.args["fields"]} if listed else None)
+  except ValueError:
+    return (jsonify({"Error": "The limit or next_page_token query parameter is invalid"}), 400)
+
+  # add id and self representation for each load and its carrier
+  for load in results:
+    if "carrier" in load:
+      load["carrier"]["self"] = request.url_root + "boats/" + load["carrier"]["id"]
+      load["carrier"]["id"] = int(load["carrier"]["id"])
+    load["id"] = load.key.id
+    load["self"] = request.url_root + "loads/" + str(load.key.id)
+
+  # create response with the loads, and the next url if there are more
+  response = {"loads": [fields.select(load, listed) for load in results]}
+  if next_url:
+    response["next"] = next_url
+  return (negotiation.respond(response), 200)
+
+# bulk put and delete routes for /boats/boat_id/loads, assigning or removing a list of loads in one request
+# the request body is {"loads": [load_id, ...]} and the response has a status for each load
+@api.route('/boats/<boat_id>/loads', methods=['PUT', 'DELETE'])
+@pre_dispatch(accept=['PUT', 'DELETE'], ids={'boat_id': BOAT_NOT_FOUND}, cost={'PUT': BATCH_COST, 'DELETE': BATCH_COST})
+def bulk_boats_and_loads(boat_id):
+  content = request.get_json(silent=True)
+
+  # if the request does not provide a list of integer load ids, return 400
+  if not isinstance(content, dict) or not isinstance(content.get("loads"), list) or not all(is_id(load_id) for load_id in content["loads"]):
+    return (jsonify({"Error": "The request object must provide a list of load ids"}), 400)
+
+  boat_key = client.key(constants.boats, boat_id)
+  if request.method == 'PUT':
+    statuses = assignments.assign(client, boat_key, content["loads"])
+  else:
+    statuses = assignments.unassign(client, boat_key, content["loads"])
+
+  # if the boat does not exist or is being deleted, return 404
+  if any(status == assignments.BOAT_NOT_FOUND for status in statuses.values()):
+    return (jsonify(BOAT_NOT_FOUND), 404)
+
+  # return the status of each load
+  results = [{"id": load_id, "status": status} for load_id, status in statuses.items()]
+  return (jsonify({"loads": results}), 200)
+
+# the items of a batch request object, {kind: [item, ...]}, or None if it isn't one or has too many items
+def batch_items(kind):
+  content = request.get_json(silent=True)
+  if not isinstance(content, dict) or not isinstance(content.get(kind), list) or len(content[kind]) > batches.MAX_ITEMS:
+    return None
+  return content[kind]
+
+def batch_error(kind):
+  return {"Error": "The request object must provide a list of at most " + str(batches.MAX_ITEMS) + " " + kind}
+
+# result of one item of a batch
+def batch_result(kind, status, entity_id=None, error=None):
+  result = {"status": status}
+  if entity_id is not None:
+    result["id"] = entity_id
+    result["self"] = request.url_root + kind + "/" + str(entity_id)
+  if error is not None:
+    result["Error"] = error["Error"]
+  return result
+
+# create the valid items of a batch with the same rules as a single create, and return a result for each item
+#   properties: builds the properties of a new entity from a valid item
+#   counted: names of the counters the new entities are added to
+def batch_create(kind, items, attributes, properties, counted):
+  errors = [creation_error(item, attributes) for item in items]
+  created = iter(batches.create(client, kind, [properties(item) for item, error in zip(items, errors) if not error]))
+  results = [batch_result(kind, batches.INVALID, error=error) if error else batch_result(kind, batches.CREATED, next(created).key.id) for error in errors]
+  total = errors.count(None)
+  if total:
+    counters.increment(client, counted, total)
+  return results
+
+# update the entities named by the items of a batch, {"id": id, attribute: value, ...}, with the same rules as a single patch
+# entities owned by another user than owner, when given, are left alone
+# returns a result for each item, and the index, changes and entity of each item updated
+def batch_update(kind, items, attributes, owner=None):
+  results = [None] * len(items)
+  changes = {}
+  for index, item in enumerate(items):
+    if not isinstance(item, dict) or not is_id(item.get("id")) or item["id"] in changes:
+      results[index] = batch_result(kind, batches.INVALID, error={"Error": "The item must have an integer id, not repeated in the batch"})
+      continue
+    content = {name: value for name, value in item.items() if name != "id"}
+    error = patch_error(content)
+    if error:
+      results[index] = batch_result(kind, batches.INVALID, item["id"], error)
+    else:
+      changes[item["id"]] = (index, content)
+
+  # the entities are read, changed and put a transaction-sized chunk at a time, as save() does for a single entity
+  updated = []
+  for chunk in batches.chunks(list(changes.items()), constants.max_mutations):
+    for entity_id, status, entity in transactions.run_in_transaction(client, update_chunk, kind, chunk, attributes, owner):
+      index, content = changes[entity_id]
+      results[index] = batch_result(kind, status, entity_id)
+      if entity is not None:
+        updated.append((index, content, entity))
+  return results, updated
+
+# read and update the entities of a chunk of a batch update, given as (id, (index, content)) pairs,
+# and return the id, status and updated entity of each, or None for those not updated
+def update_chunk(kind, chunk, attributes, owner):
+  found = {entity.key.id: entity for entity in client.get_multi([client.key(kind, entity_id) for entity_id, _ in chunk])}
+  outcomes = []
+  written = []
+  for entity_id, (_, content) in chunk:
+    entity = found.get(entity_id)
+    if entity is None or entity.get("deleting"):
+      outcomes.append((entity_id, batches.NOT_FOUND, None))
+    elif owner is not None and entity["owner"] != owner:
+      outcomes.append((entity_id, batches.FORBIDDEN, None))
+    else:
+      if kind == constants.loads:
+        update_load(entity, content)
+      else:
+        apply_patch(entity, content, attributes)
+      written.append(entity)
+      outcomes.append((entity_id, batches.UPDATED, entity))
+  if written:
+    client.put_multi(written)
+  return outcomes
+
+# the ids of a batch delete, in order, with an error result for each item that is not an integer id
+def batch_delete_ids(kind, items):
+  results = [None] * len(items)
+  ids = {}
+  for index, item in enumerate(items):
+    if is_id(item) and item not in ids:
+      ids[item] = index
+    else:
+      results[index] = batch_result(kind, batches.INVALID, error={"Error": "The item must be an integer id, not repeated in the batch"})
+  return results, ids
+
+# batch routes for /loads, creating, updating or deleting many loads in one request
+# the request object is {"loads": [item, ...]}, and the response has a result for each item, in order
+@api.route('/loads:batchCreate', methods=['POST'])
+@pre_dispatch(accept=['POST'], cost={'POST': BATCH_COST})
+def batch_create_loads():
+  items = batch_items("loads")
+  if items is None:
+    return (jsonify(batch_error("loads")), 400)
+  results = batch_create(constants.loads, items, LOAD_ATTRIBUTES, load_properties, [constants.loads])
+  return (jsonify({"loads": results}), 200)
+
+@api.route('/loads:batchUpdate', methods=['PATCH'])
+@pre_dispatch(accept=['PATCH'], cost={'PATCH': BATCH_COST})
+def batch_update_loads():
+  items = batch_items("loads")
+  if items is None:
+    return (jsonify(batch_error("loads")), 400)
+  results, _ = batch_update(constants.loads, items, LOAD_ATTRIBUTES)
+  return (jsonify({"loads": results}), 200)
+
+# the items are load ids; loads on a boat are removed from it
+@api.route('/loads:batchDelete', methods=['POST'])
+@pre_dispatch(accept=['POST'], cost={'POST': BATCH_COST})
+def batch_delete_loads():
+  items = batch_items("loads")
+  if items is None:
+    return (jsonify(batch_error("loads")), 400)
+  results, ids = batch_delete_ids(constants.loads, items)
+  deleted = {load_key.id for load_key in batches.delete_loads(client, [client.key(constants.loads, load_id) for load_id in ids])}
+  for load_id, index in ids.items():
+    results[index] = batch_result(constants.loads, batches.DELETED if load_id in deleted else batches.NOT_FOUND, load_id)
+  if deleted:
+    counters.increment(client, [constants.loads], -len(deleted))
+  return (jsonify({"loads": results}), 200)
+
+# batch routes for /boats, on the boats of the user making the request
+# the request object is {"boats": [item, ...]}, and the response has a result for each item, in order
+@api.route('/boats:batchCreate', methods=['POST'])
+@pre_dispatch(jwt=['POST'], accept=['POST'], cost={'POST': BATCH_COST})
+def batch_create_boats():
+  items = batch_items("boats")
+  if items is None:
+    return (jsonify(batch_error("boats")), 400)
+  userid = g.userid
+  results = batch_create(constants.boats, items, BOAT_ATTRIBUTES, lambda item: boat_properties(item, userid),
+    [constants.boats, counters.owner_name(constants.boats, userid)])
+  return (jsonify({"boats": results}), 200)
+
+@api.route('/boats:batchUpdate', methods=['PATCH'])
+@pre_dispatch(jwt=['PATCH'], accept=['PATCH'], cost={'PATCH': BATCH_COST})
+def batch_update_boats():
+  items = batch_items("boats")
+  if items is None:
+    return (jsonify(batch_error("boats")), 400)
+  results, updated = batch_update(constants.boats, items, BOAT_ATTRIBUTES, g.userid)
+
+  # rename the carrier of the loads of boats whose name was set, as PATCH /boats/boat_id does,
+  # linking the progress of the renames that continue in the background
+  for index, content, boat in updated:
+    if "name" in content:
+      rename_loads(boat)
+      if "rename" in boat:
+        results[index]["rename"] = boat["rename"]
+  return (jsonify({"boats": results}), 200)
+
+# the items are boat ids; each boat is deleted as by DELETE /boats/boat_id, clearing it as its loads' carrier
+@api.route('/boats:batchDelete', methods=['POST'])
+@pre_dispatch(jwt=['POST'], accept=['POST'], cost={'POST': BATCH_COST})
+def batch_delete_boats():
+  items = batch_items("boats")
+  if items is None:
+    return (jsonify(batch_error("boats")), 400)
+  results, ids = batch_delete_ids(constants.boats, items)
+  found = batches.get_by_ids(client, constants.boats, list(ids))
+  for boat_id, index in ids.items():
+    boat = found.get(boat_id)
+    if boat is None or boat.get("deleting"):
+      results[index] = batch_result(constants.boats, batches.NOT_FOUND, boat_id)
+    elif boat["owner"] != g.userid:
+      results[index] = batch_result(constants.boats, batches.FORBIDDEN, boat_id)
+    else:
+      tasks.delete_boat(client, boat)
+      results[index] = batch_result(constants.boats, batches.DELETED, boat_id)
+  return (jsonify({"boats": results}), 200)
+
+# plan route, packing loads into the user's boats by volume and assigning them as planned
+# the request object may give "loads", the ids of the loads to plan, all unassigned loads unless given,
+# "boats", the ids of the boats to fill, all of the user's boats unless given, and "apply": false to only plan
+# each boat in the response lists the room it had and the loads planned onto it, and loads left out are listed with the reason
+# at most plans.MAX_LOADS unassigned loads are planned at once, and "truncated" is set if more were left for another plan
+@api.route('/plans', methods=['POST'])
+@pre_dispatch(jwt=['POST'], accept=['POST'], mimetypes=negotiation.MIMETYPES, cost={'POST': BATCH_COST})
+def post_plans():
+  content = request.get_json(silent=True)
+  if content is None:
+    content = {}
+
+  # if the request object doesn't give the loads, boats and apply flag as expected, return 400
+  def ids_error(name, limit):
+    values = content.get(name)
+    return values is not None and (not isinstance(values, list) or len(values) > limit or not all(is_id(value) for value in values))
+  if (not isinstance(content, dict) or ids_error("loads", plans.MAX_LOADS) or ids_error("boats", plans.MAX_BOATS)
+      or not isinstance(content.get("apply", True), bool)):
+    return (jsonify({"Error": "The request object may only provide lists of at most " + str(plans.MAX_LOADS) + " load ids and " +
+      str(plans.MAX_BOATS) + " boat ids, and whether to apply the plan"}), 400)
+
+  # the boats to fill, which must be the user's
+  if content.get("boats") is not None:
+    boat_ids = list(dict.fromkeys(content["boats"]))
+    found = batches.get_by_ids(client, constants.boats, boat_ids)
+    boats = [found.get(boat_id) for boat_id in boat_ids]
+    if any(boat is None or boat.get("deleting") for boat in boats):
+      return (jsonify(BOAT_NOT_FOUND), 404)
+    if any(boat["owner"] != g.userid for boat in boats):
+      return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+  else:
+    query = client.query(kind=constants.boats)
+    query.add_filter("owner", "=", g.userid)
+    boats = [boat for boat in query.fetch(limit=plans.MAX_BOATS) if not boat.get("deleting")]
+
+  # the loads to plan, and the statuses of listed loads that can't be
+  truncated = False
+  if content.get("loads") is not None:
+    loads, statuses = plans.listed_loads(client, list(dict.fromkeys(content["loads"])))
+  else:
+    (loads, truncated), statuses = plans.unassigned_loads(client), {}
+
+  # pack the loads, and assign them unless the client only asked for the plan
+  room = plans.capacities(client, boats)
+  packed, unplaced = plans.plan(loads, room)
+  statuses.update(unplaced)
+  if content.get("apply", True):
+    failed = plans.apply(client, boats, room, packed)
+    statuses.update(failed)
+    packed = [[load_id for load_id in load_ids if load_id not in failed] for load_ids in packed]
+
+  response = {
+    "boats": [{"id": boat.key.id, "self": request.url_root + "boats/" + str(boat.key.id), "room": boat_room, "loads": load_ids}
+      for boat, boat_room, load_ids in zip(boats, room, packed)],
+    "unplaced": [{"id": load_id, "status": status} for load_id, status in statuses.items()],
+    "planned": sum(len(load_ids) for load_ids in packed),
+    "applied": content.get("apply", True)
+  }
+  if truncated:
+    response["truncated"] = True
+  return (negotiation.respond(response), 200)
+
+# most changes returned on one page of the change feed
+MAX_CHANGES = 1000
+
+# a change of the change feed, with the representation of the created or modified boat or load
+# a boat being deleted is reported as deleted already
+def represent_change(entity):
+  if entity.key.kind == constants.tombstones:
+    return {"kind": entity["kind"], "id": entity["id"], "change": changes.DELETED, "updated": entity["updated"]}
+  change = {"kind": entity.key.kind, "id": entity.key.id, "updated": entity["updated"]}
+  represented = represent_listed_boat(entity) if entity.key.kind == constants.boats else represent_listed_load(entity)
+  if represented is None:
+    change["change"] = changes.DELETED
+  else:
+    change["change"] = changes.CREATED if versions.version_of(entity) == 1 else changes.MODIFIED
+    change["entity"] = represented
+  return change
+
+# get route for /changes, the user's boats and the loads created, modified or deleted since the since token
+# with no token, the feed starts from the beginning; every response has the token to poll with next,
+# and the next url while more changes are ready
+@api.route('/changes', methods=['GET'])
+@pre_dispatch(jwt=['GET'], accept=['GET'], cost={'GET': SCAN_COST})
+def get_changes():
+  try:
+    positions, issued = changes.decode_token(request.args.get('since'))
+    limit = int(request.args.get('limit', '100'))
+    if limit < 1 or limit > MAX_CHANGES:
+      raise ValueError("limit out of range")
+  except ValueError:
+    return (jsonify({"Error": "The limit or since query parameter is invalid"}), 400)
+  except changes.Expired:
+    return (jsonify({"Error": "The since token has expired, read the collections again and start over"}), 410)
+
+  found, positions, more, horizon = changes.page(client, g.userid, positions, limit)
+
+  # a token covers everything up to the horizon only once the client has read every page before it
+  token = changes.encode_token(positions, issued if more and issued else horizon)
+  response = {"changes": [represent_change(entity) for _, entity in found], "next_token": token}
+  if more:
+    response["next"] = request.base_url + "?" + urlencode({"since": token, "limit": limit})
+  return (jsonify(response), 200)
+
+# cron route restarting boat deletions that were interrupted before they finished
+@api.route('/tasks/resume-deletes', methods=['GET'])
+@cron_only
+def resume_deletes():
+  resumed = tasks.resume_deletes(client)
+  return (jsonify({"resumed": resumed}), 200)
+
+# get route for /boats/boat_id/rename, the progress of copying the boat's new name to its loads in the background
+@api.route('/boats/<boat_id>/rename', methods=['GET'])
+@pre_dispatch(jwt=['GET'], accept=['GET'], ids={'boat_id': BOAT_NOT_FOUND})
+def get_boat_rename(boat_id):
+  boat_key = client.key(constants.boats, boat_id)
+  boat = client.get(key=boat_key)
+
+  # if the boat does not exist or is being deleted, return 404
+  if not boat or boat.get("deleting"):
+    return (jsonify(BOAT_NOT_FOUND), 404)
+
+  # if the boat does not belong to the user making the request, return 403
+  if boat["owner"] != g.userid:
+    return (jsonify({"Error": "The user making the request does not have access to this resource"}), 403)
+
+  # if the boat was never renamed in the background, return 404
+  job = tasks.rename_job(client, boat_key)
+  if job is None:
+    return (jsonify({"Error": "No rename of this boat has run in the background"}), 404)
+
+  response = dict(job)
+  response["self"] = request.base_url
+  return (jsonify(response), 200)
+
+# cron route restarting renames of boats with many loads that were interrupted before they finished
+@api.route('/tasks/resume-renames', methods=['GET'])
+@cron_only
+def resume_renames():
+  resumed = tasks.resume_renames(client)
+  return (jsonify({"resumed": resumed}), 200)
+
+# cron route purging tombstones older than the change feed keeps them
+@api.route('/tasks/purge-tombstones', methods=['GET'])
+@cron_only
+def purge_tombstones():
+  purged = changes.purge_tombstones(client)
+  return (jsonify({"purged": purged}), 200)
 
 # Return 405 for requests not implemented herein, therefore not allowed
 # reference: https://flask.palletsprojects.com/en/2.0.x/errorhandling/#error-handlers
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(e):
   return (jsonify({"Error": "Method Not Allowed"}), 405)
 
+# a conditional write found the entity changed since the version in the If-Match header
+@api.app_errorhandler(versions.Modified)
+def modified(e):
+  return (jsonify(PRECONDITION_FAILED), 412)
+
+# warmup route, which App Engine requests on a new instance before sending it traffic,
+# building the storage client and fetching Google's signing keys so the first real request doesn't wait for them
+# reference: https://cloud.google.com/appengine/docs/standard/python3/configuring-warmup-requests
+@api.route('/_ah/warmup', methods=['GET'])
+def warmup():
+  config()
+  get_verifier().warm()
+  client.build()
+  client.get(client.key(constants.users, "warmup"))
+  return ('', 200)
+
+# build the flask app serving the routes, instrumented to time each request's phases and storage use,
+# which it serves on /metrics along with the entity cache's hit rate
+# response bodies are compressed for clients that accept it
+def create_app():
+  app = Flask(__name__)
+  app.register_blueprint(api)
+  metrics.init_app(app, client)
+  negotiation.init_app(app)
+  metrics.registry.describe("entity_cache", "gauge", "Lookups, evictions and size of the entity cache.")
+  metrics.registry.collect(lambda: {("entity_cache", (("stat", name),)): value for name, value in client.stats().items()})
+  return app
+
+# the app App Engine serves, as main:app
+app = create_app()
+
 if __name__ == '__main__':
   app.run(host='127.0.0.1', port=8080, debug=True)
\ No newline at end of file
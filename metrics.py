@@ -0,0 +1,165 @@
+from flask import g, has_request_context, request, Response
+import bisect
+import contextlib
+import flask
+import os
+import threading
+import time
+
+# request instrumentation: per-phase timings, storage round trips and entities read per request,
+# exported as Prometheus histograms and counters on /metrics, and optionally as a Server-Timing header
+
+# latency buckets in seconds, and buckets for round trips and entities per request
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000]
+
+# phases of a request, in the order they appear in the Server-Timing header
+PHASES = ["auth", "accept", "storage_read", "storage_write", "serialize", "compress"]
+
+class Histogram:
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+# metrics keyed by name and label values, guarded by one lock taken once per request
+class Registry:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.histograms = {}
+    self.counters = {}
+    self.collectors = []
+    self.help = {}
+
+  def describe(self, name, kind, text):
+    self.help[name] = (kind, text)
+
+  def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+    key = (name, labels)
+    histogram = self.histograms.get(key)
+    if histogram is None:
+      histogram = self.histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+  def increment(self, name, labels, value=1):
+    key = (name, labels)
+    self.counters[key] = self.counters.get(key, 0) + value
+
+  # add a function returning current values, as a dict of (name, labels) to value, read on every render
+  def collect(self, collector):
+    self.collectors.append(collector)
+
+  # render every metric in the Prometheus text exposition format
+  def render(self):
+    lines = []
+    collected = {}
+    for collector in self.collectors:
+      collected.update(collector())
+    with self.lock:
+      values = {**self.counters, **collected}
+      names = sorted({name for name, _ in self.histograms} | {name for name, _ in values})
+      for name in names:
+        kind, text = self.help.get(name, ("untyped", name))
+        lines.append("# HELP " + name + " " + text)
+        lines.append("# TYPE " + name + " " + kind)
+        for (metric, labels), value in sorted(values.items()):
+          if metric == name:
+            lines.append(name + format_labels(labels) + " " + format_value(value))
+        for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+          if metric != name:
+            continue
+          cumulative = 0
+          for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+            cumulative += count
+            lines.append(name + "_bucket" + format_labels(labels + (("le", format_value(bound)),)) + " " + str(cumulative))
+          lines.append(name + "_sum" + format_labels(labels) + " " + format_value(histogram.sum))
+          lines.append(name + "_count" + format_labels(labels) + " " + str(histogram.count))
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+  if not labels:
+    return ""
+  escaped = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in labels]
+  return "{" + ",".join(escaped) + "}"
+
+def format_value(value):
+  if isinstance(value, str):
+    return value
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+registry = Registry()
+registry.describe("http_requests_total", "counter", "Requests handled, by route, method and status.")
+registry.describe("http_request_duration_seconds", "histogram", "Time to handle a request, by route and method.")
+registry.describe("http_request_phase_seconds", "histogram", "Time spent in each phase of a request, by route and phase.")
+registry.describe("storage_rpcs_per_request", "histogram", "Storage round trips made by a request, by route.")
+registry.describe("storage_entities_read_per_request", "histogram", "Entities read from storage by a request, by route.")
+registry.describe("storage_rpcs_total", "counter", "Storage round trips, by route and rpc.")
+
+# time the block as part of a phase of the current request; does nothing outside a request
+@contextlib.contextmanager
+def phase(name):
+  if not has_request_context() or "metrics_phases" not in g:
+    yield
+    return
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    g.metrics_phases[name] = g.metrics_phases.get(name, 0.0) + time.perf_counter() - start
+
+# flask.jsonify, timed as the serialize phase
+def jsonify(*args, **kwargs):
+  with phase("serialize"):
+    return flask.jsonify(*args, **kwargs)
+
+# instrument every request of app, taking storage counts from a storage.CountingClient
+# the Server-Timing header is added when server_timing is set or the SERVER_TIMING environment variable is 1
+def init_app(app, client, server_timing=None):
+  if server_timing is None:
+    server_timing = os.environ.get("SERVER_TIMING") == "1"
+
+  @app.before_request
+  def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_phases = {}
+    g.metrics_counts = client.snapshot()
+
+  @app.after_request
+  def finish_request(response):
+    if "metrics_start" not in g:
+      return response
+    total = time.perf_counter() - g.metrics_start
+    counts = client.since(g.metrics_counts)
+    phases = g.metrics_phases
+    phases["storage_read"] = counts["read_seconds"]
+    phases["storage_write"] = counts["write_seconds"]
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    rpcs = sum(counts["rpcs"].values())
+    with registry.lock:
+      registry.increment("http_requests_total", (("route", route), ("method", request.method), ("status", str(response.status_code))))
+      registry.observe("http_request_duration_seconds", (("route", route), ("method", request.method)), total)
+      for name in PHASES:
+        if name in phases:
+          registry.observe("http_request_phase_seconds", (("route", route), ("phase", name)), phases[name])
+      registry.observe("storage_rpcs_per_request", (("route", route),), rpcs, COUNT_BUCKETS)
+      registry.observe("storage_entities_read_per_request", (("route", route),), counts["entities_read"], COUNT_BUCKETS)
+      for rpc, count in counts["rpcs"].items():
+        registry.increment("storage_rpcs_total", (("route", route), ("rpc", rpc)), count)
+
+    if server_timing:
+      entries = [name.replace("_", "-") + ";dur=" + "%.3f" % (phases[name] * 1000) for name in PHASES if name in phases]
+      entries.append("total;dur=" + "%.3f" % (total * 1000))
+      response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+  # expose the metrics in the Prometheus text format
+  @app.route('/metrics', methods=['GET'])
+  def get_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,76 @@
+from google.cloud import datastore
+import constants
+import filters
+
+# re-key users created with auto-allocated ids by their 'sub' value, which the oauth route now uses as the key
+# duplicates left by concurrent logins collapse into one entity; safe to run more than once
+def migrate_users(client):
+  query = client.query(kind=constants.users)
+  migrated = {}
+  old_keys = []
+  for user in query.fetch():
+    if user.key.id is None:
+      continue
+    new_user = datastore.entity.Entity(key=client.key(constants.users, user["id"]))
+    new_user.update({"id": user["id"]})
+    migrated[user["id"]] = new_user
+    old_keys.append(user.key)
+
+  # write the re-keyed users before deleting the old entities, so no user is ever missing
+  new_users = list(migrated.values())
+  for start in range(0, len(new_users), constants.max_mutations):
+    client.put_multi(new_users[start:start + constants.max_mutations])
+  for start in range(0, len(old_keys), constants.max_mutations):
+    client.delete_multi(old_keys[start:start + constants.max_mutations])
+  return len(old_keys)
+
+# drop the loads list embedded in boats, now that a boat's loads are found by querying the loads' carrier
+# every load on a boat already names it as carrier, so nothing else changes; safe to run more than once
+def strip_boat_loads(client):
+  query = client.query(kind=constants.boats)
+  stripped = []
+  for boat in query.fetch():
+    if "loads" in boat:
+      del boat["loads"]
+      stripped.append(boat)
+  for start in range(0, len(stripped), constants.max_mutations):
+    client.put_multi(stripped[start:start + constants.max_mutations])
+  return len(stripped)
+
+# stamp boats and loads written before the change feed with update sequence 0, so a feed read from the start has them
+# safe to run more than once
+def stamp_updated(client):
+  stamped = []
+  for kind in (constants.boats, constants.loads):
+    query = client.query(kind=kind)
+    for entity in query.fetch():
+      if "updated" not in entity:
+        entity["updated"] = 0
+        stamped.append(entity)
+  for start in range(0, len(stamped), constants.max_mutations):
+    client.put_multi(stamped[start:start + constants.max_mutations])
+  return len(stamped)
+
+# stamp loads written before GET /loads could filter by creation date with the day of their creation date
+# safe to run more than once
+def stamp_created_on(client):
+  query = client.query(kind=constants.loads)
+  stamped = []
+  for load in query.fetch():
+    if "created_on" not in load:
+      filters.stamp(load)
+      stamped.append(load)
+  for start in range(0, len(stamped), constants.max_mutations):
+    client.put_multi(stamped[start:start + constants.max_mutations])
+  return len(stamped)
+
+if __name__ == '__main__':
+  client = datastore.Client()
+  migrated = migrate_users(client)
+  print("Migrated " + str(migrated) + " users")
+  stripped = strip_boat_loads(client)
+  print("Removed the loads list of " + str(stripped) + " boats")
+  stamped = stamp_updated(client)
+  print("Stamped " + str(stamped) + " boats and loads for the change feed")
+  dated = stamp_created_on(client)
+  print("Stamped " + str(dated) + " loads with their day of creation")
@@ -0,0 +1,74 @@
+from flask import request
+import flask
+import gzip
+import metrics
+
+# content negotiation beyond JSON: a MessagePack representation of collections for clients that ask for one,
+# and gzip or brotli compression of response bodies for clients that accept it
+# msgpack and brotli are optional; without them the app serves JSON only, and compresses with gzip only
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+MSGPACK = "application/msgpack"
+
+# media types the collection routes can answer with, JSON first so it wins when the client doesn't prefer one
+MIMETYPES = ("application/json", MSGPACK) if msgpack is not None else ("application/json",)
+
+# content codings offered, best first, and the bodies too small to be worth compressing
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+MIN_COMPRESS_SIZE = 1024
+
+# levels that keep compression cheap next to serialization; higher levels save a few percent more for several times the CPU
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# whether the request prefers MessagePack to JSON
+def wants_msgpack():
+  return msgpack is not None and request.accept_mimetypes.best_match(MIMETYPES) == MSGPACK
+
+# a response with the value as JSON, or as MessagePack if the client prefers it, timed as the serialization phase
+def respond(value):
+  if wants_msgpack():
+    with metrics.phase("serialize"):
+      response = flask.Response(msgpack.packb(value), mimetype=MSGPACK)
+  else:
+    response = metrics.jsonify(value)
+  if msgpack is not None:
+    response.vary.add("Accept")
+  return response
+
+# the best content coding the request accepts, or None
+def accepted_encoding():
+  encoding = request.accept_encodings.best_match(ENCODINGS)
+  return encoding if encoding and request.accept_encodings[encoding] else None
+
+def compress(data, encoding):
+  if encoding == "br":
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+  return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+# compress the bodies of the app's responses for clients that accept it, timed as the compress phase
+# streamed responses, like NDJSON exports, compress themselves as they go, and responses with an ETag are left
+# alone, as a compressed body would need an ETag of its own; they are single entities, below the size worth it anyway
+def init_app(app):
+  @app.after_request
+  def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200 or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers or "ETag" in response.headers):
+      return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    encoding = accepted_encoding()
+    if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+      return response
+    with metrics.phase("compress"):
+      response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,62 @@
+import os
+import threading
+
+# one HTTP session shared by every outbound call the app makes to Google, the OAuth token exchange and the
+# certificate fetches, so they reuse keep-alive connections instead of opening a TCP and TLS connection each
+# requests sessions are safe to share between threads for plain calls like these: urllib3's pools are locked,
+# and the session keeps no cookies, so nothing one caller receives leaks into another's request
+
+# connection pools kept, one per host, and connections kept per pool, which should cover the server's threads
+# overridable with the OUTBOUND_POOLS and OUTBOUND_POOL_SIZE environment variables
+DEFAULT_POOLS = 4
+DEFAULT_POOL_SIZE = 16
+
+# seconds to wait for a connection, and for each read of a response, unless a call passes its own timeout
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+# retries of a failed call, waiting 0.25s, 0.5s, ... between them
+# GETs are retried on connection errors, read errors and these statuses; POSTs only when the connection
+# could not be made, since the token exchange spends its authorization code once the request is sent
+RETRIES = 3
+BACKOFF_FACTOR = 0.25
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+session_lock = threading.Lock()
+shared_session = None
+
+# build a session with sized pools, retries and default timeouts
+# requests is only imported here, so the app doesn't import it until it first calls out
+def build_session(pools=DEFAULT_POOLS, pool_size=DEFAULT_POOL_SIZE):
+  from http import cookiejar
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+  import requests
+
+  class Session(requests.Session):
+    def request(self, method, url, **kwargs):
+      kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+      return super().request(method, url, **kwargs)
+
+  retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+    allowed_methods=frozenset(["GET", "HEAD"]), raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pools, pool_maxsize=pool_size, max_retries=retry)
+  session = Session()
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+  return session
+
+# the session shared by the app, built on first use
+def session():
+  global shared_session
+  with session_lock:
+    if shared_session is None:
+      shared_session = build_session(int(os.environ.get("OUTBOUND_POOLS", DEFAULT_POOLS)),
+        int(os.environ.get("OUTBOUND_POOL_SIZE", DEFAULT_POOL_SIZE)))
+    return shared_session
+
+# google-auth transport over the shared session, for fetching Google's signing certificates
+def google_transport():
+  import google.auth.transport.requests
+  return google.auth.transport.requests.Request(session=session())
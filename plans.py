@@ -0,0 +1,179 @@
+import assignments
+import batches
+import constants
+import transactions
+import versions
+
+# planning which boats carry which loads: loads are packed into boats by volume with first-fit decreasing,
+# each load going to the first boat with room left, largest loads first, and the plan is applied in chunked
+# transactions like bulk assignment, so a load assigned meanwhile is reported rather than moved
+# a boat's length is its capacity, in the same units as load volumes, less the volume of the loads it carries
+# the room of a boat is checked again in each transaction, so plans and single assignments made at the same time
+# can't overfill it; only a load's volume edited after it was assigned can
+
+# loads and boats one plan can take
+MAX_LOADS = 100000
+MAX_BOATS = 1000
+
+# outcomes of loads left out of a plan, besides assignments.LOAD_NOT_FOUND, ALREADY_ASSIGNED and BOAT_NOT_FOUND
+INVALID_VOLUME = "invalid_volume"
+NO_CAPACITY = "no_capacity"
+# the boat kept changing while its loads were assigned, so they were left for another plan
+BOAT_BUSY = "boat_busy"
+
+# a volume or length the planner can use: a non-negative number, or None
+def measure(value):
+  if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+    return None
+  return value
+
+# the volume of the loads a boat carries, read with a projection served by the (carrier.id, volume) index in index.yaml
+def carried_volume(client, boat_key):
+  query = assignments.carried_loads(client, boat_key)
+  query.projection = ["volume"]
+  return sum(measure(load.get("volume")) or 0 for load in query.fetch())
+
+# room left on a boat, which must have been read before its loads are queried, so that a load assigned
+# in between changes the boat's version
+def capacity(client, boat):
+  return max(0, (measure(boat.get("length")) or 0) - carried_volume(client, boat.key))
+
+# room left on each boat, in order
+def capacities(client, boats):
+  return [capacity(client, boat) for boat in boats]
+
+# the ids and volumes of up to limit unassigned loads, and whether there are more
+# only keys and volumes are read, with a projection served by the (carrier, volume) index in index.yaml
+def unassigned_loads(client, limit=MAX_LOADS):
+  query = client.query(kind=constants.loads)
+  query.add_filter("carrier", "=", None)
+  query.projection = ["volume"]
+  loads = list(query.fetch(limit=limit + 1))
+  return [(load.key.id, load.get("volume")) for load in loads[:limit]], len(loads) > limit
+
+# the ids and volumes of the loads with the given ids that are still unassigned,
+# and the statuses of the others, by id
+def listed_loads(client, load_ids):
+  found = batches.get_by_ids(client, constants.loads, load_ids)
+  loads = []
+  statuses = {}
+  for load_id in load_ids:
+    load = found.get(load_id)
+    if load is None:
+      statuses[load_id] = assignments.LOAD_NOT_FOUND
+    elif load["carrier"] is not None:
+      statuses[load_id] = assignments.ALREADY_ASSIGNED
+    else:
+      loads.append((load_id, load.get("volume")))
+  return loads, statuses
+
+# the index of the boat each load is packed into, or -1 for loads that fit in none, by first-fit decreasing
+# the loads are taken largest first, and each boat a load could go in is found with one vectorized comparison
+# over the room left on every boat, so a plan costs one pass over the loads
+# numpy is only imported here, so it stays off the import path of the app
+def first_fit_decreasing(volumes, room):
+  import numpy
+
+  volumes = numpy.asarray(volumes, dtype=numpy.float64)
+  room = numpy.array(room, dtype=numpy.float64)
+  placement = numpy.full(len(volumes), -1, dtype=numpy.int64)
+  if not len(room):
+    return placement
+  largest = room.max()
+  for index in numpy.argsort(-volumes, kind="stable").tolist():
+    volume = volumes[index]
+    # loads larger than the room left on any boat are skipped without a comparison
+    if volume > largest:
+      continue
+    boat = int((room >= volume).argmax())
+    was_largest = room[boat] == largest
+    room[boat] -= volume
+    placement[index] = boat
+    if was_largest:
+      largest = room.max()
+  return placement
+
+# pack loads, as (id, volume) pairs, into boats with the given room left
+# returns the ids of the loads packed into each boat, in order, and the statuses of the loads left out, by id
+def plan(loads, room):
+  statuses = {}
+  placeable = []
+  for load_id, volume in loads:
+    if measure(volume) is None:
+      statuses[load_id] = INVALID_VOLUME
+    else:
+      placeable.append((load_id, volume))
+
+  packed = [[] for _ in room]
+  placement = first_fit_decreasing([volume for _, volume in placeable], room)
+  for (load_id, _), boat in zip(placeable, placement.tolist()):
+    if boat < 0:
+      statuses[load_id] = NO_CAPACITY
+    else:
+      packed[boat].append(load_id)
+  return packed, statuses
+
+# assign the loads packed into each boat, which had the given room when the boats were read,
+# and return the statuses of the loads that couldn't be, by id
+def apply(client, boats, room, packed):
+  statuses = {}
+  for boat, boat_room, load_ids in zip(boats, room, packed):
+    if load_ids:
+      statuses.update(fill(client, boat, boat_room, load_ids))
+  return statuses
+
+# assign loads to a boat with the given room, a transaction-sized chunk at a time, and return the statuses
+# of the loads that couldn't be; a chunk finding the boat changed since its room was measured, e.g. given loads
+# by another request, measures it again and is retried, up to transactions.MAX_ATTEMPTS times
+def fill(client, boat, room, load_ids):
+  statuses = {}
+  version = versions.version_of(boat)
+  for start in range(0, len(load_ids), assignments.CHUNK_SIZE):
+    chunk = load_ids[start:start + assignments.CHUNK_SIZE]
+    for _ in range(transactions.MAX_ATTEMPTS):
+      filled = transactions.run_in_transaction(client, fill_chunk, client, boat.key, chunk, version, room)
+      if filled is not None:
+        break
+      boat = client.get(boat.key)
+      if boat is None:
+        filled = {load_id: assignments.BOAT_NOT_FOUND for load_id in chunk}, version, room
+        break
+      version = versions.version_of(boat)
+      room = capacity(client, boat)
+    else:
+      filled = {load_id: BOAT_BUSY for load_id in chunk}, version, room
+    chunk_statuses, version, room = filled
+    statuses.update({load_id: status for load_id, status in chunk_statuses.items() if status != assignments.ASSIGNED})
+  return statuses
+
+# assign the loads that still fit in the room of a boat that still has the given version, in the order planned,
+# and return their statuses, the boat's version after the chunk and its room left,
+# or None if the boat has another version
+def fill_chunk(client, boat_key, load_ids, version, room):
+  boat, loads = assignments.get_boat_and_loads(client, boat_key, load_ids)
+  if boat is None:
+    return {load_id: assignments.BOAT_NOT_FOUND for load_id in load_ids}, version, room
+  if versions.version_of(boat) != version:
+    return None
+
+  statuses = {}
+  updated = []
+  for load_id, load in zip(load_ids, loads):
+    if load is None:
+      statuses[load_id] = assignments.LOAD_NOT_FOUND
+    elif load["carrier"] is not None:
+      statuses[load_id] = assignments.ALREADY_ASSIGNED
+    elif measure(load.get("volume")) is None:
+      statuses[load_id] = INVALID_VOLUME
+    elif load["volume"] > room:
+      statuses[load_id] = NO_CAPACITY
+    else:
+      load["carrier"] = {"id": str(boat_key.id), "name": boat["name"]}
+      room -= load["volume"]
+      updated.append(load)
+      statuses[load_id] = assignments.ASSIGNED
+
+  # writing the boat bumps its version, which the next chunk expects
+  if updated:
+    client.put_multi([boat] + updated)
+  return statuses, versions.version_of(boat), room
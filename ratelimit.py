@@ -0,0 +1,147 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# admission control: token buckets limiting how much each client can ask of the app, and a cap on the requests
+# served at once that sheds load before requests queue up behind a saturated instance
+# each client, keyed by its JWT 'sub' or else its IP address, has a bucket refilled at rate tokens per second
+# up to burst tokens, and each request takes its route's cost from it, so scans and batches are charged more
+
+# bucket sizes, overridable with the RATE_LIMIT_RATE, RATE_LIMIT_BURST and MAX_IN_FLIGHT environment variables
+DEFAULT_RATE = 10
+DEFAULT_BURST = 60
+DEFAULT_MAX_IN_FLIGHT = 40
+
+# buckets kept by the in-process backend; the least recently used are dropped, and start full again if they return
+DEFAULT_MAX_KEYS = 100000
+
+# attempts at a compare-and-set of a shared bucket before the request is let through, rather than failing
+# or waiting on a bucket that other instances are writing
+MAX_CAS_ATTEMPTS = 3
+
+# take cost tokens from a bucket holding tokens as of updated, refilled since at rate up to burst
+# returns the tokens left and 0, or the tokens as of now and the seconds until cost tokens will be there
+def take(tokens, updated, cost, rate, burst, now):
+  tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+  if tokens >= cost:
+    return tokens - cost, 0.0
+  return tokens, (cost - tokens) / rate
+
+# interface of the bucket backends
+class Backend:
+  # take cost tokens from the bucket of key, and return 0 or the seconds to wait until they'll be there
+  def take(self, key, cost, rate, burst):
+    raise NotImplementedError
+
+# buckets held in this process, each instance limiting its own share of a client's requests
+class LocalBackend(Backend):
+  def __init__(self, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+    self.max_keys = max_keys
+    self.clock = clock
+    self.buckets = OrderedDict()
+    self.lock = threading.Lock()
+
+  def take(self, key, cost, rate, burst):
+    with self.lock:
+      now = self.clock()
+      tokens, updated = self.buckets.get(key, (burst, now))
+      tokens, wait = take(tokens, updated, cost, rate, burst, now)
+      self.buckets[key] = (tokens, now)
+      self.buckets.move_to_end(key)
+      if len(self.buckets) > self.max_keys:
+        self.buckets.popitem(last=False)
+      return wait
+
+# interface of the stores a shared backend keeps buckets in, e.g. memcache's gets and cas, shared by every instance
+# values are strings, and tokens are opaque values a compare_and_set must present to replace what get returned
+class SharedStore:
+  # the value of name and its token, or (None, None) if it has none
+  def get(self, name):
+    raise NotImplementedError
+
+  # set name to value, unless it changed since the get that returned token; returns whether it was set
+  # the value expires after ttl seconds
+  def compare_and_set(self, name, value, token, ttl):
+    raise NotImplementedError
+
+# shared store held in a dict, for local runs and tests
+class DictStore(SharedStore):
+  def __init__(self, clock=time.time):
+    self.clock = clock
+    self.values = {}
+    self.lock = threading.Lock()
+    self.version = 0
+
+  def get(self, name):
+    with self.lock:
+      entry = self.values.get(name)
+      if entry is None or entry[0] <= self.clock():
+        return None, None
+      return entry[2], entry[1]
+
+  def compare_and_set(self, name, value, token, ttl):
+    with self.lock:
+      entry = self.values.get(name)
+      current = entry[1] if entry is not None and entry[0] > self.clock() else None
+      if current != token:
+        return False
+      self.version += 1
+      self.values[name] = (self.clock() + ttl, self.version, value)
+      return True
+
+# buckets kept in a shared store, so a client's requests are limited across every instance
+# buckets are stamped with the wall clock, which the instances share
+class SharedBackend(Backend):
+  def __init__(self, store, clock=time.time):
+    self.store = store
+    self.clock = clock
+
+  def take(self, key, cost, rate, burst):
+    for _ in range(MAX_CAS_ATTEMPTS):
+      value, token = self.store.get(key)
+      now = self.clock()
+      tokens, updated = json.loads(value) if value is not None else (burst, now)
+      tokens, wait = take(tokens, updated, cost, rate, burst, now)
+      # a bucket left alone until it is full again is no different from a missing one, so it can expire then
+      if self.store.compare_and_set(key, json.dumps([tokens, now]), token, math.ceil(burst / rate) + 1):
+        return wait
+    return 0.0
+
+# token bucket limiter over a backend
+class Limiter:
+  def __init__(self, backend, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+    self.backend = backend
+    self.rate = rate
+    self.burst = burst
+
+  # take the cost of a request from the bucket of key, and return 0 to admit it,
+  # or the seconds until the request could be admitted; costs above the burst are charged the whole burst
+  def admit(self, key, cost=1):
+    return self.backend.take(key, min(cost, self.burst), self.rate, self.burst)
+
+# caps the requests being served at once; requests beyond the cap are turned away at once instead of queued
+class ConcurrencyLimit:
+  def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    self.max_in_flight = max_in_flight
+    self.semaphore = threading.BoundedSemaphore(max_in_flight)
+
+  # whether a request can start now; each that can must call release when it is done
+  def acquire(self):
+    return self.semaphore.acquire(blocking=False)
+
+  def release(self):
+    self.semaphore.release()
+
+# the limiter configured from the environment: RATE_LIMIT_RATE and RATE_LIMIT_BURST size the buckets,
+# and RATE_LIMIT_BACKEND=shared keeps them in a dict-backed shared store for local runs
+def limiter():
+  rate = float(os.environ.get("RATE_LIMIT_RATE", DEFAULT_RATE))
+  burst = float(os.environ.get("RATE_LIMIT_BURST", DEFAULT_BURST))
+  backend = SharedBackend(DictStore()) if os.environ.get("RATE_LIMIT_BACKEND") == "shared" else LocalBackend()
+  return Limiter(backend, rate, burst)
+
+def concurrency_limit():
+  return ConcurrencyLimit(int(os.environ.get("MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT)))
@@ -0,0 +1,647 @@
+from google.cloud import datastore
+import base64
+import bisect
+import copy
+import json
+import operator
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# storage backends for the app, chosen with the STORAGE_BACKEND environment variable
+#   datastore (default): google.cloud.datastore.Client
+#   memory: MemoryClient, entities held in process, for local runs and benchmarks
+#   sqlite: SQLiteClient, entities in the file named by STORAGE_PATH, with indexes on owner and carrier
+#
+# every backend offers the part of the datastore client interface that the routes use:
+#   key, get, get_multi, put, put_multi, delete, delete_multi, allocate_ids, transaction and query,
+#   with queries supporting add_filter, keys_only, projection, order and fetch(limit, offset, start_cursor)
+# the local backends use the datastore library's own Key and Entity classes, which need no credentials
+def get_client(backend=None):
+  backend = backend or os.environ.get("STORAGE_BACKEND", "datastore")
+  if backend == "datastore":
+    return datastore.Client()
+  if backend == "memory":
+    return MemoryClient()
+  if backend == "sqlite":
+    return SQLiteClient(os.environ.get("STORAGE_PATH", "boats-and-loads.sqlite3"))
+  raise ValueError("Unknown storage backend " + backend)
+
+# a client built by factory the first time it is used, so building it, e.g. finding datastore credentials,
+# is left out of process startup
+class LazyClient:
+  def __init__(self, factory):
+    self.factory = factory
+    self.client = None
+    self.lock = threading.Lock()
+
+  # build the client now if it wasn't yet, e.g. while warming up an instance, and return it
+  def build(self):
+    if self.client is None:
+      with self.lock:
+        if self.client is None:
+          self.client = self.factory()
+    return self.client
+
+  def __getattr__(self, name):
+    return getattr(self.build(), name)
+
+# properties with an index in the local backends, as the routes look boats up by owner and loads by carrier,
+# the change feed pages through boats, loads and tombstones by update sequence,
+# and GET /loads filters loads by content, volume and day of creation
+INDEXED_PROPERTIES = ["owner", "carrier.id", "updated", "content", "volume", "created_on"]
+
+# entities read per round trip when a query is iterated without a limit
+PAGE_SIZE = 500
+
+# project name given to the keys of the local backends
+LOCAL_PROJECT = "local"
+
+# property names that can be inlined into sqlite json paths
+PROPERTY_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+OPERATORS = {
+  "=": operator.eq,
+  "!=": operator.ne,
+  "<": operator.lt,
+  "<=": operator.le,
+  ">": operator.gt,
+  ">=": operator.ge
+}
+
+# marker for a property an entity does not have, which never matches a filter
+MISSING = object()
+
+# value of a property of an entity, following dots into embedded entities
+def property_value(entity, name):
+  value = entity
+  for part in name.split("."):
+    if not isinstance(value, dict) or part not in value:
+      return MISSING
+    value = value[part]
+  return value
+
+# sortable form of a property value, ordering values of different types the way datastore does
+def value_order(value):
+  if value is None:
+    return (0, 0)
+  if isinstance(value, bool):
+    return (2, value)
+  if isinstance(value, (int, float)):
+    return (1, value)
+  if isinstance(value, str):
+    return (3, value)
+  return (4, json.dumps(value, sort_keys=True, default=str))
+
+# sortable form of a key, with ids ordered before names
+def key_order(key):
+  if key.id is not None:
+    return (0, key.id)
+  return (1, key.name)
+
+# wrapper reversing the order of a value, for descending sort orders
+class Descending:
+  def __init__(self, value):
+    self.value = value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+# position of an entity in a query's sort order: its ordered property values followed by its key
+def sort_position(query, entity):
+  position = []
+  for order in query.order:
+    value = value_order(property_value(entity, order.lstrip("-")))
+    position.append(Descending(value) if order.startswith("-") else value)
+  position.append(key_order(entity.key))
+  return tuple(position)
+
+# a cursor holds the raw ordered values and key of the last entity of a page, so the next page resumes right after it
+def cursor_of(query, entity):
+  values = [property_value(entity, order.lstrip("-")) for order in query.order]
+  return [None if value is MISSING else value for value in values], key_order(entity.key)
+
+def encode_cursor(cursor):
+  values, korder = cursor
+  return base64.urlsafe_b64encode(json.dumps([values, list(korder)]).encode("utf-8"))
+
+# raises ValueError for a token that is not a cursor of this query
+def decode_cursor(query, token):
+  if isinstance(token, str):
+    token = token.encode("utf-8")
+  values, korder = json.loads(base64.urlsafe_b64decode(token))
+  if len(values) != len(query.order) or len(korder) != 2:
+    raise ValueError("Cursor does not match the query")
+  return values, tuple(korder)
+
+def cursor_position(query, values, korder):
+  position = []
+  for order, value in zip(query.order, values):
+    position.append(Descending(value_order(value)) if order.startswith("-") else value_order(value))
+  position.append(korder)
+  return tuple(position)
+
+def matches(entity, filters):
+  for name, op, expected in filters:
+    value = property_value(entity, name)
+    if value is MISSING:
+      return False
+    if not OPERATORS[op](value_order(value), value_order(expected)):
+      return False
+  return True
+
+# copy of an entity restricted to the properties a query projects
+def project(entity, projection):
+  result = datastore.Entity(key=entity.key)
+  if "__key__" not in projection:
+    result.update({name: entity[name] for name in projection if name in entity})
+  return result
+
+# query against a local backend, built up the same way as a datastore query
+class LocalQuery:
+  def __init__(self, client, kind):
+    self.client = client
+    self.kind = kind
+    self.filters = []
+    self.projection = []
+    self.order = []
+
+  def add_filter(self, property_name, op, value):
+    if op not in OPERATORS:
+      raise ValueError("Unsupported filter operator " + op)
+    self.filters.append((property_name, op, value))
+    return self
+
+  def keys_only(self):
+    self.projection = ["__key__"]
+
+  def fetch(self, limit=None, offset=0, start_cursor=None):
+    return LocalIterator(self, limit, offset, start_cursor)
+
+# results of a local query, read a page at a time and exposing the next page's cursor like a datastore iterator
+class LocalIterator:
+  def __init__(self, query, limit, offset, start_cursor):
+    self.query = query
+    self.limit = limit
+    self.offset = offset or 0
+    self.start_cursor = start_cursor
+    self.next_page_token = None
+
+  @property
+  def pages(self):
+    query = self.query
+    cursor = decode_cursor(query, self.start_cursor) if self.start_cursor else None
+    offset = self.offset
+    remaining = self.limit
+    while True:
+      size = PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)
+      entities, more = query.client.run_query(query, cursor, offset, size)
+      offset = 0
+      if remaining is not None:
+        remaining -= len(entities)
+      if entities:
+        cursor = cursor_of(query, entities[-1])
+      self.next_page_token = encode_cursor(cursor) if entities and more else None
+      if query.projection:
+        entities = [project(entity, query.projection) for entity in entities]
+      yield entities
+      if not more or remaining == 0:
+        return
+
+  def __iter__(self):
+    for page in self.pages:
+      for entity in page:
+        yield entity
+
+# writes made inside a transaction are buffered and applied together when it exits without an error
+# the local backends serialize transactions behind one lock, so they never abort on contention
+class LocalTransaction:
+  def __init__(self, client):
+    self.client = client
+    self.writes = {}
+
+  def __enter__(self):
+    self.client.lock.acquire()
+    self.client.transactions().append(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      self.client.transactions().pop()
+      if exc_type is None and self.writes:
+        self.client.apply(self.writes)
+    finally:
+      self.client.lock.release()
+    return False
+
+# shared part of the local backends: keys, id allocation, copies and transactions
+# subclasses implement lookup, apply and run_query
+class LocalClient:
+  def __init__(self):
+    self.project = LOCAL_PROJECT
+    self.lock = threading.RLock()
+    self.local = threading.local()
+    self.last_id = 0
+
+  def key(self, *path_args, **kwargs):
+    kwargs.setdefault("project", self.project)
+    return datastore.Key(*path_args, **kwargs)
+
+  def query(self, kind):
+    return LocalQuery(self, kind)
+
+  def transaction(self):
+    return LocalTransaction(self)
+
+  def transactions(self):
+    if not hasattr(self.local, "transactions"):
+      self.local.transactions = []
+    return self.local.transactions
+
+  def allocate_ids(self, incomplete_key, num_ids):
+    with self.lock:
+      first = self.last_id + 1
+      self.last_id += num_ids
+    return [incomplete_key.completed_key(new_id) for new_id in range(first, first + num_ids)]
+
+  def get(self, key):
+    found = self.get_multi([key])
+    return found[0] if found else None
+
+  def get_multi(self, keys):
+    with self.lock:
+      stored = self.lookup(keys)
+    return [self.entity(key, data) for key, data in zip(keys, stored) if data is not None]
+
+  def put(self, entity):
+    self.put_multi([entity])
+
+  def put_multi(self, entities):
+    writes = {}
+    for entity in entities:
+      if entity.key.is_partial:
+        entity.key = self.allocate_ids(entity.key, 1)[0]
+      writes[entity.key] = copy.deepcopy(dict(entity))
+    self.write(writes)
+
+  def delete(self, key):
+    self.delete_multi([key])
+
+  def delete_multi(self, keys):
+    self.write({getattr(key, "key", key): None for key in keys})
+
+  # writes map keys to the data to store, or to None for deletes
+  def write(self, writes):
+    with self.lock:
+      transactions = self.transactions()
+      if transactions:
+        transactions[-1].writes.update(writes)
+      else:
+        self.apply(writes)
+
+  def entity(self, key, data):
+    entity = datastore.Entity(key=key)
+    entity.update(copy.deepcopy(data))
+    return entity
+
+  # keep ids allocated after any id already stored
+  def reserve_id(self, key):
+    if key.id is not None and key.id > self.last_id:
+      self.last_id = key.id
+
+# entities held in dicts in this process, with sorted key lists per kind and per indexed property value
+class MemoryClient(LocalClient):
+  def __init__(self):
+    super().__init__()
+    self.kinds = {}
+
+  def store(self, kind):
+    if kind not in self.kinds:
+      self.kinds[kind] = {"entities": {}, "keys": [], "indexes": {name: {} for name in INDEXED_PROPERTIES}}
+    return self.kinds[kind]
+
+  def lookup(self, keys):
+    return [self.store(key.kind)["entities"].get(key_order(key), (None, None))[1] for key in keys]
+
+  def apply(self, writes):
+    for key, data in writes.items():
+      store = self.store(key.kind)
+      korder = key_order(key)
+      old = store["entities"].get(korder)
+      if old is not None:
+        self.unindex(store, korder, old[1])
+      elif data is not None:
+        bisect.insort(store["keys"], korder)
+
+      if data is None:
+        if old is not None:
+          del store["entities"][korder]
+          store["keys"].pop(bisect.bisect_left(store["keys"], korder))
+      else:
+        store["entities"][korder] = (key, data)
+        self.index(store, korder, data)
+        self.reserve_id(key)
+
+  def index(self, store, korder, data):
+    for name, index in store["indexes"].items():
+      value = property_value(data, name)
+      if value is not MISSING and not isinstance(value, (dict, list)):
+        bisect.insort(index.setdefault(value_order(value), []), korder)
+
+  def unindex(self, store, korder, data):
+    for name, index in store["indexes"].items():
+      value = property_value(data, name)
+      if value is not MISSING and not isinstance(value, (dict, list)):
+        keys = index[value_order(value)]
+        keys.pop(bisect.bisect_left(keys, korder))
+
+  # key orders to consider for a query, narrowed by an equality filter on an indexed property if it has one
+  def candidates(self, store, query):
+    for name, op, value in query.filters:
+      if op == "=" and name in store["indexes"]:
+        return store["indexes"][name].get(value_order(value), [])
+    return store["keys"]
+
+  def run_query(self, query, cursor, offset, size):
+    with self.lock:
+      store = self.store(query.kind)
+      candidates = self.candidates(store, query)
+
+      # in key order, resume right after the cursor's key and stop once the page is full
+      if not query.order:
+        start = bisect.bisect_right(candidates, cursor[1]) if cursor else 0
+        results = []
+        for index in range(start, len(candidates)):
+          korder = candidates[index]
+          key, data = store["entities"][korder]
+          if matches(data, query.filters):
+            results.append((key, data))
+            if len(results) > offset + size:
+              break
+
+      # other sort orders need every match sorted first
+      else:
+        rows = []
+        for korder in candidates:
+          key, data = store["entities"][korder]
+          if matches(data, query.filters):
+            entity = self.entity(key, data)
+            rows.append((sort_position(query, entity), key, data))
+        rows.sort(key=lambda row: row[0])
+        if cursor:
+          position = cursor_position(query, *cursor)
+          rows = [row for row in rows if position < row[0]]
+        results = [(key, data) for _, key, data in rows[:offset + size + 1]]
+
+    results = results[offset:]
+    entities = [self.entity(key, data) for key, data in results[:size]]
+    return entities, len(results) > size
+
+# entities stored as json in one sqlite table, with expression indexes on the indexed properties
+class SQLiteClient(LocalClient):
+  def __init__(self, path=":memory:"):
+    super().__init__()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.execute(
+        "CREATE TABLE IF NOT EXISTS entities ("
+        "kind TEXT NOT NULL, key_type INTEGER NOT NULL, key_id INTEGER NOT NULL, key_name TEXT NOT NULL, data TEXT NOT NULL, "
+        "PRIMARY KEY (kind, key_type, key_id, key_name))")
+      for name in INDEXED_PROPERTIES:
+        self.connection.execute(
+          "CREATE INDEX IF NOT EXISTS entities_" + name.replace(".", "_") +
+          " ON entities (kind, " + self.property_sql(name) + ", key_type, key_id, key_name)")
+      self.last_id = self.connection.execute("SELECT coalesce(max(key_id), 0) FROM entities WHERE key_type = 0").fetchone()[0]
+
+  @staticmethod
+  def property_sql(name):
+    if not PROPERTY_RE.match(name):
+      raise ValueError("Unsupported property name " + name)
+    return "json_extract(data, '$." + name + "')"
+
+  @staticmethod
+  def key_columns(key):
+    if key.id is not None:
+      return (key.kind, 0, key.id, "")
+    return (key.kind, 1, 0, key.name)
+
+  def row_entity(self, row):
+    kind, key_type, key_id, key_name, data = row
+    key = self.key(kind, key_id if key_type == 0 else key_name)
+    return self.entity(key, json.loads(data))
+
+  def lookup(self, keys):
+    stored = []
+    for key in keys:
+      row = self.connection.execute(
+        "SELECT data FROM entities WHERE kind = ? AND key_type = ? AND key_id = ? AND key_name = ?",
+        self.key_columns(key)).fetchone()
+      stored.append(json.loads(row[0]) if row else None)
+    return stored
+
+  def apply(self, writes):
+    with self.connection:
+      for key, data in writes.items():
+        if data is None:
+          self.connection.execute(
+            "DELETE FROM entities WHERE kind = ? AND key_type = ? AND key_id = ? AND key_name = ?",
+            self.key_columns(key))
+        else:
+          self.connection.execute(
+            "INSERT OR REPLACE INTO entities (kind, key_type, key_id, key_name, data) VALUES (?, ?, ?, ?, ?)",
+            self.key_columns(key) + (json.dumps(data),))
+          self.reserve_id(key)
+
+  # sqlite compares json values like datastore orders them: nulls, then numbers, then strings
+  @staticmethod
+  def sql_value(value):
+    return int(value) if isinstance(value, bool) else value
+
+  def run_query(self, query, cursor, offset, size):
+    sql = "SELECT kind, key_type, key_id, key_name, data FROM entities WHERE kind = ?"
+    args = [query.kind]
+    for name, op, value in query.filters:
+      column = self.property_sql(name)
+      if value is None:
+        sql += {"=": " AND " + column + " IS NULL", "!=": " AND " + column + " IS NOT NULL"}.get(op, " AND 0")
+      else:
+        sql += " AND " + column + " " + op + " ?"
+        args.append(self.sql_value(value))
+
+    # keyset condition: strictly after the cursor in (ordered properties..., key) order
+    columns = [(self.property_sql(order.lstrip("-")), order.startswith("-")) for order in query.order]
+    columns += [("key_type", False), ("key_id", False), ("key_name", False)]
+    if cursor:
+      values, korder = cursor
+      values = [self.sql_value(value) for value in values]
+      values += [korder[0], korder[1] if korder[0] == 0 else 0, korder[1] if korder[0] == 1 else ""]
+      alternatives = []
+      for index, (column, descending) in enumerate(columns):
+        terms = [columns[previous][0] + " IS ?" for previous in range(index)]
+        term_args = values[:index]
+        # nulls sort first, so they come after any other value in descending order
+        if values[index] is None:
+          terms.append("0" if descending else column + " IS NOT NULL")
+        elif descending:
+          terms.append("(" + column + " < ? OR " + column + " IS NULL)")
+          term_args.append(values[index])
+        else:
+          terms.append(column + " > ?")
+          term_args.append(values[index])
+        alternatives.append("(" + " AND ".join(terms) + ")")
+        args.extend(term_args)
+      sql += " AND (" + " OR ".join(alternatives) + ")"
+
+    sql += " ORDER BY " + ", ".join(column + (" DESC" if descending else "") for column, descending in columns)
+    sql += " LIMIT ? OFFSET ?"
+    args += [size + 1, offset]
+    with self.lock:
+      rows = self.connection.execute(sql, args).fetchall()
+    entities = [self.row_entity(row) for row in rows[:size]]
+    return entities, len(rows) > size
+
+# wraps any backend and counts the storage round trips, entities and time spent of the current thread, e.g. per request
+# lookups, queries, allocations and commits each count as one round trip, and writes inside a transaction
+# count toward the transaction's commit rather than as round trips of their own
+class CountingClient:
+  def __init__(self, inner):
+    self.inner = inner
+    self.local = threading.local()
+
+  def __getattr__(self, name):
+    return getattr(self.inner, name)
+
+  # counts of the current thread since the last reset
+  def counts(self):
+    if not hasattr(self.local, "counts"):
+      self.local.counts = {"rpcs": {}, "entities_read": 0, "entities_written": 0, "read_seconds": 0.0, "write_seconds": 0.0}
+      self.local.depth = 0
+    return self.local.counts
+
+  # return the counts of the current thread and start counting from zero
+  def reset(self):
+    counts = self.counts()
+    del self.local.counts
+    return counts
+
+  # copy of the counts of the current thread, to measure what happens after it with since()
+  def snapshot(self):
+    counts = dict(self.counts())
+    counts["rpcs"] = dict(counts["rpcs"])
+    return counts
+
+  # counts of the current thread since a snapshot
+  def since(self, snapshot):
+    counts = self.counts()
+    difference = {name: counts[name] - snapshot[name] for name in counts if name != "rpcs"}
+    difference["rpcs"] = {rpc: count - snapshot["rpcs"].get(rpc, 0) for rpc, count in counts["rpcs"].items()
+      if count != snapshot["rpcs"].get(rpc, 0)}
+    return difference
+
+  def count(self, rpc, read=0, written=0, read_seconds=0.0, write_seconds=0.0):
+    counts = self.counts()
+    if rpc:
+      counts["rpcs"][rpc] = counts["rpcs"].get(rpc, 0) + 1
+    counts["entities_read"] += read
+    counts["entities_written"] += written
+    counts["read_seconds"] += read_seconds
+    counts["write_seconds"] += write_seconds
+
+  def in_transaction(self):
+    self.counts()
+    return self.local.depth > 0
+
+  def get(self, key, *args, **kwargs):
+    found = self.get_multi([key], *args, **kwargs)
+    return found[0] if found else None
+
+  def get_multi(self, keys, *args, **kwargs):
+    start = time.perf_counter()
+    found = self.inner.get_multi(keys, *args, **kwargs)
+    self.count("lookup", read=len(found), read_seconds=time.perf_counter() - start)
+    return found
+
+  def put(self, entity, *args, **kwargs):
+    self.put_multi([entity], *args, **kwargs)
+
+  def put_multi(self, entities, *args, **kwargs):
+    start = time.perf_counter()
+    self.inner.put_multi(entities, *args, **kwargs)
+    self.count(None if self.in_transaction() else "commit", written=len(entities), write_seconds=time.perf_counter() - start)
+
+  def delete(self, key, *args, **kwargs):
+    self.delete_multi([key], *args, **kwargs)
+
+  def delete_multi(self, keys, *args, **kwargs):
+    start = time.perf_counter()
+    self.inner.delete_multi(keys, *args, **kwargs)
+    self.count(None if self.in_transaction() else "commit", written=len(keys), write_seconds=time.perf_counter() - start)
+
+  def allocate_ids(self, incomplete_key, num_ids, *args, **kwargs):
+    start = time.perf_counter()
+    keys = self.inner.allocate_ids(incomplete_key, num_ids, *args, **kwargs)
+    self.count("allocate_ids", write_seconds=time.perf_counter() - start)
+    return keys
+
+  def transaction(self, *args, **kwargs):
+    return CountingTransaction(self, self.inner.transaction(*args, **kwargs))
+
+  def query(self, *args, **kwargs):
+    query = self.inner.query(*args, **kwargs)
+    fetch = query.fetch
+    def counted_fetch(*fetch_args, **fetch_kwargs):
+      return CountingIterator(self, fetch(*fetch_args, **fetch_kwargs))
+    query.fetch = counted_fetch
+    return query
+
+class CountingTransaction:
+  def __init__(self, client, inner):
+    self.client = client
+    self.inner = inner
+
+  def __enter__(self):
+    self.client.counts()
+    self.client.local.depth += 1
+    start = time.perf_counter()
+    entered = self.inner.__enter__()
+    self.client.count("begin_transaction", write_seconds=time.perf_counter() - start)
+    return entered
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    start = time.perf_counter()
+    try:
+      return self.inner.__exit__(exc_type, exc_value, traceback)
+    finally:
+      self.client.local.depth -= 1
+      self.client.count("commit" if exc_type is None else "rollback", write_seconds=time.perf_counter() - start)
+
+class CountingIterator:
+  def __init__(self, client, inner):
+    self.client = client
+    self.inner = inner
+
+  @property
+  def next_page_token(self):
+    return self.inner.next_page_token
+
+  @property
+  def pages(self):
+    pages = iter(self.inner.pages)
+    while True:
+      start = time.perf_counter()
+      page = next(pages, None)
+      if page is None:
+        return
+      page = list(page)
+      self.client.count("run_query", read=len(page), read_seconds=time.perf_counter() - start)
+      yield page
+
+  def __iter__(self):
+    for page in self.pages:
+      for entity in page:
+        yield entity
@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+import assignments
+import constants
+import counters
+import transactions
+import versions
+
+# background work that should not hold up the response, run on a small pool of threads
+executor = ThreadPoolExecutor(max_workers=4)
+
+def submit(fn, *args):
+  return executor.submit(fn, *args)
+
+# clear the carrier of the loads still carried by the boat, and return the loads that changed
+def clear_carrier(loads, boat_key):
+  cleared = []
+  for load in loads:
+    if load["carrier"] and load["carrier"]["id"] == str(boat_key.id):
+      load["carrier"] = None
+      cleared.append(load)
+  return cleared
+
+# keys of up to limit loads still carried by a boat
+def carried_load_keys(client, boat_key, limit):
+  query = assignments.carried_loads(client, boat_key)
+  query.keys_only()
+  return [load.key for load in query.fetch(limit=limit)]
+
+# delete a boat and clear it as the carrier of its loads
+# returns True if the boat was deleted, or False if the cascade was too large for one transaction
+# and continues in the background, with the boat marked as deleting until it finishes
+# if a version is given, raises versions.Modified instead when the stored boat no longer has it
+def delete_boat(client, boat, version=None):
+  # every assignment writes the boat, bumping its version, so the version the boat had before its loads
+  # were queried tells whether a load was assigned to it since
+  seen = versions.version_of(boat)
+
+  # the boat's delete and tombstone count as two mutations, the rest of the transaction can update its loads
+  load_keys = carried_load_keys(client, boat.key, constants.max_mutations - 1)
+  if len(load_keys) < constants.max_mutations - 1:
+    try:
+      with client.transaction():
+        boat = client.get(boat.key)
+        if boat is None:
+          return True
+        if version is not None:
+          versions.check(boat, version)
+        # a boat written since, e.g. given a load the query missed, is left to the background job,
+        # which marks it as deleting first, so it takes no new loads, and queries its loads again
+        unchanged = versions.version_of(boat) == seen
+        if unchanged:
+          loads = client.get_multi(load_keys)
+          client.put_multi(clear_carrier(loads, boat.key))
+          client.delete(boat)
+      if unchanged:
+        counters.increment(client, [constants.boats, counters.owner_name(constants.boats, boat["owner"])], -1)
+        return True
+    except Conflict:
+      # a concurrent write touched the boat or one of its loads; let the background job retry in chunks
+      pass
+
+  if transactions.run_in_transaction(client, mark_deleting, client, boat.key, version) is None:
+    return True
+  submit(resume_delete_boat, client, boat.key)
+  return False
+
+# mark a boat as deleting, and return it, or None if it no longer exists
+def mark_deleting(client, boat_key, version=None):
+  boat = client.get(boat_key)
+  if boat is None:
+    return None
+  if version is not None:
+    versions.check(boat, version)
+  boat["deleting"] = True
+  client.put(boat)
+  return boat
+
+# clear the carrier of the given loads of a deleting boat, or delete the boat once it has none left,
+# and return the boat, or None if it no longer exists
+def delete_chunk(client, boat_key, load_keys):
+  boat = client.get(boat_key)
+  if boat is None:
+    return None
+  if load_keys:
+    client.put_multi(clear_carrier(client.get_multi(load_keys), boat_key))
+  else:
+    client.delete(boat)
+  return boat
+
+# clear the carrier of a deleting boat's loads one transaction-sized chunk at a time, then delete the boat
+# a deleting boat takes no new loads, and each chunk's loads stop matching the query once cleared,
+# so the job can be rerun from wherever it stopped; a chunk that keeps conflicting ends the job,
+# and the boat, still marked as deleting, is picked up again by the resume-deletes cron job
+def resume_delete_boat(client, boat_key):
+  while True:
+    load_keys = carried_load_keys(client, boat_key, constants.max_mutations)
+    boat = transactions.run_in_transaction(client, delete_chunk, client, boat_key, load_keys)
+    if boat is None:
+      return
+    if not load_keys:
+      counters.increment(client, [constants.boats, counters.owner_name(constants.boats, boat["owner"])], -1)
+      return
+
+# restart the cascades of boats still marked as deleting, e.g. after an instance was shut down mid-job
+def resume_deletes(client):
+  query = client.query(kind=constants.boats)
+  query.add_filter("deleting", "=", True)
+  query.keys_only()
+  boat_keys = [boat.key for boat in query.fetch()]
+  for boat_key in boat_keys:
+    submit(resume_delete_boat, client, boat_key)
+  return len(boat_keys)
+
+# job states of a rename fan-out
+RUNNING = "running"
+DONE = "done"
+
+# copy a boat's name into the carrier of its loads, whenever a request set the boat's name
+# returns True if the loads were updated in one transaction, or False if the boat has too many loads for one,
+# in which case the fan-out continues in the background, reporting its progress on the rename job of the boat
+def rename_carrier(client, boat):
+  load_keys = carried_load_keys(client, boat.key, constants.max_mutations)
+  if len(load_keys) < constants.max_mutations:
+    transactions.run_in_transaction(client, rename_chunk, client, boat.key, load_keys)
+    return True
+
+  job = datastore.Entity(key=rename_job_key(client, boat.key))
+  job.update({"status": RUNNING, "name": boat["name"], "loads_checked": 0, "loads_updated": 0})
+  client.put(job)
+  submit(resume_rename_carrier, client, boat.key)
+  return False
+
+def rename_job_key(client, boat_key):
+  return client.key(constants.jobs, "rename:" + str(boat_key.id))
+
+# the rename job of a boat, if it has one
+def rename_job(client, boat_key):
+  return client.get(rename_job_key(client, boat_key))
+
+# set the carrier name of the given loads still carried by the boat to the boat's current name
+# the boat is read in the same transaction, so a concurrent rename makes the commit fail and the chunk is retried
+# with the newer name; loads that already have it are left alone, so chunks can be rerun
+# returns the number of loads updated, and the name, or None if the boat no longer exists
+def rename_chunk(client, boat_key, load_keys):
+  boat = client.get(boat_key)
+  if boat is None:
+    return 0, None
+  renamed = []
+  for load in client.get_multi(load_keys):
+    if load["carrier"] and load["carrier"]["id"] == str(boat_key.id) and load["carrier"].get("name") != boat["name"]:
+      load["carrier"]["name"] = boat["name"]
+      renamed.append(load)
+  if renamed:
+    client.put_multi(renamed)
+  return len(renamed), boat["name"]
+
+# page through a boat's loads one transaction-sized chunk at a time, renaming their carrier,
+# and record the progress on the boat's rename job, which is done once a pass has given every load the boat's name
+# safe to rerun, or to run alongside another rename of the same boat, as each chunk reads the boat's current name
+def resume_rename_carrier(client, boat_key):
+  query = assignments.carried_loads(client, boat_key)
+  query.keys_only()
+  cursor = None
+  checked = 0
+  updated = 0
+  name = None
+  while True:
+    iterator = query.fetch(limit=constants.max_mutations, start_cursor=cursor)
+    load_keys = [load.key for load in next(iterator.pages)]
+    chunk_updated, name = transactions.run_in_transaction(client, rename_chunk, client, boat_key, load_keys)
+    if name is None:
+      client.delete(rename_job_key(client, boat_key))
+      return
+    checked += len(load_keys)
+    updated += chunk_updated
+    cursor = iterator.next_page_token
+    finished = not cursor or not load_keys
+    transactions.run_in_transaction(client, record_rename_progress, client, boat_key, name, checked, updated, finished)
+    if finished:
+      return
+
+# record the progress of a pass renaming the carrier to name on the boat's job
+def record_rename_progress(client, boat_key, name, checked, updated, finished):
+  job = rename_job(client, boat_key)
+  if job is None:
+    return
+  job.update({"name": name, "loads_checked": checked, "loads_updated": updated, "status": DONE if finished else RUNNING})
+  client.put(job)
+
+# restart the rename fan-outs still running, e.g. after an instance was shut down mid-job
+def resume_renames(client):
+  query = client.query(kind=constants.jobs)
+  query.add_filter("status", "=", RUNNING)
+  job_keys = [job.key for job in query.fetch()]
+  for job_key in job_keys:
+    boat_id = int(job_key.name.split(":")[1])
+    submit(resume_rename_carrier, client, client.key(constants.boats, boat_id))
+  return len(job_keys)
@@ -0,0 +1,8 @@
+# the app's modules live at the root of the repository, next to main.py, and the tests share
+# the benchmarks' harness, e.g. its locally signed JWTs
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
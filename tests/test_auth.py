@@ -0,0 +1,162 @@
+# offline tests of token verification, with tokens signed by the harness's local key and certificates served
+# by a fake transport, so no request reaches Google
+import json
+import time
+
+import pytest
+
+import auth
+import harness
+
+AUDIENCE = harness.CLIENT_ID
+KEY_ID = harness.KEY_ID
+
+@pytest.fixture(scope="module")
+def signer():
+  return harness.LocalSigner()
+
+def token(signer, sub="user", lifetime=3600, iss="https://accounts.google.com"):
+  return signer.token(sub, lifetime, iss)
+
+# a clock the tests move by hand
+class Clock:
+  def __init__(self, now=None):
+    self.now = time.time() if now is None else now
+
+  def __call__(self):
+    return self.now
+
+# answers every certificate fetch with the given certificates and headers, and counts the fetches
+class Transport:
+  def __init__(self, certs, headers=None):
+    self.certs = certs
+    self.headers = headers if headers is not None else {"Cache-Control": "public, max-age=3600"}
+    self.fetches = 0
+
+  def __call__(self, url, method, timeout):
+    self.fetches += 1
+    return Response(200, json.dumps(self.certs).encode("utf-8"), self.headers)
+
+class Response:
+  def __init__(self, status, data, headers):
+    self.status = status
+    self.data = data
+    self.headers = headers
+
+def test_verified_token_is_served_from_cache(signer):
+  transport = Transport(signer.certs())
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.GoogleCertCache(transport=transport))
+  jwt_token = token(signer)
+
+  assert verifier.verify(jwt_token)["sub"] == "user"
+  assert verifier.verify(jwt_token)["sub"] == "user"
+  assert verifier.stats()["token_hits"] == 1
+  assert verifier.stats()["token_misses"] == 1
+  assert transport.fetches == 1
+
+def test_cached_claims_are_copies(signer):
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.StaticKeySet(signer.certs()))
+  jwt_token = token(signer)
+  verifier.verify(jwt_token)["sub"] = "someone else"
+  assert verifier.verify(jwt_token)["sub"] == "user"
+
+def test_expired_token_is_evicted(signer):
+  clock = Clock()
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.StaticKeySet(signer.certs()), clock=clock)
+  jwt_token = token(signer, lifetime=60)
+  verifier.verify(jwt_token)
+  assert verifier.stats()["tokens_cached"] == 1
+
+  # past the token's expiry by the verifier's clock, the cached claims are dropped and the token is verified again
+  clock.now += 120
+  verifier.verify(jwt_token)
+  assert verifier.stats()["token_hits"] == 0
+  assert verifier.stats()["token_misses"] == 2
+
+def test_least_recently_used_tokens_are_evicted(signer):
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.StaticKeySet(signer.certs()), max_tokens=2)
+  first, second, third = token(signer, "first"), token(signer, "second"), token(signer, "third")
+  verifier.verify(first)
+  verifier.verify(second)
+  verifier.verify(first)
+  verifier.verify(third)
+  assert verifier.stats()["tokens_cached"] == 2
+
+  verifier.verify(first)
+  assert verifier.stats()["token_hits"] == 2
+  verifier.verify(second)
+  assert verifier.stats()["token_hits"] == 2
+
+def test_invalid_tokens_are_rejected(signer):
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.StaticKeySet(signer.certs()))
+  with pytest.raises(ValueError):
+    verifier.verify("")
+  with pytest.raises(ValueError):
+    verifier.verify("not a token")
+  with pytest.raises(ValueError):
+    verifier.verify(token(signer, iss="https://example.com"))
+  with pytest.raises(ValueError):
+    auth.TokenVerifier("another audience", keys=auth.StaticKeySet(signer.certs())).verify(token(signer))
+  assert verifier.stats()["tokens_cached"] == 0
+
+def test_unknown_kid_refetches_at_most_once_per_interval(signer):
+  clock = Clock()
+  transport = Transport(signer.certs())
+  certs = auth.GoogleCertCache(transport=transport, clock=clock)
+
+  certs.get(KEY_ID)
+  certs.get(KEY_ID)
+  assert transport.fetches == 1
+
+  # an unknown kid right after a fetch is served the cached certificates
+  certs.get("forged")
+  assert transport.fetches == 1
+
+  # once the interval has passed it may mean a key rotation, so the certificates are fetched again, once
+  clock.now += auth.MIN_REFRESH_INTERVAL
+  certs.get("forged")
+  certs.get("forged")
+  assert transport.fetches == 2
+
+def test_expired_certificates_are_refetched(signer):
+  clock = Clock()
+  transport = Transport(signer.certs(), {"Cache-Control": "public, max-age=100", "Age": "40"})
+  certs = auth.GoogleCertCache(transport=transport, clock=clock)
+
+  certs.get(KEY_ID)
+  clock.now += 59
+  certs.get(KEY_ID)
+  assert transport.fetches == 1
+  clock.now += 1
+  certs.get(KEY_ID)
+  assert transport.fetches == 2
+
+def test_unknown_kid_token_is_verified_after_rotation(signer):
+  clock = Clock()
+  transport = Transport({"old-key": "not a certificate"})
+  verifier = auth.TokenVerifier(AUDIENCE, keys=auth.GoogleCertCache(transport=transport, clock=clock), clock=clock)
+  verifier.keys.get("old-key")
+
+  transport.certs = signer.certs()
+  clock.now += auth.MIN_REFRESH_INTERVAL
+  assert verifier.verify(token(signer))["sub"] == "user"
+  assert transport.fetches == 2
+
+def test_failed_fetch_raises():
+  certs = auth.GoogleCertCache(transport=lambda url, method, timeout: Response(500, b"", {}))
+  with pytest.raises(ValueError):
+    certs.get(KEY_ID)
+
+@pytest.mark.parametrize("headers, expected", [
+  ({"Cache-Control": "public, max-age=19845, must-revalidate, no-transform"}, 19845),
+  ({"cache-control": "max-age=600", "age": "100"}, 500),
+  ({"Cache-Control": "max-age=600", "Age": "900"}, 0),
+  ({"Cache-Control": "max-age=600", "Age": ""}, 600),
+  ({"Cache-Control": "no-cache, max-age=600"}, 0),
+  ({"Cache-Control": "no-store"}, 0),
+  ({"Cache-Control": "public"}, auth.DEFAULT_CERTS_TTL),
+  ({}, auth.DEFAULT_CERTS_TTL),
+  (None, auth.DEFAULT_CERTS_TTL)
+])
+def test_max_age(headers, expected):
+  assert auth.GoogleCertCache.max_age(headers) == expected
@@ -0,0 +1,84 @@
+# tests of the read-through cache racing writes: a read that finishes after a concurrent write must not cache
+# the copy it read over what the write left
+from google.cloud import datastore
+import pytest
+
+import cache
+import storage
+import versions
+
+KIND = "boats"
+
+# a clock the tests move by hand
+class Clock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+# a storage client whose lookups run a write in the middle, after reading, as a concurrent request would
+class RacingClient:
+  def __init__(self, inner):
+    self.inner = inner
+    self.race = None
+
+  def __getattr__(self, name):
+    return getattr(self.inner, name)
+
+  def get_multi(self, keys, *args, **kwargs):
+    found = self.inner.get_multi(keys, *args, **kwargs)
+    race, self.race = self.race, None
+    if race is not None:
+      race()
+    return found
+
+@pytest.fixture(params=[False, True], ids=["local", "shared"])
+def setup(request):
+  clock = Clock()
+  racing = RacingClient(versions.VersioningClient(storage.MemoryClient(), [KIND]))
+  shared = cache.DictSharedTier(clock) if request.param else None
+  client = cache.CachingClient(racing, [KIND], cache.LocalTier(clock=clock), shared)
+  boat = datastore.Entity(key=client.key(KIND, 1))
+  boat.update({"name": "first"})
+  racing.inner.put(boat)
+  return client, racing, clock, boat.key
+
+def rename(client, key, name):
+  boat = client.inner.inner.get(key)
+  boat["name"] = name
+  client.put(boat)
+
+def rename_in_transaction(client, key, name):
+  with client.transaction():
+    boat = client.inner.inner.get(key)
+    boat["name"] = name
+    client.put(boat)
+
+def test_read_does_not_replace_a_newer_write(setup):
+  client, racing, _, key = setup
+  racing.race = lambda: rename(client, key, "second")
+  assert client.get(key)["name"] == "first"
+  assert client.get(key)["name"] == "second"
+  assert client.peek(key)["name"] == "second"
+
+def test_read_started_before_an_invalidation_is_not_cached(setup):
+  client, racing, clock, key = setup
+  racing.race = lambda: rename_in_transaction(client, key, "second")
+  assert client.get(key)["name"] == "first"
+  assert client.peek(key) is None
+  assert client.get(key)["name"] == "second"
+
+def test_read_started_after_an_invalidation_is_cached(setup):
+  client, _, clock, key = setup
+  rename_in_transaction(client, key, "second")
+  clock.now += cache.INVALIDATION_WINDOW + 1
+  assert client.get(key)["name"] == "second"
+  assert client.peek(key)["name"] == "second"
+
+def test_write_replaces_cached_copy(setup):
+  client, _, _, key = setup
+  client.get(key)
+  rename(client, key, "second")
+  assert client.peek(key)["name"] == "second"
+  assert client.peek(key)["version"] == 2
@@ -0,0 +1,125 @@
+# tests of the local storage backends' queries: filters, sort orders, and paging with cursors,
+# which the memory backend resumes by position in its sorted keys and the sqlite backend with a keyset condition
+from google.cloud import datastore
+import pytest
+
+import storage
+
+KIND = "Items"
+
+# volumes with repeats, a None and a string, so cursors must break ties by key and order values across types
+VOLUMES = [5, 3, None, 5, 1, 3, 5, "many", 2, 4, 5, 0]
+
+@pytest.fixture(params=["memory", "sqlite"])
+def client(request):
+  if request.param == "memory":
+    client = storage.MemoryClient()
+  else:
+    client = storage.SQLiteClient(":memory:")
+  entities = []
+  for index, volume in enumerate(VOLUMES):
+    entity = datastore.Entity(key=client.key(KIND, index + 1))
+    entity.update({"owner": "even" if index % 2 == 0 else "odd", "volume": volume})
+    entities.append(entity)
+  client.put_multi(entities)
+  return client
+
+def query(client, order=(), filters=()):
+  query = client.query(kind=KIND)
+  query.order = list(order)
+  for name, op, value in filters:
+    query.add_filter(name, op, value)
+  return query
+
+def ids(entities):
+  return [entity.key.id for entity in entities]
+
+# every page of a query, following next_page_token from one to the next
+def pages(query, limit):
+  pages = []
+  cursor = None
+  while True:
+    iterator = query.fetch(limit=limit, start_cursor=cursor)
+    pages.append(ids(next(iterator.pages)))
+    cursor = iterator.next_page_token
+    if not cursor:
+      return pages
+
+def test_key_order(client):
+  assert ids(query(client).fetch()) == list(range(1, len(VOLUMES) + 1))
+
+def test_sort_orders(client):
+  # nulls sort before numbers and numbers before strings, with ties broken by key
+  assert ids(query(client, ["volume"]).fetch()) == [3, 12, 5, 9, 2, 6, 10, 1, 4, 7, 11, 8]
+  assert ids(query(client, ["-volume"]).fetch()) == [8, 1, 4, 7, 11, 10, 2, 6, 9, 5, 12, 3]
+  assert ids(query(client, ["owner", "-volume"]).fetch()) == [1, 7, 11, 9, 5, 3, 8, 4, 10, 2, 6, 12]
+
+def test_filters(client):
+  assert ids(query(client, filters=[("volume", "=", 5)]).fetch()) == [1, 4, 7, 11]
+  assert ids(query(client, filters=[("volume", "=", None)]).fetch()) == [3]
+  assert ids(query(client, filters=[("owner", "=", "odd"), ("volume", "<=", 3)]).fetch()) == [2, 6, 12]
+  assert ids(query(client, ["-volume"], [("volume", "<", 5), ("volume", ">", 0)]).fetch()) == [10, 2, 6, 9, 5]
+
+@pytest.mark.parametrize("order", [(), ("volume",), ("-volume",), ("owner", "-volume")])
+@pytest.mark.parametrize("limit", [1, 2, 5])
+def test_pages_follow_on_from_cursors(client, order, limit):
+  pages_of_query = pages(query(client, order), limit)
+  assert all(len(page) == limit for page in pages_of_query[:-1])
+  assert sum(pages_of_query, []) == ids(query(client, order).fetch())
+
+def test_cursor_resumes_after_entities_written_since(client):
+  iterator = query(client, ["volume"]).fetch(limit=4)
+  assert ids(next(iterator.pages)) == [3, 12, 5, 9]
+  cursor = iterator.next_page_token
+
+  # an entity sorting before the cursor is not returned, one sorting after it is
+  before = datastore.Entity(key=client.key(KIND, 100))
+  before.update({"owner": "even", "volume": 0})
+  after = datastore.Entity(key=client.key(KIND, 101))
+  after.update({"owner": "even", "volume": 4})
+  client.put_multi([before, after])
+  assert ids(query(client, ["volume"]).fetch(start_cursor=cursor)) == [2, 6, 10, 101, 1, 4, 7, 11, 8]
+
+def test_last_page_has_no_cursor(client):
+  iterator = query(client).fetch(limit=len(VOLUMES))
+  assert len(next(iterator.pages)) == len(VOLUMES)
+  assert iterator.next_page_token is None
+
+def test_offset_and_limit(client):
+  assert ids(query(client, ["-volume"]).fetch(limit=3, offset=2)) == [4, 7, 11]
+  assert ids(query(client).fetch(offset=10)) == [11, 12]
+
+def test_cursor_of_another_query_is_rejected(client):
+  iterator = query(client, ["volume"]).fetch(limit=2)
+  next(iterator.pages)
+  with pytest.raises(ValueError):
+    list(query(client, ["owner", "volume"]).fetch(start_cursor=iterator.next_page_token))
+
+def test_cursor_round_trip():
+  cursor = ([None, "odd", 2.5], (0, 7))
+  token = storage.encode_cursor(cursor)
+  assert storage.decode_cursor(query(storage.MemoryClient(), ["a", "-b", "c"]), token) == cursor
+  assert storage.decode_cursor(query(storage.MemoryClient(), ["a", "-b", "c"]), token.decode("utf-8")) == cursor
+
+def test_projection_and_keys_only(client):
+  projected = query(client, filters=[("volume", "=", 5)])
+  projected.projection = ["volume"]
+  assert [dict(entity) for entity in projected.fetch()] == [{"volume": 5}] * 4
+
+  keys = query(client, filters=[("owner", "=", "odd")])
+  keys.keys_only()
+  assert [(entity.key.id, dict(entity)) for entity in keys.fetch(limit=2)] == [(2, {}), (4, {})]
+
+def test_transaction_writes_apply_on_exit(client):
+  entity = client.get(client.key(KIND, 1))
+  with client.transaction():
+    entity["volume"] = 50
+    client.put(entity)
+    assert client.get(entity.key)["volume"] == 5
+  assert client.get(entity.key)["volume"] == 50
+
+  with pytest.raises(RuntimeError):
+    with client.transaction():
+      client.delete(entity.key)
+      raise RuntimeError()
+  assert client.get(entity.key) is not None
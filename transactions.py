@@ -0,0 +1,21 @@
+from google.api_core.exceptions import Conflict
+import random
+import time
+
+# attempts before giving up on a transaction that keeps aborting on contention
+MAX_ATTEMPTS = 5
+
+# base delay between attempts, doubled after each one and jittered so retries spread out
+BASE_DELAY = 0.05
+
+# run fn(*args) inside a transaction and return its result, retrying when the commit aborts on contention
+# fn must only read and write through the client, since it may run more than once
+def run_in_transaction(client, fn, *args):
+  for attempt in range(MAX_ATTEMPTS):
+    try:
+      with client.transaction():
+        return fn(*args)
+    except Conflict:
+      if attempt == MAX_ATTEMPTS - 1:
+        raise
+      time.sleep(random.uniform(0, BASE_DELAY * 2 ** attempt))
@@ -0,0 +1,73 @@
+from google.cloud import datastore
+import constants
+import threading
+import time
+
+# entity versions, which every write bumps, so a client can tell whether an entity changed since it read it
+# the version is stored on the entity as "version", and is 0 for entities written before versions existed
+# every write also stamps the entity's "updated" sequence, and every delete leaves a tombstone with one,
+# which the change feed pages through
+
+# raised when an entity was modified or deleted since the version a write expected
+class Modified(Exception):
+  pass
+
+def version_of(entity):
+  return entity.get("version", 0)
+
+# raise Modified unless the entity exists and still has the expected version
+def check(entity, version):
+  if entity is None or version_of(entity) != version:
+    raise Modified()
+
+# update sequence: microseconds since the epoch, strictly increasing within this process
+sequence_lock = threading.Lock()
+last_sequence = 0
+
+def next_sequence():
+  global last_sequence
+  with sequence_lock:
+    last_sequence = max(int(time.time() * 1000000), last_sequence + 1)
+    return last_sequence
+
+# tombstone of a deleted entity, keyed by the entity's kind and id
+# boats keep their owner, so each user's feed only has their own boats' deletions; loads have none
+def tombstone(client, entity_or_key, sequence):
+  key = getattr(entity_or_key, "key", entity_or_key)
+  owner = entity_or_key.get("owner") if isinstance(entity_or_key, datastore.Entity) else None
+  entity = datastore.Entity(key=client.key(constants.tombstones, key.kind + ":" + str(key.id_or_name)))
+  entity.update({"kind": key.kind, "id": key.id_or_name, "owner": owner, "updated": sequence})
+  return entity
+
+# wraps a storage client, bumping the version and stamping the update sequence of the entities of the given kinds
+# whenever they are put, and leaving a tombstone whenever they are deleted, inside transactions or not,
+# so no write path can forget to; deleting a boat by its entity rather than its key keeps its owner on the tombstone
+# the new version is one more than the version of the entity put, so writers of existing entities read them
+# in the same transaction as the put; otherwise two writes from the same read would store one version with two bodies
+class VersioningClient:
+  def __init__(self, inner, kinds):
+    self.inner = inner
+    self.kinds = set(kinds)
+
+  def __getattr__(self, name):
+    return getattr(self.inner, name)
+
+  def put(self, entity, *args, **kwargs):
+    self.put_multi([entity], *args, **kwargs)
+
+  def put_multi(self, entities, *args, **kwargs):
+    for entity in entities:
+      if entity.key.kind in self.kinds:
+        entity["version"] = version_of(entity) + 1
+        entity["updated"] = next_sequence()
+    self.inner.put_multi(entities, *args, **kwargs)
+
+  def delete(self, key, *args, **kwargs):
+    self.delete_multi([key], *args, **kwargs)
+
+  # tombstones and deletes count as one mutation each in a transaction
+  def delete_multi(self, keys, *args, **kwargs):
+    tombstones = [tombstone(self, key, next_sequence()) for key in keys if getattr(key, "key", key).kind in self.kinds]
+    if tombstones:
+      self.inner.put_multi(tombstones)
+    self.inner.delete_multi([getattr(key, "key", key) for key in keys], *args, **kwargs)